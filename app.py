@@ -1,19 +1,19 @@
-import ruamel.yaml
-from cytube_bot import CytubeBot
-from discord.ext import commands
-
-CONFIG_FILE = 'config.yaml'
+import time
 
-with open(CONFIG_FILE, 'r') as f:
-    settings = ruamel.yaml.load(f.read(), ruamel.yaml.RoundTripLoader)
+# Taken before the heavy imports below, so the startup timings include them
+START_TIME = time.perf_counter()
 
-DISCORD_CLIENT_KEY = settings['login']['discord_client_key']
+import config
+from cytube_bot import CytubeBot
+from discord.ext import commands
 
-STREAM_URL = settings['stream']['stream_url']
-RTMP_ENDPOINT = settings['stream']['rtmp_endpoint']
-MEDIA_DIRECTORY = settings['stream']['media_directory']
-CHANNEL_WHITELIST = settings['channels']['whitelist']
+# The only place config.yaml is read, everything else gets its settings from here
+CONFIG = config.load_config()
 
 bot = commands.Bot(command_prefix=commands.when_mentioned_or('!'), description='A bot that plays videos on CyTube')
-bot.add_cog(CytubeBot(bot, STREAM_URL, RTMP_ENDPOINT, MEDIA_DIRECTORY, CHANNEL_WHITELIST))
-bot.run(DISCORD_CLIENT_KEY)
\ No newline at end of file
+cog = CytubeBot(bot, CONFIG, started_at=START_TIME)
+bot.add_cog(cog)
+try:
+    bot.run(CONFIG.discord_client_key)
+finally:
+    cog.save_warm_cache()
@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+# End-to-end latency benchmark of the bot, without Discord or an RTMP server.
+#
+# A synthetic library is generated with lavfi (testsrc2 video, two sine audio tracks and two subtitle tracks per file,
+# at several resolutions), along with a wide directory and a deep directory tree of hard links for listings.
+# CytubeBot commands are driven through a fake bot object that answers every track question with 1, and the player
+# streams to a local TCP sink that counts what arrives (or to a real RTMP server with --rtmp-url).
+#
+# Scenarios:
+#   ls_cold_*, ls_warm_*   !ls with the listing cache cleared, then again with it warm
+#   first_frame_*          !stream play until FFmpeg reports its first frame
+#   first_output_*         !stream play until the first byte reaches the sink (TCP sink only)
+#   seek_*                 !stream seek until the new encoder reports its first frame
+#   seek_gap_*             longest silence at the sink during a seek (TCP sink only)
+#   skip                   !stream skip until the next video reports its first frame
+#   transition_gap         stall between two queued videos, as measured by the relay
+#
+# Results are printed as p50/p99/max per scenario, or written as JSON with --output. With --baseline, the run fails
+# when a scenario's p50 is more than --tolerance slower than in the baseline file.
+#
+# Usage: python3 benchmarks/bot_benchmark.py [--iterations 5] [--library-dir DIR] [--output results.json]
+#                                            [--baseline old.json] [--rtmp-url rtmp://localhost/live/bench]
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import perf_monitor
+from filter_graph_benchmark import write_subtitles
+
+RESOLUTIONS = [(640, 360), (1280, 720), (1920, 1080)]
+VIDEO_DURATION = 120
+CLIP_DURATION = 4
+SEEK_TARGETS = [30, 90, 60]
+
+POLL_INTERVAL = 0.005
+WAIT_TIMEOUT = 60
+
+CHANNEL_NAME = 'benchmark'
+
+
+class FakeUser(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeChannel(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeMessage(object):
+
+    def __init__(self, content, channel):
+        self.content = content
+        self.channel = channel
+        self.server = object()
+
+
+class FakeContext(object):
+
+    def __init__(self, command, channel):
+        self.command = command
+        self.message = FakeMessage('', channel)
+        self.invoked_subcommand = None
+
+
+# Stands in for discord.ext.commands.Bot, with only what CytubeBot and ask_for_int use.
+# Enforces Discord's per channel rate limit the way the real API does, by making the sender wait out a 429 backoff
+class FakeBot(object):
+
+    def __init__(self, answer='1', rate=5, per=5.0, retry_after=1.0):
+        self.user = FakeUser('benchmark')
+        self.messages = []
+        self.rate_limited = 0
+        self._answer = answer
+        self._rate = rate
+        self._per = per
+        self._retry_after = retry_after
+        self._sent = collections.defaultdict(collections.deque)
+
+    async def send_message(self, destination, content):
+        sent = self._sent[destination]
+        while True:
+            now = time.perf_counter()
+            while sent and now - sent[0] >= self._per:
+                sent.popleft()
+            if len(sent) < self._rate:
+                break
+            self.rate_limited += 1
+            await asyncio.sleep(self._retry_after)
+
+        sent.append(now)
+        message = FakeMessage(content, destination)
+        self.messages.append(message)
+        return message
+
+    async def wait_for_message(self, timeout=None, channel=None, check=None):
+        message = FakeMessage(self._answer, channel)
+        return message if check is None or check(message) else None
+
+    async def change_presence(self, game=None, status=None, afk=False):
+        pass
+
+
+# Accepts the relay's FLV-over-TCP connections and records when data arrives
+class TcpSink(object):
+
+    def __init__(self):
+        self.arrivals = []
+        self.total_bytes = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return 'tcp://127.0.0.1:{}'.format(self._server.sockets[0].getsockname()[1])
+
+    async def _handle(self, reader, writer):
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            self.total_bytes += len(data)
+            self.arrivals.append(time.perf_counter())
+        writer.close()
+
+    def first_arrival_after(self, since):
+        for arrival in self.arrivals:
+            if arrival >= since:
+                return arrival
+        return None
+
+    def max_gap(self, since, until):
+        # Longest time without data between since and until
+        times = [since] + [arrival for arrival in self.arrivals if since <= arrival <= until] + [until]
+        return max(b - a for a, b in zip(times, times[1:]))
+
+    def close(self):
+        self._server.close()
+
+
+def run_ffmpeg(args):
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-y'] + args, check=True)
+
+
+def generate_video(path, width, height, duration, subtitle_file):
+    run_ffmpeg([
+        '-f', 'lavfi', '-i', 'testsrc2=size={}x{}:rate=24:duration={}'.format(width, height, duration),
+        '-f', 'lavfi', '-i', 'sine=frequency=440:duration={}'.format(duration),
+        '-f', 'lavfi', '-i', 'sine=frequency=880:duration={}'.format(duration),
+        '-i', subtitle_file,
+        '-map', '0', '-map', '1', '-map', '2', '-map', '3', '-map', '3',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '48',
+        '-c:a', 'aac', '-c:s', 'ass',
+        '-metadata:s:a:0', 'language=jpn', '-metadata:s:a:1', 'language=eng',
+        '-metadata:s:s:0', 'language=eng', '-metadata:s:s:0', 'title=Full',
+        '-metadata:s:s:1', 'language=eng', '-metadata:s:s:1', 'title=Signs',
+        path
+    ])
+
+
+def link(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def generate_library(library_dir, wide_files, wide_dirs, deep_levels):
+    # Returns (names of the full length videos by resolution, name of the short clip), all in /flat.
+    # Files that already exist are kept, so a library directory can be reused between runs
+    flat_dir = os.path.join(library_dir, 'flat')
+    os.makedirs(flat_dir, exist_ok=True)
+
+    subtitle_file = os.path.join(library_dir, 'subs.ass')
+    write_subtitles(subtitle_file, VIDEO_DURATION)
+
+    videos = {}
+    for width, height in RESOLUTIONS:
+        name = 'Test Pattern {}p.mkv'.format(height)
+        path = os.path.join(flat_dir, name)
+        if not os.path.exists(path):
+            print('Generating {}'.format(name))
+            generate_video(path, width, height, VIDEO_DURATION, subtitle_file)
+        videos['{}p'.format(height)] = name
+
+    clip_name = 'Short Clip.mkv'
+    clip_path = os.path.join(flat_dir, clip_name)
+    if not os.path.exists(clip_path):
+        generate_video(clip_path, *RESOLUTIONS[0], duration=CLIP_DURATION, subtitle_file=subtitle_file)
+
+    # Lots of entries in one directory
+    wide_dir = os.path.join(library_dir, 'wide')
+    os.makedirs(wide_dir, exist_ok=True)
+    for i in range(wide_dirs):
+        os.makedirs(os.path.join(wide_dir, 'Season {:03d}'.format(i)), exist_ok=True)
+    for i in range(wide_files):
+        target = os.path.join(wide_dir, 'Episode {:04d}.mkv'.format(i))
+        if not os.path.exists(target):
+            link(clip_path, target)
+
+    # A few entries in each of many nested directories
+    level_dir = os.path.join(library_dir, 'deep')
+    for level in range(deep_levels):
+        level_dir = os.path.join(level_dir, 'level_{:02d}'.format(level))
+        os.makedirs(level_dir, exist_ok=True)
+        for i in range(5):
+            target = os.path.join(level_dir, 'Part {}.mkv'.format(i))
+            if not os.path.exists(target):
+                link(clip_path, target)
+
+    return videos, clip_name
+
+
+def write_config(work_dir, font_file, library_dir, sink_url):
+    # JSON is valid YAML. Cheap encodes so the numbers reflect the bot rather than x264
+    config = {
+        'login': {'discord_client_key': None},
+        'stream': {
+            'stream_url': 'http://localhost/benchmark',
+            'rtmp_endpoint': sink_url,
+            'media_directory': library_dir,
+        },
+        'channels': {'whitelist': [CHANNEL_NAME]},
+        'ffmpeg': {
+            'font_file': font_file,
+            'relay_idle_timeout': 30,
+            'passthrough': False,
+            'encode_profile': 'benchmark',
+        },
+        'encode_profiles': {
+            'benchmark': {'preset': 'ultrafast', 'audio_codec': 'aac', 'max_height': 720},
+        },
+        'cache': {
+            'metadata_file': os.path.join(work_dir, 'cache', 'metadata.sqlite'),
+            'library_snapshot_file': os.path.join(work_dir, 'cache', 'library.pickle'),
+            'library_refresh_interval': 3600,
+            'subtitle_dir': os.path.join(work_dir, 'cache', 'subtitles'),
+        },
+        'transcode_cache': {'enabled': False},
+        'prefetch': {'enabled': False},
+    }
+    config_file = os.path.join(work_dir, 'config.yaml')
+    with open(config_file, 'w') as f:
+        json.dump(config, f, indent=2)
+    return config_file
+
+
+async def wait_until(predicate, timeout=WAIT_TIMEOUT):
+    # Returns the perf_counter() time predicate first held, polling every POLL_INTERVAL
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            raise asyncio.TimeoutError()
+        await asyncio.sleep(POLL_INTERVAL)
+    return time.perf_counter()
+
+
+class Benchmark(object):
+
+    def __init__(self, cog, bot, sink, iterations):
+        self._cog = cog
+        self._bot = bot
+        self._sink = sink
+        self._iterations = iterations
+        self._channel = FakeChannel(CHANNEL_NAME)
+
+        self.session = cog.get_sessions()[0]
+        self.player = self.session.media_player
+        self.samples = {}
+        self.failures = {}
+
+    def add_sample(self, scenario, seconds):
+        self.samples.setdefault(scenario, []).append(seconds)
+
+    async def invoke(self, name, *args, **kwargs):
+        # Calls a command handler the way discord.ext.commands would, returns how long it took
+        command = getattr(type(self._cog), name)
+        ctx = FakeContext(command, self._channel)
+        start = time.perf_counter()
+        await command.callback(self._cog, ctx, *args, **kwargs)
+        return time.perf_counter() - start
+
+    def _has_first_frame(self, old_video=None):
+        progress = self.player.get_progress()
+        return self.player.get_current_video() is not old_video and progress is not None and bool(progress.frame)
+
+    async def _stop(self):
+        if self.player.is_video_playing():
+            await self.invoke('stop_stream')
+        await wait_until(lambda: not self.player.is_video_playing() and self.session.now_playing is None)
+
+    async def run_ls(self, name, path):
+        await self.invoke('change_directory', path)
+        for _ in range(self._iterations):
+            self.session.file_explorer.invalidate_listing()
+            self.add_sample('ls_cold_' + name, await self.invoke('list_current_dir'))
+            self.add_sample('ls_warm_' + name, await self.invoke('list_current_dir'))
+
+    async def run_play_and_seek(self, name, filename):
+        await self.invoke('change_directory', '/flat')
+        for _ in range(self._iterations):
+            start = time.perf_counter()
+            await self.invoke('start_stream', file=filename)
+            self.add_sample('first_frame_' + name, await wait_until(self._has_first_frame) - start)
+            if self._sink:
+                await wait_until(lambda: self._sink.first_arrival_after(start) is not None)
+                self.add_sample('first_output_' + name, self._sink.first_arrival_after(start) - start)
+
+            for target in SEEK_TARGETS:
+                old_video = self.player.get_current_video()
+                start = time.perf_counter()
+                await self.invoke('seek_stream', str(target))
+                end = await wait_until(lambda: self._has_first_frame(old_video))
+                self.add_sample('seek_' + name, end - start)
+                if self._sink:
+                    self.add_sample('seek_gap_' + name, self._sink.max_gap(start, end))
+
+            await self._stop()
+
+    async def run_skip(self, filename):
+        await self.invoke('change_directory', '/flat')
+        for _ in range(self._iterations):
+            for _ in range(3):
+                await self.invoke('start_stream', file=filename)
+            await wait_until(self._has_first_frame)
+
+            for _ in range(2):
+                old_video = self.player.get_current_video()
+                start = time.perf_counter()
+                await self.invoke('skip_stream')
+                self.add_sample('skip', await wait_until(lambda: self._has_first_frame(old_video)) - start)
+
+            await self._stop()
+
+    async def run_transition(self, clip_name):
+        await self.invoke('change_directory', '/flat')
+        transition_stalls = self.player._relay.transition_stalls
+        for _ in range(self._iterations):
+            await self.invoke('start_stream', file=clip_name)
+            await self.invoke('start_stream', file=clip_name)
+            await wait_until(self._has_first_frame)
+
+            first_video = self.player.get_current_video()
+            stall_count = len(transition_stalls)
+            await wait_until(lambda: self._has_first_frame(first_video) and len(transition_stalls) > stall_count)
+            self.add_sample('transition_gap', transition_stalls[-1])
+
+            await self._stop()
+
+    async def run_scenario(self, name, coro):
+        print('Running {}'.format(name))
+        try:
+            await coro
+        except asyncio.TimeoutError:
+            print('{} timed out'.format(name))
+            self.failures[name] = self.failures.get(name, 0) + 1
+            await self._stop()
+
+
+def summarize(samples):
+    return {
+        'n': len(samples),
+        'p50_ms': round(perf_monitor.percentile(samples, 0.5) * 1000, 1),
+        'p99_ms': round(perf_monitor.percentile(samples, 0.99) * 1000, 1),
+        'max_ms': round(max(samples) * 1000, 1),
+    }
+
+
+def compare(results, baseline, tolerance):
+    # Scenarios whose p50 got more than tolerance (a fraction) slower than in baseline
+    regressions = []
+    for scenario, summary in results['scenarios'].items():
+        old = baseline.get('scenarios', {}).get(scenario)
+        if old and old['p50_ms'] > 0 and summary['p50_ms'] > old['p50_ms'] * (1 + tolerance):
+            regressions.append((scenario, old['p50_ms'], summary['p50_ms']))
+    return regressions
+
+
+async def run_benchmark(args, library_dir, work_dir):
+    videos, clip_name = generate_library(library_dir, args.wide_files, args.wide_dirs, args.deep_levels)
+
+    sink = None
+    if args.rtmp_url:
+        sink_url = args.rtmp_url
+    else:
+        sink = TcpSink()
+        sink_url = await sink.start()
+
+    config_file = write_config(work_dir, args.font_file, library_dir, sink_url)
+    os.chdir(work_dir)
+    import config
+    import cytube_bot
+
+    bot = FakeBot()
+    cog = cytube_bot.CytubeBot(bot, config.load_config(config_file))
+    benchmark = Benchmark(cog, bot, sink, args.iterations)
+
+    await benchmark.run_scenario('ls wide', benchmark.run_ls('wide', '/wide'))
+    deep_path = '/deep/' + '/'.join('level_{:02d}'.format(level) for level in range(args.deep_levels))
+    await benchmark.run_scenario('ls deep', benchmark.run_ls('deep', deep_path))
+    for name, filename in sorted(videos.items()):
+        await benchmark.run_scenario('play and seek ' + name, benchmark.run_play_and_seek(name, filename))
+    await benchmark.run_scenario('skip', benchmark.run_skip(videos['360p']))
+    await benchmark.run_scenario('transition', benchmark.run_transition(clip_name))
+
+    if sink:
+        sink.close()
+
+    # Let the last messages drain, anything the fake client had to rate limit shows up in the results
+    await wait_until(lambda: not cog._messages.get_pending())
+
+    lag_p50, lag_p99, lag_max = perf_monitor.monitor.get_lag_summary()
+    return {
+        'iterations': args.iterations,
+        'sink': 'rtmp' if args.rtmp_url else 'tcp',
+        'ffmpeg': subprocess.check_output(['ffmpeg', '-version']).decode('utf-8', 'replace').split('\n')[0],
+        'scenarios': {name: summarize(samples) for name, samples in sorted(benchmark.samples.items())},
+        'failures': benchmark.failures,
+        'spans': {name: summarize(list(stats.recent)) for name, stats in perf_monitor.monitor.spans.items()},
+        'messages': {'sent': len(bot.messages), 'merged': cog._messages.merged, 'dropped': cog._messages.dropped,
+                     'rate_limited': bot.rate_limited},
+        'loop_lag': {'p50_ms': round((lag_p50 or 0) * 1000, 1), 'p99_ms': round((lag_p99 or 0) * 1000, 1),
+                     'max_ms': round(lag_max * 1000, 1)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark bot command and playback latency')
+    parser.add_argument('--iterations', type=int, default=5, help='runs of each scenario')
+    parser.add_argument('--library-dir', help='where to generate (or reuse) the synthetic library')
+    parser.add_argument('--wide-files', type=int, default=2000, help='videos in the wide directory')
+    parser.add_argument('--wide-dirs', type=int, default=200, help='subdirectories in the wide directory')
+    parser.add_argument('--deep-levels', type=int, default=12, help='nesting depth of the deep directory tree')
+    parser.add_argument('--font-file', default='/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+    parser.add_argument('--rtmp-url', help='stream to this RTMP server instead of the local TCP sink')
+    parser.add_argument('--output', help='write the results to this file as JSON')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p50 slowdown against the baseline')
+    args = parser.parse_args()
+
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    else:
+        baseline = None
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        library_dir = os.path.abspath(args.library_dir) if args.library_dir else os.path.join(work_dir, 'library')
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(run_benchmark(args, library_dir, work_dir))
+        os.chdir(REPO_DIR)
+
+    print('{:<24}{:>5}{:>10}{:>10}{:>10}'.format('Scenario', 'n', 'p50 ms', 'p99 ms', 'max ms'))
+    for name, summary in results['scenarios'].items():
+        print('{:<24}{:>5}{:>10.1f}{:>10.1f}{:>10.1f}'.format(name, summary['n'], summary['p50_ms'],
+                                                              summary['p99_ms'], summary['max_ms']))
+    for name, count in results['failures'].items():
+        print('{} timed out {} time(s)'.format(name, count))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for scenario, old, new in regressions:
+            print('Regression in {}: p50 {:.1f} ms -> {:.1f} ms'.format(scenario, old, new))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
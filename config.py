@@ -0,0 +1,137 @@
+import ruamel.yaml
+
+import encode_profiles
+
+CONFIG_FILE = 'config.yaml'
+
+
+# Typed view of config.yaml, loaded once by app.py and passed to everything that needs settings.
+# Every section falls back to the same defaults the modules used when they read the file themselves, so options can
+# be left out of older config files.
+
+class StreamConfig(object):
+
+    def __init__(self, settings):
+        self.stream_url = settings['stream_url']
+        self.rtmp_endpoint = settings['rtmp_endpoint']
+        self.media_directory = settings['media_directory']
+        self.extra_outputs = [dict(output) for output in settings.get('extra_outputs') or []]
+
+
+class ChannelsConfig(object):
+
+    def __init__(self, settings):
+        self.whitelist = list(settings.get('whitelist') or [])
+        self.sessions = {name: dict(session) for name, session in (settings.get('sessions') or {}).items()}
+
+
+class CacheConfig(object):
+
+    def __init__(self, settings):
+        self.metadata_file = settings.get('metadata_file', 'cache/metadata.sqlite')
+        self.metadata_max_entries = settings.get('metadata_max_entries', 20000)
+        self.probe_workers = settings.get('probe_workers', 4)
+        self.library_snapshot_file = settings.get('library_snapshot_file', 'cache/library.pickle')
+        self.library_refresh_interval = settings.get('library_refresh_interval', 300)
+        self.subtitle_dir = settings.get('subtitle_dir', 'cache/subtitles')
+        self.subtitle_max_size_mb = settings.get('subtitle_max_size_mb', 1024)
+        self.state_file = settings.get('state_file')
+        self.checkpoint_interval = settings.get('checkpoint_interval', 5)
+        self.warm_snapshot_file = settings.get('warm_snapshot_file')
+        self.warm_snapshot_interval = settings.get('warm_snapshot_interval', 300)
+
+
+class TranscodeCacheConfig(object):
+
+    def __init__(self, settings):
+        self.enabled = settings.get('enabled', False)
+        self.directory = settings.get('directory', 'cache/transcode')
+        self.max_size_gb = settings.get('max_size_gb', 50)
+        self.segment_time = settings.get('segment_time', 4)
+        self.threads = settings.get('threads', 2)
+
+
+class PrefetchConfig(object):
+
+    def __init__(self, settings):
+        self.enabled = settings.get('enabled', False)
+        self.head_mb = settings.get('head_mb', 64)
+        self.seek_mb = settings.get('seek_mb', 32)
+        self.tail_mb = settings.get('tail_mb', 2)
+        self.mode = settings.get('mode', 'read')
+
+
+class GovernorConfig(object):
+
+    def __init__(self, settings):
+        self.enabled = settings.get('enabled', False)
+        self.ladder = list(settings.get('ladder') or [])
+        self.down_speed = settings.get('down_speed', 0.95)
+        self.down_window = settings.get('down_window', 8)
+        self.up_window = settings.get('up_window', 60)
+        self.up_max_load = settings.get('up_max_load', 0.6)
+        self.min_dwell = settings.get('min_dwell', 30)
+
+
+class SupervisorConfig(object):
+
+    def __init__(self, settings):
+        self.stall_timeout = settings.get('stall_timeout', 20)
+        self.max_retries = settings.get('max_retries', 5)
+        self.backoff_base = settings.get('backoff_base', 1.0)
+        self.backoff_max = settings.get('backoff_max', 30.0)
+        self.healthy_reset = settings.get('healthy_reset', 60)
+
+
+class FFmpegConfig(object):
+
+    def __init__(self, settings):
+        self.font_file = settings['font_file']
+        self.max_encoders = settings.get('max_encoders')
+        self.max_waiting_streams = settings.get('max_waiting_streams', 1)
+        self.relay_idle_timeout = settings.get('relay_idle_timeout', 30)
+        self.keyframe_snap_tolerance = settings.get('keyframe_snap_tolerance', 3.0)
+        self.encode_profile = settings.get('encode_profile', 'default')
+        self.passthrough = settings.get('passthrough', False)
+        self.standby_timeout = settings.get('standby_timeout', 15)
+        self.governor = GovernorConfig(settings.get('governor') or {})
+        self.supervisor = SupervisorConfig(settings.get('supervisor') or {})
+
+
+class PerfConfig(object):
+
+    def __init__(self, settings):
+        self.lag_interval = settings.get('lag_interval', 0.25)
+        self.slow_callback_threshold = settings.get('slow_callback_threshold', 0.25)
+
+
+class MessagesConfig(object):
+
+    def __init__(self, settings):
+        self.rate = settings.get('rate', 5)
+        self.per = settings.get('per', 5.0)
+        self.coalesce_window = settings.get('coalesce_window', 0.25)
+
+
+class Config(object):
+
+    def __init__(self, settings):
+        self.debug = settings.get('debug', False)
+        self.discord_client_key = (settings.get('login') or {}).get('discord_client_key')
+        self.stream = StreamConfig(settings['stream'])
+        self.channels = ChannelsConfig(settings.get('channels') or {})
+        self.cache = CacheConfig(settings.get('cache') or {})
+        self.transcode_cache = TranscodeCacheConfig(settings.get('transcode_cache') or {})
+        self.prefetch = PrefetchConfig(settings.get('prefetch') or {})
+        self.ffmpeg = FFmpegConfig(settings['ffmpeg'])
+        self.perf = PerfConfig(settings.get('perf') or {})
+        self.messages = MessagesConfig(settings.get('messages') or {})
+
+        # Profile name -> EncodeProfile
+        self.encode_profiles = encode_profiles.EncodeProfile.from_settings(
+            settings.get('encode_profiles') or {'default': {}})
+
+
+def load_config(path=CONFIG_FILE):
+    with open(path, 'r') as f:
+        return Config(ruamel.yaml.load(f.read(), ruamel.yaml.RoundTripLoader))
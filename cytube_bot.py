@@ -1,39 +1,182 @@
 import os
 import asyncio
+import time
 import collections
+import functools
 
 import discord
+import humanize
 from discord.ext import commands
 
-from utils import ask_for_int, parse_timestamp, escape_code_block, format_file_entry, format_dir_entry
+from utils import ask_for_int, parse_timestamp, escape_code_block, format_file_entry, format_dir_entry, split_pages
 import media_player
+import ffmpeg_supervisor
+import media_cache
+import message_scheduler
 import file_explorer
+import library_index
+import encoder_pool
+import perf_monitor
+import session_store
+import track_selection
+import stream_session
+import warm_cache
 
+VIDEO_EXTENSIONS = ('.mkv', '.mp4', '.avi')
 
-class CytubeBot(object):
-    def __init__(self, bot, stream_url, rtmp_endpoint, media_directory, channel_whitelist):
-        self._bot = bot
+# Characters left for the variable part of a reply (file names, paths) once its fixed text is accounted for.
+# Everything is measured on the rendered lines, so long names mean fewer entries rather than a reply Discord rejects
+MESSAGE_BUDGET = message_scheduler.MAX_MESSAGE_LENGTH - 200
+
+# Most results !find shows, fewer when their paths are long
+FIND_RESULT_LIMIT = 15
+
+# Most files !stream playall queues at once, its reply lists as many of them by name as fit in one message
+PLAYALL_LIMIT = 200
+
+# Paged !ls listings kept around, they are only valid for the directory listing version they were rendered from
+LS_PAGE_CACHE_SIZE = 128
+
+# Status message keys. Consecutive status messages are merged, and a newer seek announcement replaces an unsent one
+STATUS_QUEUE = 'queue'
+STATUS_SEEK = 'seek'
+STATUS_SKIP = 'skip'
 
-        self._stream_url = stream_url
-        self._rtmp_endpoint = rtmp_endpoint
-        self._channel_whitelist = channel_whitelist
+# Stack frames of the latest slow callback shown by !debug perf
+PERF_STACK_FRAMES = 6
 
-        self._file_explorer = file_explorer.FileExplorer(media_directory)
-        self._media_player = media_player.DiscordMediaPlayer(self._rtmp_endpoint)
 
-        self._last_ls_cache = (None, None)
+class CytubeBot(object):
+    def __init__(self, bot, config, started_at=None):
+        self._bot = bot
+        self._config = config
+
+        # Everything the bot says goes through here, keeping each channel inside its rate limit
+        self._messages = message_scheduler.MessageScheduler(bot.send_message, rate=config.messages.rate,
+                                                            per=config.messages.per,
+                                                            coalesce_window=config.messages.coalesce_window)
+
+        # Loop lag and blocking call reports for !debug perf, command handlers are timed by perf_monitor.timed_command
+        perf_monitor.monitor.start(config.perf.lag_interval, config.perf.slow_callback_threshold)
+        # Process start, for the startup to ready and startup to first command timings
+        perf_monitor.monitor.started_at = started_at
+
+        self._channel_whitelist = config.channels.whitelist
+
+        self._metadata_cache = media_cache.MediaMetadataCache(config.cache.metadata_file,
+                                                              max_entries=config.cache.metadata_max_entries,
+                                                              max_workers=config.cache.probe_workers)
+
+        # Build (or restore) the library-wide search index in the background
+        media_directory = config.stream.media_directory
+        self._media_directory = media_directory
+        self._library_index = library_index.LibraryIndex(media_directory, config.cache.library_snapshot_file,
+                                                         VIDEO_EXTENSIONS,
+                                                         refresh_interval=config.cache.library_refresh_interval)
+        self._library_index.start()
+
+        # Shared by every session, so the machine never runs more encoders than it has cores for
+        self._encoder_pool = encoder_pool.EncoderPool(config.ffmpeg.max_encoders,
+                                                      max_waiting=config.ffmpeg.max_waiting_streams)
+        self._subtitle_cache = media_player.create_subtitle_cache(config)
+        self._transcode_cache = media_player.create_transcode_cache(config, self._encoder_pool)
+        self._prefetcher = media_player.create_prefetcher(config)
+
+        # Queues and playback positions survive restarts when a state file is configured
+        state_file = config.cache.state_file
+        self._session_store = session_store.SessionStore(state_file) if state_file else None
+        self._checkpoint_interval = config.cache.checkpoint_interval
+
+        # (session name, directory, listing version) -> rendered !ls lines and their pages, least recently used first
+        self._ls_page_cache = collections.OrderedDict()
+
+        # Whitelisted channels stream through the default session unless they have a stream of their own
+        self._default_session = self._create_session('default', config.stream.stream_url,
+                                                     config.stream.rtmp_endpoint, media_directory,
+                                                     config.stream.extra_outputs)
+        self._channel_sessions = {}
+        for channel_name, session_settings in config.channels.sessions.items():
+            self._channel_sessions[channel_name] = self._create_session(
+                channel_name, session_settings['stream_url'], session_settings['rtmp_endpoint'],
+                session_settings.get('media_directory', media_directory), session_settings.get('extra_outputs'))
+
+        # Directory listings, current directories and recent probes carried over from the last run
+        self._warm_snapshot_file = config.cache.warm_snapshot_file
+        self._warm_snapshot_interval = config.cache.warm_snapshot_interval
+        self._ready = False
+        if self._warm_snapshot_file:
+            asyncio.ensure_future(self._maintain_warm_cache())
+
+    async def _maintain_warm_cache(self):
+        # Restores the snapshot on a worker thread while the bot is still logging in, then saves it now and then so
+        # a crash loses at most one interval's worth
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        snapshot = await loop.run_in_executor(None, warm_cache.load_snapshot, self._warm_snapshot_file)
+        if snapshot is not None:
+            await loop.run_in_executor(None, warm_cache.restore_snapshot, snapshot, self.get_sessions(),
+                                       self._metadata_cache)
+            print('Restored warm cache in {:.0f} ms'.format((time.perf_counter() - start) * 1000))
 
-        # Start the media queue
-        self._media_queue = collections.deque()
-        asyncio.ensure_future(self._process_media_queue())
+        while True:
+            await asyncio.sleep(self._warm_snapshot_interval)
+            try:
+                await loop.run_in_executor(None, self.save_warm_cache)
+            except Exception as e:
+                print('Failed to save warm cache: {}'.format(e))
+
+    def save_warm_cache(self):
+        # Blocking, also called by app.py once the bot has shut down
+        if not self._warm_snapshot_file:
+            return
+        snapshot = warm_cache.build_snapshot(self.get_sessions(), self._metadata_cache)
+        warm_cache.save_snapshot(self._warm_snapshot_file, snapshot)
+
+    def _create_session(self, name, stream_url, rtmp_endpoint, media_directory, extra_outputs):
+        # The main endpoint plus any mirrors, all fed from a single encoder
+        outputs = [{'url': rtmp_endpoint}] + list(extra_outputs or [])
+        player = media_player.DiscordMediaPlayer(outputs, self._config, metadata_cache=self._metadata_cache,
+                                                 subtitle_cache=self._subtitle_cache,
+                                                 transcode_cache=self._transcode_cache,
+                                                 file_prefetcher=self._prefetcher)
+
+        session = stream_session.StreamSession(name, stream_url, media_directory, player, self._encoder_pool,
+                                               on_playing=self._on_session_playing, store=self._session_store,
+                                               checkpoint_interval=self._checkpoint_interval)
+        session.start()
+        return session
+
+    def get_sessions(self):
+        return [self._default_session] + list(self._channel_sessions.values())
+
+    def _get_session(self, ctx):
+        return self._channel_sessions.get(ctx.message.channel.name, self._default_session)
+
+    def __check(self, ctx):
+        # Registered as a global check by add_cog: only whitelisted channels may use the bot (private messages are
+        # left to the commands' no_pm handling)
+        if ctx.message.server is None:
+            return True
+        return ctx.message.channel.name in self._channel_whitelist
+
+    async def _on_session_playing(self, session):
+        # The presence is per bot rather than per channel, so it shows whatever the first playing session is playing
+        for playing_session in self.get_sessions():
+            if playing_session.now_playing is not None:
+                await self.set_bot_presence(playing_session.now_playing.name, playing_session.stream_url)
+                return
+        await self.set_bot_presence()
 
-        self._backup_queue = None
+    async def _say(self, ctx, content, status=None, replace=False):
+        # Queued rather than sent right away, so commands never wait on Discord's rate limits. Ordering within the
+        # channel is kept, and ask_for_int questions go through the same queue
+        self._messages.say(ctx.message.channel, content, status=status, replace=replace)
 
-    async def set_bot_presence(self, name=None):
+    async def set_bot_presence(self, name=None, stream_url=None):
         bot_game = None
 
         if name:
-            bot_game = discord.Game(name=name, url=self._stream_url, type=1)
+            bot_game = discord.Game(name=name, url=stream_url, type=1)
 
         await self._bot.change_presence(game=bot_game, status=None, afk=False)
 
@@ -41,11 +184,26 @@ class CytubeBot(object):
         print('Logged in as {}'.format(self._bot.user.name))
         print('--------------')
 
-    async def _start_stream(self, relative_path: str):
-        await self._bot.say('Selected file: `{}`.'.format(escape_code_block(os.path.basename(relative_path))))
-        absolute_path = self._file_explorer.get_complete_path(relative_path)
+        # on_ready fires again after every reconnect, only the first one is part of startup
+        monitor = perf_monitor.monitor
+        if not self._ready and monitor.started_at is not None:
+            duration = time.perf_counter() - monitor.started_at
+            monitor.record('startup to ready', duration)
+            print('Ready {:.0f} ms after startup'.format(duration * 1000))
+        self._ready = True
+
+    async def _start_stream(self, ctx, session, absolute_path: str):
+        if not session.can_start_stream():
+            await self._say(ctx, 'All {} encoders are busy, please try again later.'.format(
+                self._encoder_pool.max_encoders))
+            return
+
+        await self._say(ctx, 'Selected file: `{}`.'.format(escape_code_block(os.path.basename(absolute_path))),
+                        status=STATUS_QUEUE)
 
-        audio_tracks, subtitle_tracks = self._media_player.get_human_readable_track_info(absolute_path)
+        # Probe runs on a worker thread (or is served from the metadata cache) so the event loop stays responsive
+        media_info = await session.media_player.get_media_info(absolute_path)
+        audio_tracks, subtitle_tracks = session.media_player.get_human_readable_track_info(media_info)
         audio_track = 1
         subtitle_track = 1 if len(subtitle_tracks) > 0 else None
 
@@ -53,217 +211,616 @@ class CytubeBot(object):
         if len(audio_tracks) > 1:
             ask_str = 'Please select an audio track:\n```{}```'.format(escape_code_block('\n'.join(audio_tracks)))
             audio_track = await ask_for_int(self._bot, ask_str, lower_bound=1,
-                                            upper_bound=len(audio_tracks) + 1, default=1)
+                                            upper_bound=len(audio_tracks) + 1, default=1,
+                                            channel=ctx.message.channel, messages=self._messages)
 
         # Ask user to select subtitle track if multiple present
         if len(subtitle_tracks) > 1:
             ask_str = 'Please select a subtitle track:\n```{}```'.format(escape_code_block('\n'.join(subtitle_tracks)))
             subtitle_track = await ask_for_int(self._bot, ask_str, lower_bound=1,
-                                               upper_bound=len(subtitle_tracks) + 1, default=1)
-
-        await self._bot.say('Added to queue (#{}).'.format(len(self._media_queue) + 1))
+                                               upper_bound=len(subtitle_tracks) + 1, default=1,
+                                               channel=ctx.message.channel, messages=self._messages)
+
+        video = media_player.Video(absolute_path, audio_track=audio_track, subtitle_track=subtitle_track,
+                                   media_info=media_info)
+        session.media_player.prepare_video(video)
+        entry = session.media_queue.append(video)
+
+        # The id is what !queue remove and !queue move go by
+        await self._say(ctx, 'Added to queue (#{}, id {}).'.format(len(session.media_queue), entry.id),
+                        status=STATUS_QUEUE)
+
+        if session.must_wait_for_encoder():
+            await self._say(ctx, 'Waiting for a free encoder ({} of {} in use).'.format(
+                self._encoder_pool.get_in_use(), self._encoder_pool.max_encoders), status=STATUS_QUEUE)
+
+    async def _ask_for_track_rule(self, ctx, session, media_infos, track_type):
+        # Ask once for the whole batch, using the first video that actually has a choice to make
+        for media_info in media_infos:
+            tracks = track_selection.get_tracks(media_info, track_type)
+            if len(tracks) < 2:
+                continue
+
+            audio_tracks, subtitle_tracks = session.media_player.get_human_readable_track_info(media_info)
+            if track_type == track_selection.AUDIO:
+                ask_str = 'Please select an audio track for all videos:\n```{}```'.format(
+                    escape_code_block('\n'.join(audio_tracks)))
+            else:
+                ask_str = 'Please select a subtitle track for all videos:\n```{}```'.format(
+                    escape_code_block('\n'.join(subtitle_tracks)))
+
+            num = await ask_for_int(self._bot, ask_str, lower_bound=1, upper_bound=len(tracks), default=1,
+                                    channel=ctx.message.channel, messages=self._messages)
+            return track_selection.TrackRule.from_track(tracks[num - 1])
+
+        return None
+
+    async def _start_stream_batch(self, ctx, session, paths):
+        if not session.can_start_stream():
+            await self._say(ctx, 'All {} encoders are busy, please try again later.'.format(
+                self._encoder_pool.max_encoders))
+            return
 
-        self._media_queue.append(
-            media_player.Video(absolute_path, audio_track=audio_track, subtitle_track=subtitle_track))
+        # All probes are submitted at once and run in the metadata cache's worker pool
+        start = time.perf_counter()
+        results = await asyncio.gather(*[session.media_player.get_media_info(path) for path in paths],
+                                       return_exceptions=True)
+        probe_time = time.perf_counter() - start
+
+        probed = []
+        for path, result in zip(paths, results):
+            if isinstance(result, Exception):
+                print('Failed to probe {}: {}'.format(path, result))
+            else:
+                probed.append((path, result))
+        if not probed:
+            await self._say(ctx, 'None of the files could be read.')
+            return
 
-    async def _process_media_queue(self):
-        while True:
-            video = None
-            while video is None:
-                try:
-                    video = self._media_queue.popleft()
-                except IndexError:
-                    await asyncio.sleep(1)
-            await self.set_bot_presence(video.name)
-            await self._media_player.play_video(video)
-            await self.set_bot_presence()
+        media_infos = [media_info for _, media_info in probed]
+        audio_rule = await self._ask_for_track_rule(ctx, session, media_infos, track_selection.AUDIO)
+        subtitle_rule = await self._ask_for_track_rule(ctx, session, media_infos, track_selection.SUBTITLES)
+
+        videos, unmatched = [], 0
+        for path, media_info in probed:
+            audio_tracks = track_selection.get_tracks(media_info, track_selection.AUDIO)
+            subtitle_tracks = track_selection.get_tracks(media_info, track_selection.SUBTITLES)
+
+            # Same defaults as a single !stream play when there is no rule or nothing matches it
+            audio_track = audio_rule.choose(audio_tracks) if audio_rule else None
+            subtitle_track = subtitle_rule.choose(subtitle_tracks) if subtitle_rule else None
+            if (audio_rule and audio_track is None and audio_tracks) or \
+                    (subtitle_rule and subtitle_track is None and subtitle_tracks):
+                unmatched += 1
+
+            videos.append(media_player.Video(path, audio_track=audio_track or 1,
+                                             subtitle_track=subtitle_track or (1 if subtitle_tracks else None),
+                                             media_info=media_info))
+
+        first_num = len(session.media_queue) + 1
+        for video in videos:
+            session.media_player.prepare_video(video)
+        session.media_queue.extend(videos)
+
+        summary = 'Added {} videos to the queue (#{}-#{}), probed in {:.1f} s.'.format(
+            len(videos), first_num, first_num + len(videos) - 1, probe_time)
+        if audio_rule:
+            summary += '\nAudio: {}'.format(escape_code_block(audio_rule.describe()))
+        if subtitle_rule:
+            summary += '\nSubtitles: {}'.format(escape_code_block(subtitle_rule.describe()))
+        if unmatched:
+            summary += '\n{} videos had no matching track and use their first track instead.'.format(unmatched)
+        if len(probed) < len(paths):
+            summary += '\n{} files could not be read and were skipped.'.format(len(paths) - len(probed))
+
+        names = [format_dir_entry(i + first_num, first_num + len(videos), video) for i, video in enumerate(videos)]
+        _, shown = split_pages(names, MESSAGE_BUDGET - len(summary))[0]
+        if shown < len(names):
+            names = names[:shown] + ['... and {} more'.format(len(names) - shown)]
+        await self._say(ctx, '{}\n```c\n{}```'.format(summary, '\n'.join(names)))
+
+        if session.must_wait_for_encoder():
+            await self._say(ctx, 'Waiting for a free encoder ({} of {} in use).'.format(
+                self._encoder_pool.get_in_use(), self._encoder_pool.max_encoders), status=STATUS_QUEUE)
 
     @commands.group(name='stream', pass_context=True, no_pm=True)
     async def stream(self, ctx):
         if ctx.invoked_subcommand is None:
-            await self._bot.say('Invalid stream command passed.')
+            await self._say(ctx, 'Invalid stream command passed.')
 
-    @stream.command(name='play', no_pm=True)
-    async def start_stream(self, *, file: str):
+    @stream.command(name='play', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def start_stream(self, ctx, *, file: str):
+        session = self._get_session(ctx)
         try:
             num = int(file)
-            _, files = self._last_ls_cache
+            _, files = session.last_ls_cache
 
             if files is None:
-                _, files = self.get_sorted_files_and_dirs()
+                _, files = await self.get_sorted_files_and_dirs(session)
 
             if num < 1 or num > len(files):
-                await self._bot.say('Invalid option.')
+                await self._say(ctx, 'Invalid option.')
                 return
 
-            file = files[num - 1].name
+            # Entries may come from !ls or !find, so always go by their absolute path
+            absolute_path = files[num - 1].path
         except ValueError:
-            pass
+            absolute_path = session.file_explorer.get_complete_path(file)
 
-        if not self._file_explorer.file_exists(file):
-            await self._bot.say('File does not exist.')
+        if not session.file_explorer.file_exists(absolute_path, relative=False):
+            await self._say(ctx, 'File does not exist.')
             return
 
-        await self._start_stream(file)
+        await self._start_stream(ctx, session, absolute_path)
 
-    @stream.command(name='skip', no_pm=True)
-    async def skip_stream(self):
-        if not self._media_player.is_video_playing():
-            await self._bot.say('Stream not currently playing.')
+    @stream.command(name='playall', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def start_stream_batch(self, ctx, *, target: str = None):
+        # Queues every video in a directory (the current one by default) or matching a glob pattern
+        session = self._get_session(ctx)
+        loop = asyncio.get_event_loop()
+        paths = await loop.run_in_executor(None, functools.partial(session.file_explorer.resolve_files, target,
+                                                                   extensions=VIDEO_EXTENSIONS))
+
+        if not paths:
+            await self._say(ctx, 'No videos found.')
+            return
+        if len(paths) > PLAYALL_LIMIT:
+            await self._say(ctx, 'That matches {} videos, please narrow it down to at most {}.'.format(
+                len(paths), PLAYALL_LIMIT))
             return
-        await self._bot.say('Skipping current video.')
-        await self._media_player.stop_video()
 
-    @stream.command(name='pause', no_pm=True)
-    async def pause_stream(self):
-        if not self._media_player.is_video_playing():
-            await self._bot.say('Stream not currently playing.')
+        await self._start_stream_batch(ctx, session, paths)
+
+    @stream.command(name='skip', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def skip_stream(self, ctx):
+        session = self._get_session(ctx)
+        if not session.media_player.is_video_playing():
+            await self._say(ctx, 'Stream not currently playing.')
+            return
+        await self._say(ctx, 'Skipping current video.', status=STATUS_SKIP)
+        latency = await session.skip()
+        if latency is not None:
+            await self._say(ctx, 'Switched in {:.0f} ms.'.format(latency * 1000), status=STATUS_SKIP)
+
+    @stream.command(name='pause', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def pause_stream(self, ctx):
+        session = self._get_session(ctx)
+        if not session.media_player.is_video_playing():
+            await self._say(ctx, 'Stream not currently playing.')
             return
 
-        self._backup_queue = collections.deque()
-        self._backup_queue.extend(self._media_queue)
-        self._media_queue.clear()
+        # Hands the whole queue over without copying it
+        backup_queue = session.media_queue.detach()
 
-        video = self._media_player.get_current_video()
-        video.seek_time, _ = self._media_player.get_video_time()
-        self._backup_queue.appendleft(video)
+        video = session.media_player.get_current_video()
+        video.seek_time, _ = session.media_player.get_video_time()
+        backup_queue.appendleft(video)
+        session.backup_queue = backup_queue
 
-        await self._media_player.stop_video()
-        await self.set_bot_presence()
-        await self._bot.say('Stream paused at {}.'.format(self._media_player.convert_secs_to_str(video.seek_time)))
+        await session.media_player.stop_video()
+        await self._say(ctx, 'Stream paused at {}.'.format(
+            session.media_player.convert_secs_to_str(video.seek_time)))
 
-    @stream.command(name='resume', no_pm=True)
-    async def resume_stream(self):
-        if self._backup_queue is None:
-            await self._bot.say('Stream not currently paused.')
+    @stream.command(name='resume', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def resume_stream(self, ctx):
+        session = self._get_session(ctx)
+        if session.backup_queue is None:
+            await self._say(ctx, 'Stream not currently paused.')
             return
 
-        self._media_queue.extend(self._backup_queue)
-        self._backup_queue = None
-        await self._bot.say('Resuming stream.')
+        session.media_queue.attach(session.backup_queue)
+        session.backup_queue = None
+        await self._say(ctx, 'Resuming stream.')
 
-    @stream.command(name='stop', no_pm=True)
-    async def stop_stream(self):
-        if not self._media_player.is_video_playing():
-            await self._bot.say('Stream not currently playing.')
+    @stream.command(name='stop', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def stop_stream(self, ctx):
+        session = self._get_session(ctx)
+        if not session.media_player.is_video_playing():
+            await self._say(ctx, 'Stream not currently playing.')
             return
 
-        self._media_queue.clear()
+        session.media_queue.clear()
 
-        _, current_time, _ = await self._media_player.stop_video()
-        await self.set_bot_presence()
+        _, current_time, _ = await session.media_player.stop_video()
         if current_time:
-            await self._bot.say('Stream stopped at {}.'.format(self._media_player.convert_secs_to_str(current_time)))
+            await self._say(ctx, 'Stream stopped at {}.'.format(
+                session.media_player.convert_secs_to_str(current_time)))
         else:
-            await self._bot.say('Stream stopped.')
+            await self._say(ctx, 'Stream stopped.')
+
+    @stream.command(name='stats', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def stream_stats(self, ctx):
+        session = self._get_session(ctx)
+        if not session.media_player.is_video_playing():
+            await self._say(ctx, 'Stream not currently playing.')
+            return
 
-    async def _seek_stream(self, time):
-        if not self._media_player.is_video_playing():
-            await self._bot.say('Stream not currently playing.')
+        progress = session.media_player.get_progress()
+        if progress is None:
+            await self._say(ctx, 'No progress reported by FFmpeg yet.')
             return
 
-        await self._bot.say('Restarting stream at {}.'.format(self._media_player.convert_secs_to_str(time)))
-        video = self._media_player.get_current_video()
-        video.seek_time = time
-        self._media_queue.appendleft(video)
-        await self._media_player.stop_video()
+        current, total = session.media_player.get_video_time()
+        supervisor = session.media_player.get_supervisor()
+        stall_count, stall_mean, stall_max = supervisor.get_stall_summary()
+        stats = [
+            ('Position', '{} / {}'.format(session.media_player.convert_secs_to_str(current),
+                                          session.media_player.convert_secs_to_str(total) if total else '?')),
+            ('Speed', '{:.2f}x'.format(progress.speed) if progress.speed is not None else 'N/A'),
+            ('FPS', '{:.1f}'.format(progress.fps) if progress.fps is not None else 'N/A'),
+            ('Bitrate', '{:.0f} kbit/s'.format(progress.bitrate) if progress.bitrate is not None else 'N/A'),
+            ('Frames', '{} ({} dup, {} drop)'.format(progress.frame, progress.dup_frames, progress.drop_frames)),
+            ('Sent', humanize.naturalsize(progress.total_size) if progress.total_size is not None else 'N/A'),
+            ('Restarts', '{} ({} exit, {} stall, {} given up)'.format(
+                sum(supervisor.restarts.values()), supervisor.restarts[ffmpeg_supervisor.REASON_EXIT],
+                supervisor.restarts[ffmpeg_supervisor.REASON_STALL], supervisor.gave_up)),
+            ('Stalls', '{} (avg {:.1f} s, max {:.1f} s)'.format(stall_count, stall_mean, stall_max)
+                if stall_count else 'None'),
+        ]
+
+        switch_latencies = session.media_player.switch_latencies
+        if switch_latencies:
+            stats.append(('Switches', '{} (avg {:.0f} ms, max {:.0f} ms)'.format(
+                len(switch_latencies), sum(switch_latencies) / len(switch_latencies) * 1000,
+                max(switch_latencies) * 1000)))
+
+        file_prefetcher = session.media_player.get_prefetcher()
+        if file_prefetcher:
+            throughput = file_prefetcher.get_throughput()
+            stats.append(('Prefetch', '{} hit, {} late, {} miss, {} read{}'.format(
+                file_prefetcher.hits, file_prefetcher.late, file_prefetcher.misses,
+                humanize.naturalsize(file_prefetcher.bytes_prefetched),
+                ' at {}/s'.format(humanize.naturalsize(throughput)) if throughput else '')))
+
+        await self._say(ctx, '```{}```'.format('\n'.join('{:<10}{}'.format(name + ':', value) for name, value in stats)))
+
+    async def _seek_stream(self, ctx, session, time):
+        if not session.media_player.is_video_playing():
+            await self._say(ctx, 'Stream not currently playing.')
+            return
 
-    @stream.command(name='seek', no_pm=True)
-    async def seek_stream(self, timestamp: str):
+        video = session.media_player.get_current_video()
+        # Snap to a nearby keyframe when the index allows it, and tell the user where playback will actually land
+        seek_time = await session.media_player.find_seek_point(video, time)
+        session.media_player.prefetch_video(video, seek_time)
+        # A newer seek makes any unsent announcement of an older one pointless
+        if abs(seek_time - time) >= 0.01:
+            await self._say(ctx, 'Restarting stream at {} (requested {}).'.format(
+                media_player.DiscordMediaPlayer.convert_secs_to_str(seek_time),
+                media_player.DiscordMediaPlayer.convert_secs_to_str(time)), status=STATUS_SEEK, replace=True)
+        else:
+            await self._say(ctx, 'Restarting stream at {}.'.format(
+                media_player.DiscordMediaPlayer.convert_secs_to_str(seek_time)), status=STATUS_SEEK, replace=True)
+        latency = await session.seek(video, seek_time)
+        if latency is not None:
+            await self._say(ctx, 'Switched in {:.0f} ms.'.format(latency * 1000), status=STATUS_SEEK)
+
+    @stream.command(name='seek', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def seek_stream(self, ctx, timestamp: str):
+        session = self._get_session(ctx)
         time = parse_timestamp(timestamp)
         if time:
-            await self._seek_stream(time)
+            await self._seek_stream(ctx, session, time)
         else:
-            await self._bot.say('Invalid parameter.')
+            await self._say(ctx, 'Invalid parameter.')
 
-    @stream.command(name='ff', no_pm=True)
-    async def ff_stream(self, length: str):
+    @stream.command(name='ff', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def ff_stream(self, ctx, length: str):
+        session = self._get_session(ctx)
         time = parse_timestamp(length)
         if time:
-            current, _ = self._media_player.get_video_time()
-            await self._seek_stream(current + time)
+            current, _ = session.media_player.get_video_time()
+            await self._seek_stream(ctx, session, current + time)
         else:
-            await self._bot.say('Invalid parameter.')
+            await self._say(ctx, 'Invalid parameter.')
 
-    @stream.command(name='rew', no_pm=True)
-    async def rew_stream(self, length: str):
+    @stream.command(name='rew', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def rew_stream(self, ctx, length: str):
+        session = self._get_session(ctx)
         time = parse_timestamp(length)
         if time:
-            current, _ = self._media_player.get_video_time()
+            current, _ = session.media_player.get_video_time()
 
             if current + time < 0:
                 current = time
 
-            await self._seek_stream(current - time)
+            await self._seek_stream(ctx, session, current - time)
         else:
-            await self._bot.say('Invalid parameter.')
+            await self._say(ctx, 'Invalid parameter.')
 
-    @commands.command(name='ls', no_pm=True)
-    async def list_current_dir(self):
-        output_str = ('```diff\n'
-                      '=== Contents of {path} ===\n'
-                      '```{dirs}{files}')
+    @commands.group(name='queue', pass_context=True, no_pm=True)
+    async def queue(self, ctx):
+        if ctx.invoked_subcommand is None:
+            await self._say(ctx, 'Invalid queue command passed.')
+
+    @queue.command(name='list', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def list_queue(self, ctx, page: int = 1):
+        session = self._get_session(ctx)
+        media_queue = session.media_queue
+
+        paused_str = ''
+        if session.backup_queue is not None:
+            paused_str = '\nPaused with {} videos held back, `!stream resume` puts them back.'.format(
+                len(session.backup_queue))
+        if not len(media_queue):
+            await self._say(ctx, 'The queue is empty.' + paused_str)
+            return
+
+        now_playing_str = ''
+        if session.now_playing is not None:
+            now_playing_str = 'Now playing: `{}`\n'.format(escape_code_block(session.now_playing.name))
+
+        # Pages are cut by rendered length, so long names make for shorter pages
+        lines = ['{pad}{num}) [{id}] {name}'.format(
+            num=i + 1, pad=(len(str(len(media_queue))) - len(str(i + 1))) * ' ', id=entry.id,
+            name=escape_code_block(entry.video.name)) for i, entry in enumerate(media_queue.entries())]
+        pages = split_pages(lines, MESSAGE_BUDGET - len(now_playing_str) - len(paused_str))
+        page_count = len(pages)
+        if page < 1 or page > page_count:
+            await self._say(ctx, 'Invalid page, the queue has {} page{}.'.format(
+                page_count, 's' if page_count != 1 else ''))
+            return
+
+        start, end = pages[page - 1]
+        entry_str = '\n'.join(lines[start:end])
+
+        page_str = ''
+        if page_count > 1:
+            page_str = '\nPage {} of {}, use `!queue list <page>`.'.format(page, page_count)
+
+        await self._say(ctx, '{}```diff\n'
+                             '=== Queue ({} videos) ===\n'
+                             '``````c\n{}```{}{}'.format(now_playing_str, len(media_queue), entry_str, page_str,
+                                                        paused_str))
+
+    @queue.command(name='remove', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def remove_from_queue(self, ctx, entry_id: int):
+        session = self._get_session(ctx)
+        video = session.media_queue.remove(entry_id)
+        if video is None:
+            await self._say(ctx, 'No queued video with id {}.'.format(entry_id))
+            return
+        await self._say(ctx, 'Removed `{}` from the queue.'.format(escape_code_block(video.name)))
+
+    @queue.command(name='move', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def move_in_queue(self, ctx, entry_id: int, position: int):
+        session = self._get_session(ctx)
+        if not session.media_queue.move(entry_id, position):
+            await self._say(ctx, 'No queued video with id {}.'.format(entry_id))
+            return
 
-        dirs, files = self.get_sorted_files_and_dirs()
+        video = session.media_queue.get_entry(entry_id).video
+        await self._say(ctx, 'Moved `{}` to position {}.'.format(
+            escape_code_block(video.name), max(1, min(position, len(session.media_queue)))))
+
+    @queue.command(name='clear', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def clear_queue(self, ctx):
+        # Leaves the video that is playing alone, !stream stop stops that as well
+        session = self._get_session(ctx)
+        count = len(session.media_queue)
+        session.media_queue.clear()
+        await self._say(ctx, 'Cleared {} video{} from the queue.'.format(count, 's' if count != 1 else ''))
+
+    @commands.command(name='ls', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def list_current_dir(self, ctx, page: str = None):
+        # Directories come first, then files. Entries keep the numbers they have in the whole listing, so !ezcd and
+        # !stream play work the same whichever page they were picked from
+        session = self._get_session(ctx)
+        listing = await self._get_listing(session)
+        dirs, files = session.last_ls_cache
+        path = session.file_explorer.get_current_path()
+
+        # Pages are cut by rendered length, so the listing is formatted and paged once per version of it
+        key = (session.name, listing.path, listing.version)
+        layout = self._ls_page_cache.get(key)
+        if layout is None:
+            layout = self._layout_ls(path, dirs, files)
+            self._ls_page_cache[key] = layout
+            while len(self._ls_page_cache) > LS_PAGE_CACHE_SIZE:
+                self._ls_page_cache.popitem(last=False)
+        else:
+            self._ls_page_cache.move_to_end(key)
+        lines, pages = layout
+        page_count = len(pages)
+
+        last_path, last_page = session.ls_page
+        if last_path != listing.path:
+            last_page = 1
+
+        if page is None:
+            page_num = 1
+        elif page.lower() == 'next':
+            page_num = last_page + 1
+        elif page.lower() == 'prev':
+            page_num = last_page - 1
+        else:
+            try:
+                page_num = int(page)
+            except ValueError:
+                page_num = None
+
+        if page_num is None or page_num < 1 or page_num > page_count:
+            await self._say(ctx, 'Invalid page, this directory has {} page{}.'.format(
+                page_count, 's' if page_count != 1 else ''))
+            return
 
-        dir_str = '\n'.join([format_dir_entry(i + 1, len(dirs), dir) for i, dir in enumerate(dirs)])
+        session.ls_page = (listing.path, page_num)
+        await self._say(ctx, self._render_ls_page(path, lines, len(dirs), pages[page_num - 1], page_num,
+                                                  page_count))
+
+    @staticmethod
+    def _layout_ls(path, dirs, files):
+        # Every entry's line, and the (start, end) line ranges of the pages they are split into
+        lines = [format_dir_entry(i + 1, len(dirs), dir) for i, dir in enumerate(dirs)]
+        lines.extend(format_file_entry(i + 1, len(files), entry) for i, entry in enumerate(files))
+        return lines, split_pages(lines, MESSAGE_BUDGET - len(path))
+
+    @staticmethod
+    def _render_ls_page(path, lines, dir_count, page, page_num, page_count):
+        start, end = page
+        dir_str = '\n'.join(lines[start:min(end, dir_count)])
         if len(dir_str) > 0:
             dir_str = '```c\n' + dir_str + '```'
 
-        files = self._file_explorer.get_files_in_current_dir(extensions=['.mkv', '.mp4', '.avi'])
-        files.sort(key=lambda x: x.name)
-
-        file_str = '\n'.join([format_file_entry(i + 1, len(files), entry) for i, entry in enumerate(files)])
+        file_str = '\n'.join(lines[max(start, dir_count):end])
         if len(file_str) > 0:
             file_str = '```c\n' + file_str + '```'
 
-        await self._bot.say(output_str.format(
-            path=self._file_explorer.get_current_path(),
-            dirs=dir_str,
-            files=file_str
-        ))
+        page_str = ''
+        if page_count > 1:
+            page_str = 'Page {} of {}, use `!ls next`, `!ls prev` or `!ls <page>`.'.format(page_num, page_count)
+
+        return ('```diff\n'
+                '=== Contents of {path} ===\n'
+                '```{dirs}{files}{page}').format(path=path, dirs=dir_str, files=file_str, page=page_str)
 
-        self._last_ls_cache = (dirs, files)
+    async def _get_listing(self, session):
+        # Listings come back already sorted and are cached per directory, so this is one stat when nothing changed
+        listing = await session.file_explorer.get_current_listing()
 
-    def get_sorted_files_and_dirs(self):
-        dirs = self._file_explorer.get_dirs_in_current_dir()
-        dirs.sort(key=lambda x: x.name)
+        session.last_ls_cache = (listing.get_dirs(), listing.get_files(extensions=VIDEO_EXTENSIONS))
+        return listing
 
-        files = self._file_explorer.get_files_in_current_dir(extensions=['.mkv', '.mp4', '.avi'])
-        files.sort(key=lambda x: x.name)
+    async def get_sorted_files_and_dirs(self, session):
+        await self._get_listing(session)
+        return session.last_ls_cache
 
-        self._last_ls_cache = (dirs, files)
-        return self._last_ls_cache
+    @commands.command(name='find', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def find_files(self, ctx, *, query: str):
+        session = self._get_session(ctx)
+        if not self._library_index.is_ready():
+            await self._say(ctx, 'Library index is still being built, try again shortly.')
+            return
 
-    async def _change_directory(self, path: str):
+        # Broad queries can still take a while on a big library, so they never hold up the event loop
+        loop = asyncio.get_event_loop()
+        paths = await loop.run_in_executor(None, functools.partial(self._library_index.search, query,
+                                                                   limit=FIND_RESULT_LIMIT))
+        if paths is None:
+            await self._say(ctx, 'Search query is too short.')
+            return
+        if not paths:
+            await self._say(ctx, 'No files found.')
+            return
+
+        files = [file_explorer.CachedDirEntry('/' + path, session.file_explorer.build_absolute_path(path),
+                                              False, True, False) for path in paths]
+        lines = [format_dir_entry(i + 1, len(files), entry) for i, entry in enumerate(files)]
+
+        # Only as many results as fit in one message, numbered the same way !stream play picks them
+        query_str = escape_code_block(query)
+        _, end = split_pages(lines, MESSAGE_BUDGET - len(query_str))[0]
+        files = files[:end]
+        await self._say(ctx, '```diff\n'
+                            '=== Results for {query} ===\n'
+                            '``````c\n{results}```'.format(query=query_str, results='\n'.join(lines[:end])))
+
+        # Results can be played by number with !stream play, just like the files from the last !ls
+        dirs, _ = session.last_ls_cache
+        session.last_ls_cache = (dirs, files)
+
+    async def _change_directory(self, ctx, session, path: str):
+        # realpath/exists can be slow on network mounts, so resolve the new directory off the event loop
+        loop = asyncio.get_event_loop()
         if path[0] == '/':
-            path = self._file_explorer.build_absolute_path(path[1:])
-            res = self._file_explorer.change_directory(path, relative=False)
+            path = session.file_explorer.build_absolute_path(path[1:])
+            res = await loop.run_in_executor(None, functools.partial(session.file_explorer.change_directory, path,
+                                                                     relative=False))
         else:
-            res = self._file_explorer.change_directory(path)
+            res = await loop.run_in_executor(None, session.file_explorer.change_directory, path)
 
-        self._last_ls_cache = (None, None)
+        session.last_ls_cache = (None, None)
 
         if res:
-            send_str = 'Changed directory to `{}`'.format(escape_code_block(self._file_explorer.get_current_path()))
+            send_str = 'Changed directory to `{}`'.format(
+                escape_code_block(session.file_explorer.get_current_path()))
         else:
             send_str = 'Failed to change directory.'
 
-        await self._bot.say(send_str)
+        await self._say(ctx, send_str)
 
-    @commands.command(name='cd', no_pm=True)
-    async def change_directory(self, path: str):
-        await self._change_directory(path)
+    @commands.command(name='cd', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def change_directory(self, ctx, path: str):
+        session = self._get_session(ctx)
+        await self._change_directory(ctx, session, path)
 
-    @commands.command(name='ezcd', no_pm=True)
-    async def change_directory_ez(self, num: int):
-        dirs, _ = self._last_ls_cache
+    @commands.command(name='ezcd', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def change_directory_ez(self, ctx, num: int):
+        session = self._get_session(ctx)
+        dirs, _ = session.last_ls_cache
 
         if dirs is None:
-            dirs, _ = self.get_sorted_files_and_dirs()
+            dirs, _ = await self.get_sorted_files_and_dirs(session)
 
         if num < 1 or num > len(dirs):
-            await self._bot.say('Invalid option.')
+            await self._say(ctx, 'Invalid option.')
             return
 
-        await self._change_directory(dirs[num - 1].name)
+        await self._change_directory(ctx, session, dirs[num - 1].name)
+
+    @commands.group(name='debug', pass_context=True, no_pm=True)
+    async def debug(self, ctx):
+        if ctx.invoked_subcommand is None:
+            await self._say(ctx, 'Invalid debug command passed.')
+
+    @debug.command(name='perf', no_pm=True, pass_context=True)
+    @perf_monitor.timed_command
+    async def debug_perf(self, ctx):
+        monitor = perf_monitor.monitor
+        lines = []
+
+        lag_p50, lag_p99, lag_max = monitor.get_lag_summary()
+        if lag_p50 is not None:
+            lines.append('Loop lag: p50 {:.1f} ms, p99 {:.1f} ms, max {:.0f} ms (sampled every {:.0f} ms)'.format(
+                lag_p50 * 1000, lag_p99 * 1000, lag_max * 1000, monitor.interval * 1000))
+            lower = 0
+            for bound, count in zip(perf_monitor.LAG_BUCKETS + (None,), monitor.lag_histogram):
+                label = '{}-{} ms'.format(lower, bound) if bound is not None else '>{} ms'.format(lower)
+                lines.append('  {:<12}{}'.format(label, count))
+                lower = bound
+
+        lines.append('Messages: {} sent, {} merged, {} dropped, {} pending, throttled for {:.1f} s'.format(
+            self._messages.sent, self._messages.merged, self._messages.dropped, self._messages.get_pending(),
+            self._messages.throttled_time))
+
+        if monitor.spans:
+            lines.append('{:<24}{:>7}{:>10}{:>10}{:>10}'.format('Span', 'Count', 'p50 ms', 'p95 ms', 'Max ms'))
+            for name, stats in monitor.spans.items():
+                lines.append('{:<24}{:>7}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+                    name[:23], stats.count, perf_monitor.percentile(stats.recent, 0.5) * 1000,
+                    perf_monitor.percentile(stats.recent, 0.95) * 1000, stats.max * 1000))
+
+        slow_callbacks = monitor.get_slow_callbacks()
+        lines.append('Slow callbacks: {} (over {:.0f} ms)'.format(monitor.slow_callback_count,
+                                                                 monitor.slow_threshold * 1000))
+        if slow_callbacks:
+            last = slow_callbacks[-1]
+            lines.append('  Latest {} ago{}:'.format(
+                humanize.naturaldelta(time.time() - last.detected_at),
+                ', blocked {:.0f} ms'.format(last.duration * 1000) if last.duration is not None else ''))
+            for frame in last.stack[-PERF_STACK_FRAMES:]:
+                lines.extend('  ' + line for line in frame.rstrip().split('\n'))
+
+        # Stay under Discord's message limit, the stack is the first thing to go
+        output = escape_code_block('\n'.join(lines))
+        if len(output) > 1990:
+            output = output[:1986] + '\n...'
+        await self._say(ctx, '```{}```'.format(output))
@@ -0,0 +1,149 @@
+import re
+
+# How play_video should handle a source
+MODE_ENCODE = 'encode'
+MODE_COPY_VIDEO = 'copy_video'
+MODE_COPY = 'copy'
+
+BITRATE_REGEX = re.compile(r'^(?P<value>[\d.]+)(?P<unit>[kKmM]?)$')
+
+
+def parse_bitrate(bitrate):
+    # '4500k' -> 4500000, plain numbers are bits per second
+    match = BITRATE_REGEX.match(str(bitrate))
+    if not match:
+        raise ValueError('Invalid bitrate: {}'.format(bitrate))
+    multiplier = {'': 1, 'k': 1000, 'm': 1000000}[match.group('unit').lower()]
+    return int(float(match.group('value')) * multiplier)
+
+
+def _get_int(track, key):
+    try:
+        return int(str(track.get(key)).split(' / ')[0])
+    except (TypeError, ValueError):
+        return None
+
+
+class EncodeProfile(object):
+    DEFAULTS = {
+        'video_codec': 'libx264',
+        'preset': 'veryfast',
+        'maxrate': '4500k',
+        'bufsize': '1125k',
+        'pix_fmt': 'yuv420p',
+        'gop': 24,
+        'audio_codec': 'libfdk_aac',
+        'audio_bitrate': '128k',
+        'audio_channels': 2,
+        'audio_sample_rate': 44100,
+        # Target output height: taller sources are downscaled before subtitles and the overlay are drawn
+        # (None keeps the source resolution)
+        'max_height': None,
+        'scale_flags': 'bicubic',
+        # Number of threads for the filter graph (None lets FFmpeg decide)
+        'filter_threads': None,
+    }
+
+    def __init__(self, name, **options):
+        self.name = name
+
+        settings = dict(self.DEFAULTS)
+        settings.update(options)
+        for key, value in settings.items():
+            setattr(self, key, value)
+
+    @classmethod
+    def from_settings(cls, profiles_settings):
+        # Build every profile in the encode_profiles config section, keyed by name
+        return {name: cls(name, **dict(options or {})) for name, options in profiles_settings.items()}
+
+    def get_global_params(self):
+        if self.filter_threads:
+            return ['-filter_threads', str(self.filter_threads)]
+        return []
+
+    def get_video_params(self, stream_index=None):
+        # With a stream_index, the options only apply to that output video stream (for multi-variant encodes)
+        if stream_index is not None:
+            spec = ':v:{}'.format(stream_index)
+            return ['-c' + spec, self.video_codec, '-preset' + spec, self.preset, '-maxrate' + spec,
+                    str(self.maxrate), '-bufsize' + spec, str(self.bufsize), '-pix_fmt' + spec, self.pix_fmt,
+                    '-g' + spec, str(self.gop)]
+
+        return [
+            # Encode using the profile's x264 preset (veryfast is decent performance/quality for realtime streaming)
+            '-vcodec', self.video_codec,
+            '-preset', self.preset,
+
+            # Cap the bitrate, a small buffer (0.25 sec at the defaults) makes for faster stream startup
+            '-maxrate', str(self.maxrate),
+            '-bufsize', str(self.bufsize),
+
+            # Use YUV color space, 4:2:0 chroma subsampling, 8-bit render depth
+            '-pix_fmt', self.pix_fmt,
+
+            # Set keyframe interval
+            # (RTMP clients need to wait for the next keyframe, so at 24 this is a 1 second startup time)
+            '-g', str(self.gop),
+        ]
+
+    def get_audio_params(self, stream_index=None):
+        if stream_index is not None:
+            spec = ':a:{}'.format(stream_index)
+            return ['-c' + spec, self.audio_codec, '-b' + spec, str(self.audio_bitrate), '-ac' + spec,
+                    str(self.audio_channels), '-ar' + spec, str(self.audio_sample_rate)]
+
+        return [
+            # AAC-LC stereo at 44.1KHz by default
+            '-c:a', self.audio_codec,
+            '-ab', str(self.audio_bitrate),
+            '-ac', str(self.audio_channels),
+            '-ar', str(self.audio_sample_rate),
+        ]
+
+    def is_video_compatible(self, media_info):
+        # H.264 8-bit 4:2:0 that already fits under the profile's maxrate and resolution can be sent as-is
+        tracks = media_info['tracks']
+        video_tracks = [t for t in tracks if t.get('track_type') == 'Video']
+        if not video_tracks:
+            return False
+        video = video_tracks[0]
+
+        if video.get('format') != 'AVC':
+            return False
+        if video.get('chroma_subsampling') not in ('4:2:0', None) or _get_int(video, 'bit_depth') not in (8, None):
+            return False
+
+        height = _get_int(video, 'height')
+        if self.max_height and (height is None or height > self.max_height):
+            return False
+
+        bit_rate = _get_int(video, 'maximum_bit_rate') or _get_int(video, 'bit_rate')
+        if bit_rate is None:
+            general = [t for t in tracks if t.get('track_type') == 'General']
+            bit_rate = _get_int(general[0], 'overall_bit_rate') if general else None
+        return bit_rate is not None and bit_rate <= parse_bitrate(self.maxrate)
+
+    def is_audio_compatible(self, media_info, audio_track):
+        audio_tracks = [t for t in media_info['tracks'] if t.get('track_type') == 'Audio']
+        if audio_track < 1 or audio_track > len(audio_tracks):
+            return False
+        audio = audio_tracks[audio_track - 1]
+
+        # Encoded videos go through the same persistent FLV connection, and players keep the first audio config they
+        # see, so copied audio has to match what an encode would output exactly
+        channels = _get_int(audio, 'channel_s')
+        sample_rate = _get_int(audio, 'sampling_rate')
+        return (audio.get('format') == 'AAC' and channels == int(self.audio_channels) and
+                sample_rate == int(self.audio_sample_rate))
+
+    def choose_mode(self, video, passthrough=False):
+        # Anything rendered into the picture (subtitles, the timestamp overlay) needs a full encode, so passthrough
+        # trades the timestamp overlay for a fraction of the CPU on sources that don't need subtitles burned in
+        if not passthrough or video.media_info is None or video.subtitle_track:
+            return MODE_ENCODE
+        if not self.is_video_compatible(video.media_info):
+            return MODE_ENCODE
+        if self.is_audio_compatible(video.media_info, video.audio_track):
+            return MODE_COPY
+        return MODE_COPY_VIDEO
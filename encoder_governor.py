@@ -0,0 +1,79 @@
+import os
+import time
+
+
+# Picks an encode profile from a ladder (best quality first) based on how well the encoder keeps up.
+# With -re FFmpeg never runs faster than 1.0x, so falling behind shows up as speed dropping below realtime, while
+# headroom has to be judged from the host load instead. Stepping down needs a sustained slowdown and stepping up
+# needs a much longer stretch of healthy speed and spare CPU, plus a minimum dwell time, so the level doesn't flap.
+class EncoderGovernor(object):
+
+    def __init__(self, ladder, down_speed=0.95, down_window=8, up_window=60, up_max_load=0.6, min_dwell=30,
+                 warmup=5):
+        self._ladder = list(ladder)
+        self._down_speed = down_speed
+        self._down_window = down_window
+        self._up_window = up_window
+        self._up_max_load = up_max_load
+        self._min_dwell = min_dwell
+        self._warmup = warmup
+
+        self._level = 0
+        self._last_change = None
+        self._started_at = None
+        self._slow_since = None
+        self._healthy_since = None
+
+        self.changes = []
+
+    def get_profile_name(self):
+        return self._ladder[self._level]
+
+    def start(self):
+        # Called for every new FFmpeg, since speed readings are meaningless while it spins up
+        self._started_at = time.perf_counter()
+        self._slow_since = None
+        self._healthy_since = None
+
+    @staticmethod
+    def _get_load_per_cpu():
+        try:
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+        except OSError:
+            return None
+
+    def _change_level(self, level, now, reason):
+        old_name = self.get_profile_name()
+        self._level = level
+        self._last_change = now
+        self.changes.append((time.time(), old_name, self.get_profile_name(), reason))
+        print('Encoder governor: {} -> {} ({})'.format(old_name, self.get_profile_name(), reason))
+        return self.get_profile_name()
+
+    def observe(self, progress):
+        # Feed a progress record, returns the new profile name if FFmpeg should be restarted with it
+        now = progress.received_at
+        if progress.speed is None or self._started_at is None or now - self._started_at < self._warmup:
+            return None
+
+        if progress.speed < self._down_speed:
+            self._healthy_since = None
+            if self._slow_since is None:
+                self._slow_since = now
+            elif now - self._slow_since >= self._down_window and self._level < len(self._ladder) - 1:
+                return self._change_level(self._level + 1, now, 'speed {:.2f}x'.format(progress.speed))
+            return None
+
+        self._slow_since = None
+
+        load = self._get_load_per_cpu()
+        if progress.speed < 0.99 or load is None or load > self._up_max_load:
+            self._healthy_since = None
+            return None
+
+        if self._healthy_since is None:
+            self._healthy_since = now
+        elif now - self._healthy_since >= self._up_window and self._level > 0 and \
+                (self._last_change is None or now - self._last_change >= self._min_dwell):
+            return self._change_level(self._level - 1, now, 'load {:.2f} per CPU'.format(load))
+        return None
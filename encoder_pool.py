@@ -0,0 +1,134 @@
+import asyncio
+import collections
+import os
+
+
+# Caps the number of FFmpeg encoders running across every stream session in the process.
+# A session holds its slots (one per encoder its player runs) from the moment its queue starts playing until the
+# queue runs dry, so seeks and transitions between videos never lose their place. Sessions that don't fit wait in
+# FIFO order, and can_admit() lets commands refuse new streams once max_waiting sessions are already waiting.
+# Background work (pre-transcoding) takes a slot with acquire_background(), only when nothing else is waiting, and is
+# asked to give it back through its on_preempt callback as soon as a stream has to wait for one.
+class EncoderPool(object):
+
+    def __init__(self, max_encoders=None, max_waiting=1):
+        self.max_encoders = max_encoders or os.cpu_count() or 1
+        self._max_waiting = max_waiting
+
+        self._in_use = 0
+        self._holders = {}
+        self._waiters = collections.deque()
+
+        # Background owner -> on_preempt callback, and background owners waiting for a slot
+        self._background = {}
+        self._background_waiters = collections.deque()
+
+    def get_in_use(self):
+        return self._in_use
+
+    def get_waiting(self):
+        return len(self._waiters)
+
+    def is_holding(self, owner):
+        return owner in self._holders
+
+    def _get_weight(self, weight):
+        # Anything bigger than the whole pool would never be scheduled, let it run alone instead
+        return max(1, min(weight, self.max_encoders))
+
+    def _fits(self, weight):
+        return self._in_use + self._get_weight(weight) <= self.max_encoders
+
+    def can_acquire_now(self, weight=1):
+        return not self._waiters and self._fits(weight)
+
+    def can_admit(self, owner, weight=1):
+        # Whether a new stream for owner would either start right away or be allowed to wait for a slot
+        if owner in self._holders or any(waiter == owner for waiter, _, _ in self._waiters):
+            return True
+        if self.can_acquire_now(weight):
+            return True
+        return len(self._waiters) < self._max_waiting
+
+    def try_acquire(self, owner, weight=1):
+        # Takes slots for owner only if they are free right now, never waits. Returns whether owner holds them
+        if owner in self._holders:
+            return True
+        if not self.can_acquire_now(weight):
+            return False
+        self._grant(owner, weight)
+        return True
+
+    async def acquire(self, owner, weight=1):
+        if owner in self._holders:
+            return
+
+        # Strict FIFO, a small stream can't jump ahead of a big one that is already waiting
+        if self.can_acquire_now(weight):
+            self._grant(owner, weight)
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.append((owner, weight, future))
+        print('Waiting for {} encoder slot(s), {}/{} in use'.format(weight, self._in_use, self.max_encoders))
+        self._preempt_background()
+        try:
+            await future
+        except asyncio.CancelledError:
+            self._waiters = collections.deque(w for w in self._waiters if w[2] is not future)
+            if owner in self._holders:
+                self.release(owner)
+            raise
+
+    async def acquire_background(self, owner, on_preempt):
+        # One slot for background work, granted only while no stream is waiting. on_preempt() is called when a stream
+        # needs the slot, after which the owner should stop and release() it
+        if owner in self._holders:
+            return
+
+        if not self._waiters and not self._background_waiters and self._fits(1):
+            self._grant(owner, 1)
+            self._background[owner] = on_preempt
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        self._background_waiters.append((owner, on_preempt, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            self._background_waiters = collections.deque(w for w in self._background_waiters if w[2] is not future)
+            if owner in self._holders:
+                self.release(owner)
+            raise
+
+    def _preempt_background(self):
+        for on_preempt in list(self._background.values()):
+            on_preempt()
+
+    def _grant(self, owner, weight):
+        weight = self._get_weight(weight)
+        self._holders[owner] = weight
+        self._in_use += weight
+
+    def release(self, owner):
+        weight = self._holders.pop(owner, None)
+        self._background.pop(owner, None)
+        if weight is None:
+            return
+        self._in_use -= weight
+
+        while self._waiters and self._fits(self._waiters[0][1]):
+            waiter, waiter_weight, future = self._waiters.popleft()
+            if future.cancelled():
+                continue
+            self._grant(waiter, waiter_weight)
+            future.set_result(None)
+
+        # Background work only gets whatever is left once every stream has its slots
+        while not self._waiters and self._background_waiters and self._fits(1):
+            waiter, on_preempt, future = self._background_waiters.popleft()
+            if future.cancelled():
+                continue
+            self._grant(waiter, 1)
+            self._background[waiter] = on_preempt
+            future.set_result(None)
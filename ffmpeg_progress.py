@@ -0,0 +1,82 @@
+import re
+import time
+
+PROGRESS_LINE_REGEX = re.compile(r'^(?P<key>[a-z_0-9]+)=(?P<value>.*)$')
+
+
+def _parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class FFmpegProgress(object):
+    # One block of FFmpeg's machine readable -progress output
+    __slots__ = ('frame', 'fps', 'bitrate', 'total_size', 'out_time', 'dup_frames', 'drop_frames', 'speed',
+                 'finished', 'received_at')
+
+    def __init__(self, frame=None, fps=None, bitrate=None, total_size=None, out_time=None, dup_frames=None,
+                 drop_frames=None, speed=None, finished=False, received_at=None):
+        self.frame = frame
+        self.fps = fps
+        # kbit/s
+        self.bitrate = bitrate
+        # bytes
+        self.total_size = total_size
+        # seconds of output produced, relative to where this FFmpeg started
+        self.out_time = out_time
+        self.dup_frames = dup_frames
+        self.drop_frames = drop_frames
+        # encoding speed as a multiple of realtime
+        self.speed = speed
+        self.finished = finished
+        self.received_at = received_at
+
+    @classmethod
+    def from_fields(cls, fields):
+        # out_time_ms is actually in microseconds, and newer FFmpeg versions also provide out_time_us
+        out_time_us = _parse_int(fields.get('out_time_us', fields.get('out_time_ms')))
+
+        return cls(
+            frame=_parse_int(fields.get('frame')),
+            fps=_parse_float(fields.get('fps')),
+            bitrate=_parse_float(fields.get('bitrate', '').replace('kbits/s', '')),
+            total_size=_parse_int(fields.get('total_size')),
+            out_time=out_time_us / 1000000 if out_time_us is not None and out_time_us >= 0 else None,
+            dup_frames=_parse_int(fields.get('dup_frames')),
+            drop_frames=_parse_int(fields.get('drop_frames')),
+            speed=_parse_float(fields.get('speed', '').rstrip('x')),
+            finished=fields.get('progress') == 'end',
+            received_at=time.perf_counter(),
+        )
+
+
+class ProgressParser(object):
+    # Collects key=value lines from -progress output, yielding a record at the end of each block
+
+    def __init__(self):
+        self._fields = {}
+
+    @staticmethod
+    def match(line):
+        return PROGRESS_LINE_REGEX.match(line)
+
+    def feed(self, match):
+        key, value = match.group('key', 'value')
+        self._fields[key] = value.strip()
+
+        # Every block ends with progress=continue (or progress=end for the last one)
+        if key != 'progress':
+            return None
+
+        progress = FFmpegProgress.from_fields(self._fields)
+        self._fields = {}
+        return progress
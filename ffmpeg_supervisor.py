@@ -0,0 +1,65 @@
+import collections
+import time
+
+# Why an FFmpeg had to be restarted
+REASON_EXIT = 'exit'
+REASON_STALL = 'stall'
+
+
+# Decides whether a failed FFmpeg should be restarted and when, and keeps the numbers for !stream stats.
+# An FFmpeg counts as stalled when its output position hasn't moved for stall_timeout seconds (including hangs where
+# it stops writing progress altogether). Failures are retried from the last known position with exponential backoff,
+# up to max_retries times in a row; an FFmpeg that then streams fine for healthy_reset seconds earns the full budget
+# back, so a couple of hiccups spread over a long movie never use it up.
+class FFmpegSupervisor(object):
+
+    def __init__(self, stall_timeout=20, max_retries=5, backoff_base=1.0, backoff_max=30.0, healthy_reset=60):
+        self.stall_timeout = stall_timeout
+        self._max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._healthy_reset = healthy_reset
+
+        self._attempt = 0
+
+        self.restarts = collections.Counter()
+        self.gave_up = 0
+        # Seconds without progress before each detected stall was acted on
+        self.stall_durations = collections.deque(maxlen=100)
+        # (wall clock time, reason, media position) of recent restarts
+        self.history = collections.deque(maxlen=20)
+
+    def start_video(self):
+        self._attempt = 0
+
+    def is_stalled(self, last_advance, now=None):
+        if now is None:
+            now = time.perf_counter()
+        return now - last_advance >= self.stall_timeout
+
+    def record_stall(self, duration):
+        self.stall_durations.append(duration)
+        print('FFmpeg stalled, no progress for {:.1f} s'.format(duration))
+
+    def next_retry(self, reason, position, healthy_time=0.0):
+        # Returns the delay before restarting, or None if the retry budget is used up
+        if healthy_time >= self._healthy_reset:
+            self._attempt = 0
+
+        if self._attempt >= self._max_retries:
+            self.gave_up += 1
+            print('FFmpeg failed {} times in a row, giving up'.format(self._attempt))
+            return None
+
+        delay = min(self._backoff_max, self._backoff_base * 2 ** self._attempt)
+        self._attempt += 1
+        self.restarts[reason] += 1
+        self.history.append((time.time(), reason, position))
+        return delay
+
+    def get_stall_summary(self):
+        # (count, mean, max) of the recorded stall durations
+        if not self.stall_durations:
+            return 0, None, None
+        return (len(self.stall_durations), sum(self.stall_durations) / len(self.stall_durations),
+                max(self.stall_durations))
@@ -1,4 +1,8 @@
+import asyncio
+import collections
+import glob
 import os
+import threading
 
 PROJECT_ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -39,15 +43,74 @@ class PseudoDirEntry:
         return self._stat[follow_symlinks]
 
 
+class CachedDirEntry(object):
+    # Snapshot of an os.DirEntry taken at scan time, so listings can be reused without touching the filesystem again
+    __slots__ = ('name', 'path', '_is_dir', '_is_file', '_is_symlink', '_stat')
+
+    def __init__(self, name, path, is_dir, is_file, is_symlink, stat=None):
+        self.name = name
+        self.path = path
+        self._is_dir = is_dir
+        self._is_file = is_file
+        self._is_symlink = is_symlink
+        self._stat = stat
+
+    @classmethod
+    def from_dir_entry(cls, entry):
+        is_file = entry.is_file()
+        # Files need their size when listed, so grab it now while the scan is already hitting the disk
+        return cls(entry.name, entry.path, entry.is_dir(), is_file, entry.is_symlink(),
+                   entry.stat() if is_file else None)
+
+    def is_dir(self, *, follow_symlinks=True):
+        return self._is_dir
+
+    def is_file(self, *, follow_symlinks=True):
+        return self._is_file
+
+    def is_symlink(self):
+        return self._is_symlink
+
+    def stat(self, *, follow_symlinks=True):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+class DirectoryListing(object):
+    def __init__(self, path, mtime_ns, version, dirs, files):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        # Increases every time any directory is rescanned, so anything derived from a listing can tell it is stale
+        self.version = version
+        self._dirs = dirs
+        self._files = files
+
+    def get_dirs(self, hidden=False):
+        return [entry for entry in self._dirs if hidden or entry.name == '..' or entry.name[0] != '.']
+
+    def get_files(self, hidden=False, extensions=None):
+        return [entry for entry in self._files
+                if (hidden or entry.name[0] != '.') and
+                (extensions is None or os.path.splitext(entry.name)[1] in extensions)]
+
+
 class FileExplorer(object):
-    def __init__(self, root_path=None):
+    def __init__(self, root_path=None, max_cached_dirs=256):
         self._root_path = os.path.realpath(root_path) if root_path else PROJECT_ROOT_DIR
+        self._real_root_path = os.path.realpath(self._root_path)
         self._current_path = self._root_path
 
+        # Scanned directories keyed by absolute path, revalidated against the directory mtime and evicted LRU
+        self._dir_cache = collections.OrderedDict()
+        self._dir_cache_lock = threading.Lock()
+        self._max_cached_dirs = max_cached_dirs
+        self._listing_version = 0
+
     def is_safe_path(self, path, follow_symlinks=True):
         # resolves symbolic links
         if follow_symlinks:
-            return os.path.realpath(path).startswith(os.path.realpath(self._root_path))
+            return os.path.realpath(path).startswith(self._real_root_path)
 
         return os.path.abspath(path).startswith(self._root_path)
 
@@ -63,22 +126,91 @@ class FileExplorer(object):
     def build_absolute_path(self, offset_abs_path):
         return os.path.join(self._root_path, offset_abs_path)
 
+    def _scan_directory(self, path, mtime_ns):
+        dirs, files = [], []
+        for dir_entry in os.scandir(path):
+            entry = CachedDirEntry.from_dir_entry(dir_entry)
+            # Only symlinks can escape the root, anything else inside a safe directory is safe as well
+            if entry.is_symlink() and not self.is_safe_path(entry.path):
+                continue
+            if entry.is_dir():
+                dirs.append(entry)
+            elif entry.is_file():
+                files.append(entry)
+
+        parent_path = os.path.join(path, '..')
+        if self.is_safe_path(parent_path):
+            dirs.append(CachedDirEntry('..', parent_path, True, False, False))
+
+        dirs.sort(key=lambda x: x.name)
+        files.sort(key=lambda x: x.name)
+
+        with self._dir_cache_lock:
+            self._listing_version += 1
+            version = self._listing_version
+
+        return DirectoryListing(path, mtime_ns, version, dirs, files)
+
+    def get_listing(self, path=None):
+        # Blocking: costs a single stat of the directory when cached, or a full scan when the directory has changed
+        path = path or self._current_path
+        mtime_ns = os.stat(path).st_mtime_ns
+
+        with self._dir_cache_lock:
+            listing = self._dir_cache.get(path)
+            if listing is not None and listing.mtime_ns == mtime_ns:
+                self._dir_cache.move_to_end(path)
+                return listing
+
+        listing = self._scan_directory(path, mtime_ns)
+
+        with self._dir_cache_lock:
+            self._dir_cache[path] = listing
+            self._dir_cache.move_to_end(path)
+            while len(self._dir_cache) > self._max_cached_dirs:
+                self._dir_cache.popitem(last=False)
+
+        return listing
+
+    async def get_current_listing(self):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.get_listing, self._current_path)
+
+    def invalidate_listing(self, path=None):
+        with self._dir_cache_lock:
+            if path is None:
+                self._dir_cache.clear()
+            else:
+                self._dir_cache.pop(path, None)
+
+    def get_warm_state(self):
+        # Current directory and cached listings, least recently used first, for the warm start snapshot
+        with self._dir_cache_lock:
+            return self._current_path, list(self._dir_cache.values())
+
+    def restore_warm_state(self, current_path, listings):
+        # Blocking: listings are still revalidated against the directory mtime when they are used, this only saves
+        # the scans of directories that haven't changed
+        with self._dir_cache_lock:
+            # Anything already scanned since startup is newer, restored listings go behind it in LRU order
+            for listing in reversed(listings):
+                if listing.path in self._dir_cache or not self.is_safe_path(listing.path):
+                    continue
+                self._dir_cache[listing.path] = listing
+                self._dir_cache.move_to_end(listing.path, last=False)
+                self._listing_version = max(self._listing_version, listing.version)
+            while len(self._dir_cache) > self._max_cached_dirs:
+                self._dir_cache.popitem(last=False)
+
+        # Someone may have changed directory already while the snapshot was loading, which takes precedence
+        if self._current_path == self._root_path and os.path.isdir(current_path):
+            self.change_directory(current_path, relative=False)
+
     def get_files_in_current_dir(self, hidden=False, extensions=None):
-        files = []
-        for entry in os.scandir(self._current_path):
-            if self.is_safe_path(entry.path) and entry.is_file() and (hidden or entry.name[0] != '.'):
-                if extensions is None or os.path.splitext(entry.name)[1] in extensions:
-                    files.append(entry)
-        return files
+        return self.get_listing().get_files(hidden=hidden, extensions=extensions)
 
     def get_dirs_in_current_dir(self, hidden=False):
-        dirs = []
-        for entry in os.scandir(self._current_path):
-            if self.is_safe_path(entry.path) and entry.is_dir() and (hidden or entry.name[0] != '.'):
-                dirs.append(entry)
-        if self.is_safe_path(self.get_complete_path('..')):
-            dirs.append(PseudoDirEntry('..', self._current_path))
-        return dirs
+        return self.get_listing().get_dirs(hidden=hidden)
 
     def change_directory(self, path, relative=True):
         if relative:
@@ -95,6 +227,30 @@ class FileExplorer(object):
     def change_to_root_dir(self):
         return self.change_directory(self._root_path, relative=False)
 
+    def resolve_files(self, pattern=None, extensions=None):
+        # Blocking: files in the directory named by pattern, or matched by pattern when it is a glob, sorted by name.
+        # Relative to the current directory, or to the root when it starts with /. Directories matched by a glob
+        # contribute the files directly inside them
+        base_path = self._current_path
+        if pattern and pattern.startswith('/'):
+            base_path, pattern = self._root_path, pattern.lstrip('/')
+
+        if pattern and glob.has_magic(pattern):
+            matches = sorted(glob.glob(os.path.join(glob.escape(base_path), pattern)))
+        else:
+            matches = [os.path.normpath(os.path.join(base_path, pattern or ''))]
+
+        files = []
+        for match in matches:
+            if not self.is_safe_path(match):
+                continue
+            if os.path.isdir(match):
+                files.extend(entry.path for entry in self.get_listing(match).get_files(extensions=extensions))
+            elif os.path.isfile(match) and (extensions is None or os.path.splitext(match)[1] in extensions):
+                files.append(match)
+
+        return files
+
     def get_complete_path(self, relative_path):
         complete_path = os.path.join(self._current_path, relative_path)
         return complete_path
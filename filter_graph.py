@@ -0,0 +1,58 @@
+# Builds the -vf chain used for realtime encodes.
+# Kept free of config and Discord imports so the benchmark scripts can build the exact same graphs.
+
+# Timestamp overlay size when drawn at source resolution
+DEFAULT_FONT_SIZE = 24
+
+
+def get_output_height(source_height, max_height):
+    if max_height and source_height and source_height > max_height:
+        return max_height
+    return source_height
+
+
+def get_font_size(source_height, output_height):
+    # Drawing after the downscale, shrink the font by the same factor so the overlay looks as it did before
+    if not source_height or not output_height:
+        return DEFAULT_FONT_SIZE
+    return max(10, int(round(DEFAULT_FONT_SIZE * output_height / source_height)))
+
+
+def build_video_filters(seek_time, font_file, subtitles_filter=None, source_height=None, max_height=None,
+                        scale_flags='bicubic', scale_first=True):
+    # subtitles_filter is a complete subtitles=... filter, or None when no subtitles are burned in.
+    # With scale_first, the frame is downscaled before anything is rendered onto it, so subtitles and the
+    # timestamp are drawn at output resolution rather than at (possibly 4K) source resolution
+    filters = []
+
+    # Change frame timestamps so that they are correct when starting at seek_time
+    # (subtitles and the timestamp overlay both rely on these)
+    filters.append('setpts=PTS+{}/TB'.format(seek_time))
+
+    scale_filter = None
+    output_height = source_height
+    if max_height:
+        output_height = get_output_height(source_height, max_height)
+        if source_height:
+            if output_height != source_height:
+                scale_filter = 'scale=-2:{}:flags={}'.format(output_height, scale_flags)
+        else:
+            # Source height unknown, let FFmpeg work it out
+            scale_filter = 'scale=-2:\'min(ih,{})\':flags={}'.format(max_height, scale_flags)
+
+    if scale_filter and scale_first:
+        filters.append(scale_filter)
+
+    if subtitles_filter:
+        filters.append(subtitles_filter)
+
+    # Draw timestamp for current frame in the video to make seeking easier
+    font_size = get_font_size(source_height, output_height) if scale_first else DEFAULT_FONT_SIZE
+    filters.append('drawtext=\'fontfile={}: fontcolor=white: x=0: y=h-line_h-5: fontsize={}: boxcolor=black@0.5: '
+                   'box=1: text=%{{pts\\:hms}}\''.format(font_file, font_size))
+
+    if scale_filter and not scale_first:
+        filters.append(scale_filter)
+
+    filters.append('setpts=PTS-STARTPTS')
+    return ','.join(filters)
@@ -0,0 +1,335 @@
+import array
+import asyncio
+import itertools
+import os
+import pickle
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Bump this whenever the snapshot layout changes so old snapshots are rebuilt instead of loaded
+SNAPSHOT_VERSION = 3
+
+NORMALIZE_REGEX = re.compile(r'[\W_]+')
+
+
+def normalize(name):
+    return NORMALIZE_REGEX.sub(' ', name.lower()).strip()
+
+
+def get_trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def normalize_path(path):
+    # (normalized path, normalized file name), kept next to each path so queries never have to normalize
+    return normalize(path), normalize(os.path.basename(path))
+
+
+def _scan_dir(root_path, rel_dir, extensions):
+    # List a single directory, returning (mtime_ns, matching file names, subdirectory names)
+    abs_dir = os.path.join(root_path, rel_dir)
+    files, subdirs = [], []
+    for entry in os.scandir(abs_dir):
+        if entry.name[0] == '.':
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.name)
+        elif entry.is_file() and os.path.splitext(entry.name)[1] in extensions:
+            files.append(entry.name)
+    return os.stat(abs_dir).st_mtime_ns, files, subdirs
+
+
+def _walk_subtree(root_path, rel_top, extensions):
+    # Runs in a worker process during the initial build, so it must stay a picklable module-level function
+    files, dir_mtimes = [], {}
+    pending = [rel_top]
+    while pending:
+        rel_dir = pending.pop()
+        try:
+            mtime_ns, names, subdirs = _scan_dir(root_path, rel_dir, extensions)
+        except OSError:
+            continue
+        dir_mtimes[rel_dir] = mtime_ns
+        files.extend(os.path.join(rel_dir, name) for name in names)
+        pending.extend(os.path.join(rel_dir, name) for name in subdirs)
+    return files, dir_mtimes
+
+
+# In-memory trigram index over every media file under the library root.
+# Paths are stored relative to the root and identified by an integer ID. Each trigram of a normalized path (with a
+# space in front, so the start of every word has trigrams of its own) maps to a sorted array of IDs, so a query only
+# has to walk the shortest posting list of its trigrams and verify each path on it.
+# Deleted paths are tombstoned and the postings are compacted once enough of them pile up.
+# A query examines and scores a bounded number of paths: when it matches more than that, the results are the best of
+# the first matches in path order rather than of all of them.
+class LibraryIndex(object):
+
+    def __init__(self, root_path, snapshot_file, extensions, refresh_interval=300, max_workers=None):
+        self._root_path = os.path.realpath(root_path)
+        self._snapshot_file = snapshot_file
+        self._extensions = tuple(extensions)
+        self._refresh_interval = refresh_interval
+        self._max_workers = max_workers
+
+        self._lock = threading.Lock()
+        self._paths = []
+        # Path ID -> normalize_path(path), None for deleted paths
+        self._normalized = []
+        self._path_ids = {}
+        self._postings = {}
+        self._dir_mtimes = {}
+        self._num_deleted = 0
+
+        self._ready = False
+
+    def is_ready(self):
+        return self._ready
+
+    def __len__(self):
+        return len(self._path_ids)
+
+    def start(self):
+        asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+
+        start = time.perf_counter()
+        loaded = await loop.run_in_executor(None, self._load_snapshot)
+        if loaded:
+            self._ready = True
+            print('Loaded library index snapshot ({} files) in {:.2f} s'.format(len(self), time.perf_counter() - start))
+            # Catch anything that changed while we weren't running
+            await loop.run_in_executor(None, self._refresh)
+        else:
+            await self._build()
+            self._ready = True
+            print('Built library index ({} files) in {:.2f} s'.format(len(self), time.perf_counter() - start))
+            await loop.run_in_executor(None, self._save_snapshot)
+
+        while True:
+            await asyncio.sleep(self._refresh_interval)
+            try:
+                await loop.run_in_executor(None, self._refresh)
+            except OSError as e:
+                print('Library index refresh failed: {}'.format(e))
+
+    async def _build(self):
+        loop = asyncio.get_event_loop()
+
+        # Scan the root ourselves, then hand each top level subtree to a separate worker process
+        _, root_files, top_dirs = await loop.run_in_executor(None, _scan_dir, self._root_path, '', self._extensions)
+
+        pool = ProcessPoolExecutor(max_workers=self._max_workers)
+        try:
+            results = await asyncio.gather(*[
+                loop.run_in_executor(pool, _walk_subtree, self._root_path, top_dir, self._extensions)
+                for top_dir in top_dirs
+            ])
+        finally:
+            pool.shutdown(wait=False)
+
+        files = list(root_files)
+        dir_mtimes = {}
+        for subtree_files, subtree_mtimes in results:
+            files.extend(subtree_files)
+            dir_mtimes.update(subtree_mtimes)
+        dir_mtimes[''] = os.stat(self._root_path).st_mtime_ns
+
+        await loop.run_in_executor(None, self._replace_contents, files, dir_mtimes)
+
+    def _replace_contents(self, files, dir_mtimes):
+        paths, normalized, path_ids, postings = [], [], {}, {}
+        for path in sorted(files):
+            path_id = len(paths)
+            paths.append(path)
+            normalized.append(normalize_path(path))
+            path_ids[path] = path_id
+            for trigram in get_trigrams(' ' + normalized[path_id][0]):
+                posting = postings.get(trigram)
+                if posting is None:
+                    posting = postings[trigram] = array.array('I')
+                posting.append(path_id)
+
+        with self._lock:
+            self._paths = paths
+            self._normalized = normalized
+            self._path_ids = path_ids
+            self._postings = postings
+            self._dir_mtimes = dict(dir_mtimes)
+            self._num_deleted = 0
+
+    def _add_path(self, path):
+        # Caller holds the lock. New IDs are always the largest so far, which keeps every posting list sorted
+        path_id = len(self._paths)
+        self._paths.append(path)
+        self._normalized.append(normalize_path(path))
+        self._path_ids[path] = path_id
+        for trigram in get_trigrams(' ' + self._normalized[path_id][0]):
+            posting = self._postings.get(trigram)
+            if posting is None:
+                posting = self._postings[trigram] = array.array('I')
+            posting.append(path_id)
+
+    def _remove_path(self, path):
+        # Caller holds the lock
+        path_id = self._path_ids.pop(path, None)
+        if path_id is not None:
+            self._paths[path_id] = None
+            self._normalized[path_id] = None
+            self._num_deleted += 1
+
+    def _refresh(self):
+        # Only directories whose mtime changed are rescanned; adding or removing a file always bumps its parent's mtime.
+        # Refreshes never overlap, so everything up to applying the changes can run without holding the lock
+        known_dirs = dict(self._dir_mtimes)
+
+        changed_dirs, removed_dirs = {}, []
+        for rel_dir, mtime_ns in known_dirs.items():
+            try:
+                if os.stat(os.path.join(self._root_path, rel_dir)).st_mtime_ns != mtime_ns:
+                    changed_dirs[rel_dir] = _scan_dir(self._root_path, rel_dir, self._extensions)
+            except OSError:
+                removed_dirs.append(rel_dir)
+
+        if not changed_dirs and not removed_dirs:
+            return
+
+        added_files, new_dir_mtimes = [], {}
+        for rel_dir, (mtime_ns, names, subdirs) in changed_dirs.items():
+            new_dir_mtimes[rel_dir] = mtime_ns
+            added_files.extend(os.path.join(rel_dir, name) for name in names)
+            for name in subdirs:
+                rel_subdir = os.path.join(rel_dir, name)
+                if rel_subdir not in known_dirs:
+                    subtree_files, subtree_mtimes = _walk_subtree(self._root_path, rel_subdir, self._extensions)
+                    added_files.extend(subtree_files)
+                    new_dir_mtimes.update(subtree_mtimes)
+
+        # Every file directly inside a changed or removed directory is dropped, then whatever still exists is re-added
+        stale_dirs = set(changed_dirs) | set(removed_dirs)
+        stale_files = [path for path in list(self._path_ids) if os.path.dirname(path) in stale_dirs]
+
+        with self._lock:
+            for rel_dir in removed_dirs:
+                self._dir_mtimes.pop(rel_dir, None)
+            for path in stale_files:
+                self._remove_path(path)
+            for path in added_files:
+                self._add_path(path)
+            self._dir_mtimes.update(new_dir_mtimes)
+
+            needs_compaction = self._num_deleted > len(self._paths) // 4
+
+        if needs_compaction:
+            self._compact()
+
+        print('Library index refreshed: {} changed and {} removed directories'.format(
+            len(changed_dirs), len(removed_dirs)))
+        self._save_snapshot()
+
+    def _compact(self):
+        with self._lock:
+            files = list(self._path_ids)
+            dir_mtimes = dict(self._dir_mtimes)
+        self._replace_contents(files, dir_mtimes)
+
+    def _load_snapshot(self):
+        try:
+            with open(self._snapshot_file, 'rb') as f:
+                snapshot = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return False
+
+        if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('root_path') != self._root_path or \
+                tuple(snapshot.get('extensions', ())) != self._extensions:
+            return False
+
+        paths = snapshot['paths']
+        with self._lock:
+            self._paths = paths
+            self._normalized = snapshot['normalized']
+            self._path_ids = {path: i for i, path in enumerate(paths) if path is not None}
+            self._postings = snapshot['postings']
+            self._dir_mtimes = snapshot['dir_mtimes']
+            self._num_deleted = len(paths) - len(self._path_ids)
+        return True
+
+    def _save_snapshot(self):
+        with self._lock:
+            snapshot = {
+                'version': SNAPSHOT_VERSION,
+                'root_path': self._root_path,
+                'extensions': self._extensions,
+                'paths': list(self._paths),
+                'normalized': list(self._normalized),
+                'postings': {trigram: array.array('I', posting) for trigram, posting in self._postings.items()},
+                'dir_mtimes': dict(self._dir_mtimes),
+            }
+
+        os.makedirs(os.path.dirname(os.path.abspath(self._snapshot_file)), exist_ok=True)
+        tmp_file = self._snapshot_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self._snapshot_file)
+
+    @staticmethod
+    def _score(normalized_path, basename, tokens):
+        # Lower is better: whole words beat the start of a word, which beats a match anywhere. Matches in the file name
+        # itself get a bonus, and shorter paths win ties
+        padded_path = ' ' + normalized_path + ' '
+        score = len(normalized_path)
+        for token in tokens:
+            if (' ' + token + ' ') in padded_path:
+                score -= 1000
+            elif (' ' + token) in padded_path:
+                score -= 500
+            if token in basename:
+                score -= 200
+        return score
+
+    def _collect(self, trigrams, tokens, word_start, scores, max_candidates, max_examined):
+        # Caller holds the lock. Scores the paths containing every token (at the start of a word with word_start) into
+        # scores, walking the shortest posting list of trigrams. Every token being in the stored normalized path
+        # implies every trigram is too, so the other posting lists only have to exist
+        postings = [self._postings.get(trigram) for trigram in trigrams]
+        if not postings or not all(postings):
+            return
+
+        needles = [' ' + token for token in tokens] if word_start else tokens
+        for path_id in itertools.islice(min(postings, key=len), max_examined):
+            if len(scores) >= max_candidates:
+                return
+            normalized = self._normalized[path_id]
+            if normalized is None or path_id in scores:
+                continue
+            normalized_path, basename = normalized
+            text = ' ' + normalized_path
+            if all(needle in text for needle in needles):
+                scores[path_id] = self._score(normalized_path, basename, tokens)
+
+    def search(self, query, limit=10, max_candidates=1000, max_examined=50000):
+        # Blocking: returns None if the query is too short to use the index, otherwise a ranked list of root-relative
+        # paths.
+        # Paths where every token starts a word are looked for first: their trigrams include the space before each
+        # token, which narrows down short tokens like "77" that have no trigrams of their own. Paths that only
+        # contain the tokens somewhere fill up the results when there aren't enough of those. Each pass examines at
+        # most max_examined paths, in path order, and at most max_candidates are scored in total
+        tokens = normalize(query).split()
+        trigrams, word_trigrams = set(), set()
+        for token in tokens:
+            trigrams |= get_trigrams(token)
+            word_trigrams |= get_trigrams(' ' + token)
+        if not word_trigrams:
+            return None
+
+        scores = {}
+        with self._lock:
+            self._collect(word_trigrams, tokens, True, scores, max_candidates, max_examined)
+            if len(scores) < limit and trigrams:
+                self._collect(trigrams, tokens, False, scores, max_candidates, max_examined)
+            results = sorted((score, self._paths[path_id]) for path_id, score in scores.items())
+
+        return [path for _, path in results[:limit]]
@@ -0,0 +1,251 @@
+import array
+import asyncio
+import collections
+import json
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Bump this whenever the shape of the stored probe data changes so stale rows get re-probed
+PROBE_VERSION = 1
+
+# Most recently used probe results kept in memory and in the warm start snapshot
+RECENT_PROBES = 256
+
+
+# Persistent cache of MediaInfo probe results, keyed by path, size and mtime.
+# Entries live in SQLite so they survive restarts, and the least recently used rows are evicted past max_entries.
+# All filesystem and database access happens on worker threads so the event loop never blocks on a probe.
+class MediaMetadataCache(object):
+
+    def __init__(self, db_path, max_entries=20000, max_workers=2):
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(db_dir, exist_ok=True)
+
+        self._max_entries = max_entries
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        # Connection is shared between worker threads, so serialize access to it
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                           'path TEXT PRIMARY KEY, '
+                           'size INTEGER NOT NULL, '
+                           'mtime_ns INTEGER NOT NULL, '
+                           'version INTEGER NOT NULL, '
+                           'data TEXT NOT NULL, '
+                           'last_access REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS metadata_last_access ON metadata (last_access)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS keyframes ('
+                           'path TEXT PRIMARY KEY, '
+                           'size INTEGER NOT NULL, '
+                           'mtime_ns INTEGER NOT NULL, '
+                           'data BLOB NOT NULL)')
+        self._conn.commit()
+
+        self._num_entries = self._conn.execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
+
+        # Probes currently in flight, so concurrent requests for the same file only probe once
+        self._pending = {}
+
+        # Keyframe scans read the whole file, so they get their own worker and never hold up track probes
+        self._keyframe_executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_keyframes = {}
+
+        # path -> (size, mtime_ns, info) of recent probe results, answers repeat lookups without touching SQLite
+        self._recent_lock = threading.Lock()
+        self._recent = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _probe(file_path):
+        # pymediainfo loads libmediainfo, which isn't needed until the first probe
+        from pymediainfo import MediaInfo
+
+        mi = MediaInfo.parse(file_path)
+        return {'tracks': [track.to_data() for track in mi.tracks]}
+
+    def _remember(self, file_path, size, mtime_ns, info):
+        with self._recent_lock:
+            self._recent[file_path] = (size, mtime_ns, info)
+            self._recent.move_to_end(file_path)
+            while len(self._recent) > RECENT_PROBES:
+                self._recent.popitem(last=False)
+
+    def _lookup_recent(self, file_path, st):
+        with self._recent_lock:
+            entry = self._recent.get(file_path)
+            if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+                return None
+            self._recent.move_to_end(file_path)
+            return entry[2]
+
+    def get_warm_entries(self):
+        # Recent probe results, oldest first, for the warm start snapshot
+        with self._recent_lock:
+            return [(path,) + entry for path, entry in self._recent.items()]
+
+    def restore_warm_entries(self, entries):
+        # Entries are checked against the file's size and mtime when they are looked up, so stale ones are harmless
+        for path, size, mtime_ns, info in entries:
+            self._remember(path, size, mtime_ns, info)
+
+    def _lookup(self, file_path, st):
+        with self._db_lock:
+            row = self._conn.execute('SELECT size, mtime_ns, version, data FROM metadata WHERE path = ?',
+                                     (file_path,)).fetchone()
+            if row is None:
+                return None
+
+            size, mtime_ns, version, data = row
+            if size != st.st_size or mtime_ns != st.st_mtime_ns or version != PROBE_VERSION:
+                return None
+
+            self._conn.execute('UPDATE metadata SET last_access = ? WHERE path = ?', (time.time(), file_path))
+            self._conn.commit()
+            return json.loads(data)
+
+    def _store(self, file_path, st, info):
+        with self._db_lock:
+            replaced = self._conn.execute('SELECT 1 FROM metadata WHERE path = ?', (file_path,)).fetchone()
+            self._conn.execute('INSERT OR REPLACE INTO metadata (path, size, mtime_ns, version, data, last_access) '
+                               'VALUES (?, ?, ?, ?, ?, ?)',
+                               (file_path, st.st_size, st.st_mtime_ns, PROBE_VERSION, json.dumps(info), time.time()))
+            if not replaced:
+                self._num_entries += 1
+
+            # Evict least recently used entries (and their keyframe indexes) once we're over budget
+            excess = self._num_entries - self._max_entries
+            if excess > 0:
+                evicted = self._conn.execute('SELECT path FROM metadata ORDER BY last_access ASC LIMIT ?',
+                                             (excess,)).fetchall()
+                self._conn.executemany('DELETE FROM metadata WHERE path = ?', evicted)
+                self._conn.executemany('DELETE FROM keyframes WHERE path = ?', evicted)
+                self._num_entries -= excess
+
+            self._conn.commit()
+
+    def _lookup_or_probe(self, file_path):
+        st = os.stat(file_path)
+
+        info = self._lookup_recent(file_path, st)
+        if info is not None:
+            self.hits += 1
+            return info
+
+        info = self._lookup(file_path, st)
+        if info is not None:
+            self.hits += 1
+            self._remember(file_path, st.st_size, st.st_mtime_ns, info)
+            return info
+
+        self.misses += 1
+        start = time.perf_counter()
+        info = self._probe(file_path)
+        print('Probed {} in {:.0f} ms'.format(os.path.basename(file_path), (time.perf_counter() - start) * 1000))
+
+        self._store(file_path, st, info)
+        self._remember(file_path, st.st_size, st.st_mtime_ns, info)
+        return info
+
+    async def get(self, file_path):
+        # Return probe data for file_path, probing on a worker thread if it isn't cached or has changed on disk
+        file_path = os.path.abspath(file_path)
+
+        future = self._pending.get(file_path)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(self._executor, self._lookup_or_probe, file_path)
+            self._pending[file_path] = future
+            future.add_done_callback(lambda _: self._pending.pop(file_path, None))
+
+        return await asyncio.shield(future)
+
+    @staticmethod
+    def _scan_keyframes(file_path):
+        # Demux only (no decoding) and keep the timestamps of packets flagged as keyframes in the first video stream
+        output = subprocess.check_output([
+            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+            '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', file_path
+        ], stdin=subprocess.DEVNULL)
+
+        keyframes = array.array('d')
+        for line in output.splitlines():
+            pts_time, _, flags = line.partition(b',')
+            if b'K' in flags and pts_time and pts_time != b'N/A':
+                keyframes.append(float(pts_time))
+
+        # Packets come out in decode order, which isn't always presentation order
+        return array.array('d', sorted(keyframes))
+
+    def _lookup_keyframes(self, file_path):
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+
+        with self._db_lock:
+            row = self._conn.execute('SELECT size, mtime_ns, data FROM keyframes WHERE path = ?',
+                                     (file_path,)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+            return None
+
+        keyframes = array.array('d')
+        keyframes.frombytes(row[2])
+        return keyframes
+
+    def _lookup_or_scan_keyframes(self, file_path):
+        keyframes = self._lookup_keyframes(file_path)
+        if keyframes is not None:
+            return keyframes
+
+        st = os.stat(file_path)
+        start = time.perf_counter()
+        try:
+            keyframes = self._scan_keyframes(file_path)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('Failed to index keyframes of {}: {}'.format(os.path.basename(file_path), e))
+            return None
+        print('Indexed {} keyframes of {} in {:.1f} s'.format(len(keyframes), os.path.basename(file_path),
+                                                               time.perf_counter() - start))
+
+        with self._db_lock:
+            self._conn.execute('INSERT OR REPLACE INTO keyframes (path, size, mtime_ns, data) VALUES (?, ?, ?, ?)',
+                               (file_path, st.st_size, st.st_mtime_ns, keyframes.tobytes()))
+            self._conn.commit()
+        return keyframes
+
+    def build_keyframe_index(self, file_path):
+        # Start indexing keyframes in the background, returns a future that resolves to the index (or None)
+        file_path = os.path.abspath(file_path)
+
+        future = self._pending_keyframes.get(file_path)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(self._keyframe_executor, self._lookup_or_scan_keyframes, file_path)
+            self._pending_keyframes[file_path] = future
+            future.add_done_callback(lambda _: self._pending_keyframes.pop(file_path, None))
+
+        return future
+
+    async def get_keyframes(self, file_path):
+        # Only returns an index that has already been built; never waits on a scan
+        file_path = os.path.abspath(file_path)
+        if file_path in self._pending_keyframes:
+            return None
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._lookup_keyframes, file_path)
+
+    def close(self):
+        self._keyframe_executor.shutdown(wait=True)
+        self._executor.shutdown(wait=True)
+        with self._db_lock:
+            self._conn.close()
@@ -1,22 +1,60 @@
 import asyncio
+import bisect
+import collections
 import os
-import re
-
-import ffmpy3
-from pymediainfo import MediaInfo
-
-import ruamel.yaml
-CONFIG_FILE = 'config.yaml'
-
-with open(CONFIG_FILE, 'r') as f:
-    settings = ruamel.yaml.load(f.read(), ruamel.yaml.RoundTripLoader)
-
-FONT_FILE = settings['ffmpeg']['font_file']
+import time
+
+import encode_profiles
+import encoder_governor
+import ffmpeg_progress
+import ffmpeg_supervisor
+import filter_graph
+import perf_monitor
+import prefetcher
+import rtmp_relay
+import subtitle_cache
+import transcode_cache
+
+# Extra seconds of timestamp headroom given to standby encoders on top of their expected startup time
+STANDBY_SLACK = 0.25
+
+
+def create_subtitle_cache(config):
+    return subtitle_cache.SubtitleCache(config.cache.subtitle_dir,
+                                        max_bytes=int(config.cache.subtitle_max_size_mb * 1024 ** 2))
+
+
+def create_transcode_cache(config, encoder_pool=None):
+    # None when pre-transcoding is disabled. With encoder_pool, background encodes take slots from it
+    settings = config.transcode_cache
+    if not settings.enabled:
+        return None
+    return transcode_cache.TranscodeCache(
+        settings.directory,
+        int(settings.max_size_gb * 1024 ** 3),
+        segment_time=settings.segment_time,
+        threads=settings.threads,
+        encoder_pool=encoder_pool)
+
+
+def create_prefetcher(config):
+    # None when prefetching is disabled
+    settings = config.prefetch
+    if not settings.enabled:
+        return None
+    return prefetcher.Prefetcher(
+        head_bytes=int(settings.head_mb * 1024 ** 2),
+        seek_bytes=int(settings.seek_mb * 1024 ** 2),
+        tail_bytes=int(settings.tail_mb * 1024 ** 2),
+        mode=settings.mode)
 
 
 class Video(object):
+    # Long playlists keep thousands of these around, so no per-instance __dict__
+    __slots__ = ('filename', 'name', 'absolute_path', 'seek_time', 'audio_track', 'subtitle_track', 'media_info',
+                 'queued_at', 'keyframes')
 
-    def __init__(self, absolute_path, name=None, seek_time=0.0, audio_track=1, subtitle_track=None):
+    def __init__(self, absolute_path, name=None, seek_time=0.0, audio_track=1, subtitle_track=None, media_info=None):
         self.filename = os.path.basename(absolute_path)
         self.name = name if name else os.path.splitext(self.filename)[0]
         self.absolute_path = absolute_path
@@ -24,48 +62,205 @@ class Video(object):
         self.audio_track = audio_track
         self.subtitle_track = subtitle_track
 
+        # Cached probe data, carried along so that seeks and resumes never need to probe again
+        self.media_info = media_info
 
-class DiscordMediaPlayer(object):
+        # perf_counter() timestamp of the last time this video was put on the queue
+        self.queued_at = None
 
-    TOTAL_DURATION_REGEX = re.compile(r'Duration: (?P<hrs>[\d]+):(?P<mins>[\d]+):(?P<secs>[\d]+)\.(?P<ms>[\d]+)')
-    CURRENT_PROGRESS_REGEX = re.compile(r'time=(?P<hrs>[\d]+):(?P<mins>[\d]+):(?P<secs>[\d]+)\.(?P<ms>[\d]+)')
+        # Sorted keyframe timestamps of the video stream, once the background index has been built
+        self.keyframes = None
 
-    def __init__(self, stream_url):
-        self._stream_url = stream_url
+    def with_seek_time(self, seek_time):
+        # Copy starting at seek_time, so a seek doesn't change the video the running encoder is playing
+        video = Video(self.absolute_path, name=self.name, seek_time=seek_time, audio_track=self.audio_track,
+                      subtitle_track=self.subtitle_track, media_info=self.media_info)
+        video.keyframes = self.keyframes
+        return video
+
+
+class DiscordMediaPlayer(object):
+
+    # Only errors go to stderr, along with the machine readable -progress key/value blocks
+    PROGRESS_OPTIONS = ['-nostats', '-loglevel', 'error', '-progress', 'pipe:2']
+
+    def __init__(self, outputs, config, metadata_cache=None, subtitle_cache=None, transcode_cache=None,
+                 file_prefetcher=None):
+        # outputs is a single RTMP URL, or a list of {'url': ..., 'profile': ...} dicts. Outputs without a profile
+        # (or with the main one) share the main encode, every other profile becomes an extra variant encoded from
+        # the same decoded and filtered frames.
+        # The caches are keyed by source file, so players of different sessions can share them
+        if isinstance(outputs, str):
+            outputs = [{'url': outputs}]
+        self._outputs = list(outputs)
+        self._config = config
+        self._metadata_cache = metadata_cache
         self._ffmpeg_process = None
-        self._offset_time = 0
+        self._progress = None
         self._total_duration = None
         self._current_video = None
+        # Position in the video the running encoder's output starts at, which can be before the video's seek_time
+        self._output_start = None
+
+        encode_profile = config.ffmpeg.encode_profile
+        self._profile = config.encode_profiles[encode_profile]
+
+        # Restarts FFmpeg from where it got to when it crashes or stops making progress
+        supervisor_settings = config.ffmpeg.supervisor
+        self._supervisor = ffmpeg_supervisor.FFmpegSupervisor(
+            stall_timeout=supervisor_settings.stall_timeout,
+            max_retries=supervisor_settings.max_retries,
+            backoff_base=supervisor_settings.backoff_base,
+            backoff_max=supervisor_settings.backoff_max,
+            healthy_reset=supervisor_settings.healthy_reset)
+        self._stop_requested = False
+        self._stalled = False
+        self._healthy_time = 0.0
+        # Set while waiting out the backoff before a restart, the video still counts as playing then
+        self._retrying = False
+        self._stop_event = asyncio.Event()
+
+        # Replacement encoders started by switch_to. _standby_settled is clear while one is starting up, and _switch
+        # holds the (video, run) that took over until play_video picks it up
+        self._standby_settled = asyncio.Event()
+        self._standby_settled.set()
+        self._switch = None
+        # Running estimate of the time from starting an encoder to its first output, and measured switch times
+        self._startup_estimate = 2.0
+        self.switch_latencies = collections.deque(maxlen=100)
+
+        # Steps down to cheaper profiles when the encoder can't keep up with realtime, and back up with headroom
+        self._governor = None
+        self._restart_requested = False
+        governor_settings = config.ffmpeg.governor
+        if governor_settings.enabled:
+            self._governor = encoder_governor.EncoderGovernor(
+                [encode_profile] + [name for name in governor_settings.ladder if name != encode_profile],
+                down_speed=governor_settings.down_speed,
+                down_window=governor_settings.down_window,
+                up_window=governor_settings.up_window,
+                up_max_load=governor_settings.up_max_load,
+                min_dwell=governor_settings.min_dwell)
+
+        variant_names, variant_urls = [encode_profile], [[]]
+        for output in self._outputs:
+            profile_name = output.get('profile') or encode_profile
+            if profile_name not in variant_names:
+                variant_names.append(profile_name)
+                variant_urls.append([])
+            variant_urls[variant_names.index(profile_name)].append(output['url'])
+
+        # Profiles of the extra variants, the main one is still picked by the governor
+        self._variant_profiles = [config.encode_profiles[name] for name in variant_names[1:]]
+
+        # Owns the RTMP connections across videos so transitions and seeks don't drop the streams
+        self._relay = rtmp_relay.RtmpRelay(variant_urls, idle_timeout=config.ffmpeg.relay_idle_timeout)
+
+        # Subtitle tracks extracted from their containers, so libass doesn't have to demux the whole source file
+        self._subtitle_cache = subtitle_cache or create_subtitle_cache(config)
+
+        # Videos encoded ahead of time, so playback and rewinds can stream-copy instead of encoding in realtime
+        self._transcode_cache = transcode_cache if transcode_cache is not None else create_transcode_cache(config)
+
+        # Warms the page cache ahead of the next video and of seeks, for media on slow mounts
+        self._prefetcher = file_prefetcher if file_prefetcher is not None else create_prefetcher(config)
+
+    async def get_media_info(self, file_path):
+        with perf_monitor.monitor.span('player probe'):
+            return await self._metadata_cache.get(file_path)
+
+    def prepare_video(self, video):
+        # Kick off background work for a freshly queued video so it's ready by the time anyone seeks in it
+        self._metadata_cache.build_keyframe_index(video.absolute_path)
+
+        if video.subtitle_track:
+            self._subtitle_cache.extract(video.absolute_path, video.subtitle_track)
+
+        # Nothing to pre-transcode when the source can be streamed as-is
+        mode = self.choose_mode(video)
+        if self._transcode_cache and mode == encode_profiles.MODE_ENCODE and not self._variant_profiles:
+            self._transcode_cache.schedule(video.absolute_path, self.build_encode_params(video, seek_time=0))
+
+    def prefetch_video(self, video, position=None):
+        # Start pulling the part of the file that playback from position (default: the video's seek time) needs
+        if self._prefetcher:
+            self._prefetcher.prefetch(video.absolute_path, video.seek_time if position is None else position,
+                                      self.get_duration(video.media_info) if video.media_info else None)
+
+    def get_prefetcher(self):
+        return self._prefetcher
+
+    def get_encoder_count(self):
+        # Number of video encoders a realtime encode runs, one per variant
+        return 1 + len(self._variant_profiles)
+
+    def choose_mode(self, video):
+        # Extra variants need decoded frames anyway, so every output is encoded in that case
+        if self._variant_profiles:
+            return encode_profiles.MODE_ENCODE
+        return self._profile.choose_mode(video, self._config.ffmpeg.passthrough)
+
+    async def find_seek_point(self, video, target_time):
+        # Returns the time to restart from: the preceding keyframe if it's close enough to the target, since input
+        # seeking to a keyframe starts immediately instead of decoding and discarding frames up to the target
+        if video.keyframes is None:
+            video.keyframes = await self._metadata_cache.get_keyframes(video.absolute_path)
+
+        if not video.keyframes:
+            return target_time
+
+        i = bisect.bisect_right(video.keyframes, target_time)
+        if i == 0:
+            return target_time
+
+        keyframe_time = video.keyframes[i - 1]
+        if target_time - keyframe_time <= self._config.ffmpeg.keyframe_snap_tolerance:
+            return keyframe_time
+        return target_time
 
     @staticmethod
-    def get_human_readable_track_info(file_path):
-        mi = MediaInfo.parse(file_path)
+    def get_human_readable_track_info(media_info):
         audio_tracks, subtitle_tracks = [], []
-        for track in mi.tracks:
-            if track.track_type == 'Audio':
+        for track in media_info['tracks']:
+            if track.get('track_type') == 'Audio':
                 audio_tracks.append(
                     '{num}) {name} ({lang}, {codec} - {channels})'.format(
-                        num=int(track.stream_identifier or '0') + 1,
-                        name=track.title or 'Untitled',
-                        lang=(track.other_language or ['Unknown language'])[0],
-                        codec=track.format or 'Unknown codec',
-                        channels=(str(track.channel_s) or 'Unknown') + ' channels'
+                        num=int(track.get('stream_identifier') or '0') + 1,
+                        name=track.get('title') or 'Untitled',
+                        lang=(track.get('other_language') or ['Unknown language'])[0],
+                        codec=track.get('format') or 'Unknown codec',
+                        channels=(str(track.get('channel_s')) or 'Unknown') + ' channels'
                     )
                 )
-            elif track.track_type == 'Text':
+            elif track.get('track_type') == 'Text':
                 subtitle_tracks.append(
                     '{num}) {name} ({lang})'.format(
-                        num=int(track.stream_identifier or '0') + 1,
-                        name=track.title or 'Untitled',
-                        lang=(track.other_language or ['Unknown language'])[0]
+                        num=int(track.get('stream_identifier') or '0') + 1,
+                        name=track.get('title') or 'Untitled',
+                        lang=(track.get('other_language') or ['Unknown language'])[0]
                     )
                 )
 
         return audio_tracks, subtitle_tracks
 
     @staticmethod
-    def convert_to_secs(hrs, mins, secs, ms):
-        return int(hrs) * 3600 + int(mins) * 60 + int(secs) + int(ms) * 0.01
+    def get_duration(media_info):
+        general = [t for t in media_info['tracks'] if t.get('track_type') == 'General']
+        try:
+            # MediaInfo reports durations in milliseconds
+            return float(general[0]['duration']) / 1000
+        except (IndexError, KeyError, TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def get_video_height(media_info):
+        for track in media_info['tracks']:
+            if track.get('track_type') == 'Video':
+                try:
+                    return int(track['height'])
+                except (KeyError, TypeError, ValueError):
+                    return None
+        return None
 
     @staticmethod
     def convert_secs_to_str(secs):
@@ -76,17 +271,36 @@ class DiscordMediaPlayer(object):
         else:
             return '{}:{:05.2f}'.format(mins, secs)
 
+    def _is_process_running(self):
+        return self._ffmpeg_process and self._ffmpeg_process.process and \
+            self._ffmpeg_process.process.returncode is None
+
     def is_video_playing(self):
-        return self._ffmpeg_process and self._ffmpeg_process.process.returncode is None
+        return self._retrying or self._is_process_running()
+
+    def get_supervisor(self):
+        return self._supervisor
+
+    def get_progress(self):
+        # Latest progress record from the running FFmpeg, or None if it hasn't reported any yet
+        return self._progress
 
     def get_video_time(self):
-        return self._current_video.seek_time + self._offset_time, self._total_duration
+        offset_time = self._progress.out_time if self._progress and self._progress.out_time else 0
+        start_time = self._output_start if self._output_start is not None else self._current_video.seek_time
+        return start_time + offset_time, self._total_duration
 
     def get_current_video(self):
         return self._current_video
 
     async def stop_video(self):
-        if self.is_video_playing():
+        # An explicit stop always wins over a pending governor or supervisor restart
+        self._restart_requested = False
+        self._stop_requested = True
+        self._stop_event.set()
+
+        if self._is_process_running():
+            import ffmpy3
             try:
                 print('Stopping FFmpeg')
                 self._ffmpeg_process.process.terminate()
@@ -102,11 +316,15 @@ class DiscordMediaPlayer(object):
         current, total = self.get_video_time()
         return exitcode, current, total
 
-    async def play_video(self, video):
-        if not os.path.exists(video.absolute_path):
-            raise FileNotFoundError('File not found: {}'.format(video.filename))
-
-        self._current_video = video
+    def build_encode_params(self, video, seek_time=None, extracted_subtitles=None, mode=encode_profiles.MODE_ENCODE,
+                            profile=None, variant_profiles=None):
+        # Encoding profile shared by realtime playback and pre-transcoding, excluding the output container options.
+        # extracted_subtitles is an optional (subtitle file, fonts dir) pair from the subtitle cache.
+        # variant_profiles adds one more video/audio stream pair per profile, encoded from the same filtered frames
+        if seek_time is None:
+            seek_time = video.seek_time
+        if profile is None:
+            profile = self._profile
 
         output_params = [
             # Select the first video track (if there are multiple)
@@ -116,112 +334,414 @@ class DiscordMediaPlayer(object):
             '-map', '0:a:{}'.format(video.audio_track - 1)
         ]
 
-        # Build filtergraph
-        # First filter: change frame timestamps so that they are correct when starting at seek_time
-        vf_str = 'setpts=PTS+{}/TB,'.format(video.seek_time)
-
-        # Second filter: render embedded subtitle track from the media file
-        # Note that subtitles rely on the above timestamps and that tracks are 0 indexed
-        if video.subtitle_track:
-            vf_str += 'subtitles=\'{}\':si={},'.format(video.absolute_path, video.subtitle_track - 1)
-
-        # Third filter: Draw timestamp for current frame in the video to make seeking easier
-        # TODO: make these parameters more configurable
-        vf_str += 'drawtext=\'fontfile={}: fontcolor=white: x=0: y=h-line_h-5: fontsize=24: boxcolor=black@0.5: box=1: text=%{{pts\\:hms}}\','.format(FONT_FILE)
-        vf_str += 'setpts=PTS-STARTPTS'
+        if mode == encode_profiles.MODE_COPY:
+            # Source already fits the output profile, just remux it
+            return output_params + ['-c:v', 'copy', '-c:a', 'copy']
 
-        # TODO: make these more configurable
-        output_params += [
-            # Filtergraph options from above
-            '-vf', vf_str,
+        if mode == encode_profiles.MODE_COPY_VIDEO:
+            # Only the audio track is incompatible
+            return output_params + ['-c:v', 'copy'] + profile.get_audio_params()
 
-            # Use the following encoding settings:
+        # Render embedded subtitle track, preferably from the small pre-extracted copy
+        # Note that tracks are 0 indexed
+        subtitles_filter = None
+        if video.subtitle_track and extracted_subtitles:
+            subtitles_filter = 'subtitles=\'{}\':fontsdir=\'{}\''.format(*extracted_subtitles)
+        elif video.subtitle_track:
+            subtitles_filter = 'subtitles=\'{}\':si={}'.format(video.absolute_path, video.subtitle_track - 1)
 
-            # Encode using x264 veryfast preset (decent performance/quality for realtime streaming)
-            '-vcodec', 'libx264',
-            '-preset', 'veryfast',
+        vf_str = filter_graph.build_video_filters(
+            seek_time, self._config.ffmpeg.font_file, subtitles_filter=subtitles_filter,
+            source_height=self.get_video_height(video.media_info) if video.media_info else None,
+            max_height=profile.max_height, scale_flags=profile.scale_flags)
 
-            # Specify max bitrate of 4.5Mbps with buffer size of 1.125Mbps (0.25 sec buffer for faster stream startup)
-            '-maxrate', '4500k',
-            '-bufsize', '1125k',
+        if variant_profiles:
+            return self._build_variant_params(video, vf_str, profile, variant_profiles)
 
-            # Use YUV color space, 4:2:0 chroma subsampling, 8-bit render depth
-            '-pix_fmt', 'yuv420p',
+        # Filtergraph options from above, then the encoding settings from the selected profile
+        output_params += ['-vf', vf_str]
+        output_params += profile.get_video_params()
+        output_params += profile.get_audio_params()
 
-            # Set keyframe interval to 24
-            # (RTMP clients need to wait for the next keyframe, so this is a 1 second startup time)
-            '-g', '24',
+        return output_params
 
-            # Use AAC-LC audio codec, 128Kbps stereo at 44.1KHz sampling rate
-            '-c:a', 'libfdk_aac',
-            '-ab', '128k',
-            '-ac', '2',
-            '-ar', '44100',
+    @staticmethod
+    def _build_variant_params(video, vf_str, profile, variant_profiles):
+        # Decode, render subtitles and the overlay once, then split the frames between the encoders. Variants with a
+        # lower max_height scale the already rendered frames down, which is far cheaper than rendering them again
+        count = len(variant_profiles) + 1
+        graph = '[0:v:0]{},split={}{}'.format(vf_str, count, ''.join('[v{}]'.format(i) for i in range(count)))
+        labels = ['[v0]']
+        for i, variant in enumerate(variant_profiles, 1):
+            if variant.max_height:
+                graph += ';[v{i}]scale=-2:\'min(ih,{h})\':flags={f}[v{i}s]'.format(
+                    i=i, h=variant.max_height, f=variant.scale_flags)
+                labels.append('[v{}s]'.format(i))
+            else:
+                labels.append('[v{}]'.format(i))
+
+        # -filter_complex is a global option, FFmpeg accepts it among the output options too
+        output_params = ['-filter_complex', graph]
+
+        # Stream i of each type belongs to variant i, which is what the relays select on
+        for label in labels:
+            output_params += ['-map', label, '-map', '0:a:{}'.format(video.audio_track - 1)]
+        for i, variant in enumerate([profile] + list(variant_profiles)):
+            output_params += variant.get_video_params(i)
+            output_params += variant.get_audio_params(i)
+
+        return output_params
 
-            # Some more options to reduce startup time
-            '-probesize', '32',
-            '-analyzeduration', '500000',
-            '-flush_packets', '1',
+    async def play_video(self, video):
+        if not os.path.exists(video.absolute_path):
+            raise FileNotFoundError('File not found: {}'.format(video.filename))
 
-            # Output format is FLV
-            '-f', 'flv'
-        ]
+        self._stop_requested = False
+        self._stop_event.clear()
+        self._start_video(video)
 
-        self._ffmpeg_process = ffmpy3.FFmpeg(
-            global_options=[
-                # Tell ffmpeg to start encoding from seek_time seconds into the video
-                '-ss', str(video.seek_time),
+        run = None
+        while True:
+            self._restart_requested = False
+            if run is None:
+                run = await self._start_ffmpeg(video)
+            self._ffmpeg_process = run.ffmpeg
+            self._output_start = run.start_time
+            if run.total_duration is not None:
+                self._total_duration = run.total_duration
+
+            returncode = await self._monitor_ffmpeg(video, run)
+            run = None
+
+            # The encoder may have finished on its own while a replacement was starting up
+            await self._standby_settled.wait()
+
+            if self._switch is not None:
+                # A standby encoder took over (seek or skip), carry on monitoring that one
+                video, run = self._switch
+                self._switch = None
+                self._start_video(video)
+                continue
+
+            if self._stop_requested:
+                return returncode
+
+            if not self._restart_requested:
+                if returncode == 0 and not self._stalled:
+                    return returncode
+
+                # Crashed or hung, so retry from the last known position after a backoff
+                reason = ffmpeg_supervisor.REASON_STALL if self._stalled else ffmpeg_supervisor.REASON_EXIT
+                position, _ = self.get_video_time()
+                delay = self._supervisor.next_retry(reason, position, self._healthy_time)
+                if delay is None:
+                    return returncode
+
+                print('FFmpeg {} (code {}), retrying in {:.1f} s'.format(
+                    'stalled' if self._stalled else 'exited', returncode, delay))
+                # A stop cuts the wait short
+                self._retrying = True
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    self._retrying = False
+                if self._stop_requested:
+                    return returncode
+
+            # Pick up again from where the last FFmpeg got to (the governor may have switched profiles)
+            video.seek_time, _ = self.get_video_time()
+            self._progress = None
+            print('Restarting FFmpeg at {}'.format(self.convert_secs_to_str(video.seek_time)))
+
+    def _start_video(self, video):
+        self._current_video = video
+        self._output_start = None
+        self._progress = None
+        self._total_duration = self.get_duration(video.media_info) if video.media_info else None
+        self._supervisor.start_video()
+
+        if self._prefetcher:
+            self._prefetcher.record_playback(video.absolute_path, video.seek_time, self._total_duration)
+
+    async def switch_to(self, video):
+        # Start an encoder for video (at its seek_time) while the current one keeps streaming, and hand the output
+        # over once it produces data. Returns the time the switch took, or None if nothing was playing or the new
+        # encoder failed, in which case the caller should fall back to stopping and restarting
+        if not self._is_process_running() or not self._standby_settled.is_set() or self._retrying:
+            return None
+        if not os.path.exists(video.absolute_path):
+            return None
 
-                # Read input file at the frame rate it's encoded at (crucial for live streams and synchronization)
-                '-re',
-            ],
-            inputs={video.absolute_path: None},
-            outputs={self._stream_url: output_params},
-        )
+        start = time.perf_counter()
+        self._standby_settled.clear()
+        try:
+            run = await self._start_ffmpeg(video, standby=True)
 
-        print('Starting FFmpeg')
-        print(self._ffmpeg_process.cmd)
+            try:
+                switched = await asyncio.wait_for(asyncio.shield(run.switched), self._config.ffmpeg.standby_timeout)
+            except asyncio.TimeoutError:
+                print('Standby FFmpeg produced nothing in {} s, giving up on it'.format(
+                    self._config.ffmpeg.standby_timeout))
+                self._kill(run.ffmpeg.process)
+                # Wait for the run to settle, but even if its first data got through as it was killed there is
+                # nothing left to hand over to, so the switch failed
+                await run.switched
+                switched = False
+
+            if switched and self._stop_requested:
+                # Stopped while the standby was starting up
+                self._kill(run.ffmpeg.process)
+                switched = False
+
+            if not switched:
+                await self._finish_run(run)
+                return None
+
+            latency = time.perf_counter() - start
+            self.switch_latencies.append(latency)
+            perf_monitor.monitor.record('player switch', latency)
+            print('Switched to standby FFmpeg after {:.0f} ms'.format(latency * 1000))
+
+            # The old encoder's output is no longer relayed, so it can go. From here on stop_video acts on the new one
+            self._switch = (video, run)
+            old_process = self._ffmpeg_process.process
+            self._ffmpeg_process = run.ffmpeg
+            if old_process.returncode is None:
+                old_process.terminate()
+            return latency
+        finally:
+            self._standby_settled.set()
+
+    def get_switch_lead(self):
+        # How far ahead of the live stream a standby encoder's timestamps start: its expected startup time plus a
+        # little slack. The live encoder's output is cut off at that point if the standby is slower than expected
+        return self._startup_estimate + STANDBY_SLACK
 
-        # Start FFmpeg, redirect stderr so we can keep track of encoding progress
-        self._ffmpeg_process.run_async(stderr=asyncio.subprocess.PIPE)
+    @staticmethod
+    def _kill(process):
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+
+    async def _start_ffmpeg(self, video, standby=False):
+        # Everything up to the FFmpeg process running (cache lookups, subtitle extraction, the spawn itself)
+        with perf_monitor.monitor.span('player spawn'):
+            return await self._spawn_ffmpeg(video, standby)
+
+    async def _spawn_ffmpeg(self, video, standby):
+        # Imported here rather than at startup, nothing needs FFmpeg until the first video is played
+        import ffmpy3
+
+        if standby:
+            segment_id, ts_offset = await self._relay.begin_segment(standby_lead=self.get_switch_lead())
+        else:
+            segment_id, ts_offset = await self._relay.begin_segment()
+
+        run = EncoderRun(segment_id)
+        run.start_time = video.seek_time
+        mode = self.choose_mode(video)
+        run.mode = mode
+
+        if self._transcode_cache and mode == encode_profiles.MODE_ENCODE and not self._variant_profiles:
+            run.cached_transcode = await self._transcode_cache.lookup(video.absolute_path,
+                                                                      self.build_encode_params(video, seek_time=0))
+            if run.cached_transcode:
+                run.playlist = run.cached_transcode.write_playlist(video.seek_time)
+
+        if run.playlist:
+            playlist_path, start_time = run.playlist
+            print('Streaming pre-transcoded segments from {}'.format(self.convert_secs_to_str(start_time)))
+
+            # Segments start on keyframes, so playback resumes at the start of the segment containing seek_time.
+            # video.seek_time keeps the requested time, the reported position counts from where the output starts
+            run.start_time = start_time
+            run.total_duration = run.cached_transcode.get_duration()
+            self._transcode_cache.acquire(run.cached_transcode)
+
+            run.ffmpeg = ffmpy3.FFmpeg(
+                global_options=self.PROGRESS_OPTIONS + ['-re'],
+                inputs={playlist_path: ['-f', 'concat', '-safe', '0']},
+                outputs={'pipe:1': [
+                    '-map', '0',
+                    '-c', 'copy',
+                    '-output_ts_offset', str(ts_offset),
+                    '-muxdelay', '0',
+                    '-f', 'mpegts'
+                ]},
+            )
+        else:
+            run.cached_transcode = None
+
+            extracted_subtitles = None
+            if video.subtitle_track:
+                extracted_subtitles = await self._subtitle_cache.get(video.absolute_path, video.subtitle_track)
+                if extracted_subtitles is None:
+                    print('Subtitles not extracted yet, rendering from the source file')
+
+            if mode != encode_profiles.MODE_ENCODE:
+                print('Source fits the {} profile, using {} mode'.format(self._profile.name, mode))
+
+            profile = self._profile
+            if self._governor and mode == encode_profiles.MODE_ENCODE:
+                profile = self._config.encode_profiles[self._governor.get_profile_name()]
+
+            global_params = []
+            if mode == encode_profiles.MODE_ENCODE:
+                global_params = profile.get_global_params()
+
+            output_params = self.build_encode_params(video, extracted_subtitles=extracted_subtitles, mode=mode,
+                                                     profile=profile, variant_profiles=self._variant_profiles) + [
+                # Some more options to reduce startup time
+                '-probesize', '32',
+                '-analyzeduration', '500000',
+                '-flush_packets', '1',
+
+                # Continue timestamps from where the previous video left off on the relayed stream
+                '-output_ts_offset', str(ts_offset),
+
+                # Output MPEG-TS to stdout, the relays remux it to FLV on their persistent RTMP connections
+                '-muxdelay', '0',
+                '-f', 'mpegts'
+            ]
+
+            run.ffmpeg = ffmpy3.FFmpeg(
+                global_options=self.PROGRESS_OPTIONS + global_params + [
+                    # Tell ffmpeg to start encoding from seek_time seconds into the video
+                    '-ss', str(video.seek_time),
+
+                    # Read input file at the frame rate it's encoded at (crucial for live streams and synchronization)
+                    '-re',
+                ],
+                inputs={video.absolute_path: None},
+                outputs={'pipe:1': output_params},
+            )
+
+        print('Starting {}FFmpeg'.format('standby ' if standby else ''))
+        print(run.ffmpeg.cmd)
+
+        # Start FFmpeg, redirect stderr so we can keep track of encoding progress and stdout to feed the relay
+        await run.ffmpeg.run_async(stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        run.spawn_time = time.perf_counter()
+        run.relay_feed = asyncio.ensure_future(self._relay.feed(run.ffmpeg.process.stdout, segment_id,
+                                                                on_first_data=run.on_first_data))
+
+        if video.queued_at is not None:
+            print('Enqueue to FFmpeg spawn: {:.1f} ms'.format((run.spawn_time - video.queued_at) * 1000))
+            video.queued_at = None
+
+        return run
+
+    async def _monitor_ffmpeg(self, video, run):
+        first_frame_time = None
+
+        # Time the output position last moved, for stall detection
+        self._stalled = False
+        self._healthy_time = 0.0
+        last_out_time = None
+        last_advance = run.spawn_time
+
+        if self._governor and run.mode == encode_profiles.MODE_ENCODE and not run.cached_transcode:
+            self._governor.start()
+
+        progress_parser = ffmpeg_progress.ProgressParser()
+        my_stderr = run.ffmpeg.process.stderr
 
-        # Buffer for incomplete line output
-        line_buf = bytearray()
+        while True:
+            # Wake up regularly even if FFmpeg goes quiet, a hung FFmpeg wouldn't write progress at all
+            try:
+                line = await asyncio.wait_for(my_stderr.readline(), 1)
+            except asyncio.TimeoutError:
+                line = None
 
-        my_stderr = self._ffmpeg_process.process.stderr
+            now = time.perf_counter()
+            if not self._stalled and self._supervisor.is_stalled(last_advance, now):
+                self._stalled = True
+                self._supervisor.record_stall(now - last_advance)
+                self._kill(run.ffmpeg.process)
 
-        while True:
-            # Read some FFmpeg output (128 bytes is about 1 line worth)
-            in_buf = await my_stderr.read(128)
+            if line is None:
+                continue
 
             # Break if EOF
-            if not in_buf:
+            if not line:
                 break
 
-            # FFmpeg encoding progress is displayed on the same line using CR, so replace with LF if present
-            in_buf = in_buf.replace(b'\r', b'\n')
-
-            # Append to the buffer
-            line_buf.extend(in_buf)
-
-            # Process each line present in the buffer
-            while b'\n' in line_buf:
-                line, _, line_buf = line_buf.partition(b'\n')
-                line = str(line)
-                # print(line)
-
-                if self._total_duration is None:
-                    # Get total video duration
-                    match = self.TOTAL_DURATION_REGEX.search(line)
-                    if match:
-                        self._total_duration = self.convert_to_secs(**match.groupdict())
-                else:
-                    # Get current video playback duration
-                    match = self.CURRENT_PROGRESS_REGEX.search(line)
-                    if match:
-                        self._offset_time = self.convert_to_secs(**match.groupdict())
-
-        # At this point, FFmpeg will already have stopped without us having to wait explicitly on it
-        # because it will close stderr when it is complete (breaking the loop)
+            line = line.decode('utf-8', 'replace').rstrip()
+            match = progress_parser.match(line)
+            if not match:
+                if line:
+                    print('FFmpeg: {}'.format(line))
+                continue
+
+            progress = progress_parser.feed(match)
+            if progress is None:
+                continue
+            self._progress = progress
+
+            if progress.out_time is not None and (last_out_time is None or progress.out_time > last_out_time):
+                last_out_time = progress.out_time
+                last_advance = progress.received_at
+                if first_frame_time is not None:
+                    self._healthy_time = progress.received_at - first_frame_time
+
+            if first_frame_time is None and progress.frame:
+                first_frame_time = progress.received_at
+                perf_monitor.monitor.record('player first frame', first_frame_time - run.spawn_time)
+                print('FFmpeg spawn to first frame at {}: {:.0f} ms'.format(
+                    self.convert_secs_to_str(video.seek_time), (first_frame_time - run.spawn_time) * 1000))
+
+            if self._governor and not run.cached_transcode and run.mode == encode_profiles.MODE_ENCODE and \
+                    not self._restart_requested and self._governor.observe(progress):
+                self._restart_requested = True
+                run.ffmpeg.process.terminate()
+
+        await self._finish_run(run)
         print('FFmpeg finished')
-        return self._ffmpeg_process.process.returncode
+        return run.ffmpeg.process.returncode
+
+    async def _finish_run(self, run):
+        # FFmpeg closes stderr when it is complete, so this won't wait long
+        await run.ffmpeg.process.wait()
+        await run.relay_feed
+
+        if run.first_data_time is not None:
+            # Keep a running estimate of startup time, standby encoders use it to pick their timestamp offset
+            startup = run.first_data_time - run.created_at
+            self._startup_estimate = 0.7 * self._startup_estimate + 0.3 * startup
+
+        # Only advances the stream clock if this encoder's output was still the live one
+        self._relay.end_segment(run.segment_id,
+                                self._progress.out_time if self._progress and self._progress.out_time else 0)
+        if run.cached_transcode:
+            self._transcode_cache.release(run.cached_transcode)
+            os.remove(run.playlist[0])
+
+
+class EncoderRun(object):
+    # One FFmpeg started by the player, along with everything needed to clean up after it
+
+    def __init__(self, segment_id):
+        self.segment_id = segment_id
+        self.created_at = time.perf_counter()
+        self.ffmpeg = None
+        self.mode = None
+        self.cached_transcode = None
+        self.playlist = None
+        self.total_duration = None
+        # Position in the video the output starts at
+        self.start_time = None
+        self.relay_feed = None
+        self.spawn_time = None
+        self.first_data_time = None
+
+        # Resolves to True once the relay starts sending this encoder's output, False if it never produced any
+        self.switched = asyncio.get_event_loop().create_future()
+
+    def on_first_data(self, went_live):
+        if went_live:
+            self.first_data_time = time.perf_counter()
+        if not self.switched.done():
+            self.switched.set_result(went_live)
@@ -0,0 +1,125 @@
+import asyncio
+import collections
+import time
+
+# Discord allows 5 messages per 5 seconds in a channel
+DEFAULT_RATE = 5
+DEFAULT_PER = 5.0
+
+MAX_MESSAGE_LENGTH = 2000
+
+
+class PendingMessage(object):
+
+    def __init__(self, content, status):
+        self.content = content
+        self.status = status
+        self.queued_at = time.perf_counter()
+        # Resolves to whatever send returned, or None if the message was dropped or failed to send
+        self.future = asyncio.get_event_loop().create_future()
+
+
+# Outbound messages, sent in order per channel while staying inside each channel's rate limit, so bursts wait their
+# turn here instead of stalling in Discord's 429 backoff.
+# Status messages (progress notes like "Added to queue" or "Restarting stream at") wait coalesce_window seconds before
+# going out, and consecutive ones are merged into a single message. A status message sent with replace=True drops
+# any unsent message with the same status key, so only the latest of several quick seeks is announced.
+# send is a coroutine function taking (channel, content), which makes it easy to run against a fake client.
+class MessageScheduler(object):
+
+    def __init__(self, send, rate=DEFAULT_RATE, per=DEFAULT_PER, coalesce_window=0.25,
+                 max_length=MAX_MESSAGE_LENGTH):
+        self._send = send
+        self._rate = rate
+        self._per = per
+        self._coalesce_window = coalesce_window
+        self._max_length = max_length
+
+        # Per channel: unsent messages, times of the last few sends, and the task sending them
+        self._pending = {}
+        self._sent = {}
+        self._workers = {}
+
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.throttled_time = 0.0
+
+    def say(self, channel, content, status=None, replace=False):
+        # Queues content for channel and returns a future for the sent message, callers don't have to wait for it
+        pending = self._pending.setdefault(channel, collections.deque())
+
+        if replace and status is not None:
+            for message in [message for message in pending if message.status == status]:
+                pending.remove(message)
+                message.future.set_result(None)
+                self.dropped += 1
+
+        message = PendingMessage(content, status)
+        pending.append(message)
+
+        if channel not in self._workers:
+            self._workers[channel] = asyncio.ensure_future(self._run(channel))
+        return message.future
+
+    def get_pending(self, channel=None):
+        if channel is not None:
+            return len(self._pending.get(channel, ()))
+        return sum(len(pending) for pending in self._pending.values())
+
+    async def _wait_for_budget(self, channel):
+        sent = self._sent.setdefault(channel, collections.deque(maxlen=self._rate))
+        if len(sent) < self._rate:
+            return
+        delay = sent[0] + self._per - time.perf_counter()
+        if delay > 0:
+            self.throttled_time += delay
+            await asyncio.sleep(delay)
+
+    def _take_batch(self, pending):
+        batch = [pending.popleft()]
+        if batch[0].status is None:
+            return batch
+
+        length = len(batch[0].content)
+        while pending and pending[0].status is not None and \
+                length + 1 + len(pending[0].content) <= self._max_length:
+            message = pending.popleft()
+            length += 1 + len(message.content)
+            batch.append(message)
+        self.merged += len(batch) - 1
+        return batch
+
+    async def _run(self, channel):
+        pending = self._pending[channel]
+        try:
+            while pending:
+                head = pending[0]
+                if head.status is not None:
+                    # Give the status messages that tend to follow a moment to arrive, so they go out together
+                    delay = head.queued_at + self._coalesce_window - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                        # The head may have been replaced in the meantime
+                        continue
+
+                await self._wait_for_budget(channel)
+                if not pending:
+                    break
+
+                batch = self._take_batch(pending)
+                self._sent[channel].append(time.perf_counter())
+                try:
+                    result = await self._send(channel, '\n'.join(message.content for message in batch))
+                    self.sent += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print('Failed to send message: {}'.format(e))
+                    result = None
+
+                for message in batch:
+                    if not message.future.done():
+                        message.future.set_result(result)
+        finally:
+            del self._workers[channel]
@@ -0,0 +1,185 @@
+import asyncio
+import collections
+import contextlib
+import functools
+import sys
+import threading
+import time
+import traceback
+
+# Upper bounds (ms) of the loop lag histogram buckets, anything slower lands in the last one
+LAG_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# Durations kept per span name for the percentiles
+SPAN_HISTORY = 200
+
+
+def percentile(values, fraction):
+    # Nearest rank percentile of an unsorted sequence, None when it's empty
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class SlowCallback(object):
+    # The event loop being blocked for longer than the threshold, along with the stack it was stuck in
+
+    def __init__(self, detected_at, stack):
+        self.detected_at = detected_at
+        self.stack = stack
+        # Filled in once the loop gets going again
+        self.duration = None
+
+
+class SpanStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.max = 0.0
+        self.recent = collections.deque(maxlen=SPAN_HISTORY)
+
+    def add(self, duration):
+        self.count += 1
+        self.max = max(self.max, duration)
+        self.recent.append(duration)
+
+
+# Built-in instrumentation for finding out where the bot spends its time.
+# A sampler coroutine sleeps for a fixed interval and records how late it wakes up, which is how long the event loop
+# was busy with other callbacks (the loop lag). A watchdog thread notices when the sampler hasn't woken up for longer
+# than the slow callback threshold and grabs the loop thread's stack while it is still stuck, so blocking calls show
+# up with the code that made them. Spans time named pieces of work, such as command handlers and player phases.
+class PerfMonitor(object):
+
+    def __init__(self):
+        self.interval = None
+        self.slow_threshold = None
+
+        self.lag_histogram = [0] * (len(LAG_BUCKETS) + 1)
+        self.recent_lags = collections.deque(maxlen=600)
+        self.max_lag = 0.0
+
+        self.slow_callbacks = collections.deque(maxlen=20)
+        self.slow_callback_count = 0
+        self._lock = threading.Lock()
+
+        self.spans = collections.OrderedDict()
+
+        # perf_counter() when the process started, set by whoever knows it
+        self.started_at = None
+        self._first_command_done = False
+
+        self._last_tick = None
+        self._reported_tick = None
+        self._loop_thread_id = None
+        self._task = None
+
+    def is_running(self):
+        return self._task is not None
+
+    def start(self, interval=0.25, slow_threshold=0.25):
+        if self._task is not None:
+            return
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.perf_counter()
+        self._task = asyncio.ensure_future(self._sample_lag())
+
+        watchdog = threading.Thread(target=self._watch, name='perf-watchdog', daemon=True)
+        watchdog.start()
+
+    async def _sample_lag(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            self._record_lag(max(0.0, now - expected))
+
+            with self._lock:
+                if self._reported_tick == self._last_tick and self.slow_callbacks:
+                    # The watchdog caught this one while it was still blocking
+                    self.slow_callbacks[-1].duration = now - self._last_tick - self.interval
+                self._last_tick = now
+
+    def _record_lag(self, lag):
+        ms = lag * 1000
+        bucket = len(LAG_BUCKETS)
+        for i, bound in enumerate(LAG_BUCKETS):
+            if ms < bound:
+                bucket = i
+                break
+        self.lag_histogram[bucket] += 1
+        self.recent_lags.append(lag)
+        self.max_lag = max(self.max_lag, lag)
+
+    def _watch(self):
+        # Runs on its own thread, so it keeps going while the event loop is blocked
+        check_interval = max(0.05, self.slow_threshold / 2)
+        while True:
+            time.sleep(check_interval)
+
+            with self._lock:
+                tick = self._last_tick
+                if tick == self._reported_tick or time.perf_counter() - tick - self.interval < self.slow_threshold:
+                    continue
+                self._reported_tick = tick
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = traceback.format_stack(frame) if frame is not None else []
+            with self._lock:
+                self.slow_callbacks.append(SlowCallback(time.time(), stack))
+                self.slow_callback_count += 1
+            print('Event loop blocked for over {:.0f} ms in:\n{}'.format(self.slow_threshold * 1000,
+                                                                         ''.join(stack[-3:]).rstrip()))
+
+    def record(self, name, duration):
+        stats = self.spans.get(name)
+        if stats is None:
+            stats = self.spans[name] = SpanStats()
+        stats.add(duration)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        # Times the body of a with block, awaits included
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def command_finished(self):
+        # The first command handled after startup marks the point the bot became usable
+        if self._first_command_done or self.started_at is None:
+            return
+        self._first_command_done = True
+        duration = time.perf_counter() - self.started_at
+        self.record('startup to first command', duration)
+        print('First command handled {:.0f} ms after startup'.format(duration * 1000))
+
+    def get_lag_summary(self):
+        # (p50, p99, max) of the loop lag in seconds, over the recent samples except for max
+        lags = list(self.recent_lags)
+        return percentile(lags, 0.5), percentile(lags, 0.99), self.max_lag
+
+    def get_slow_callbacks(self):
+        with self._lock:
+            return list(self.slow_callbacks)
+
+
+# Shared by everything in the process, there is only ever one event loop to watch
+monitor = PerfMonitor()
+
+
+def timed_command(func):
+    # Wraps a command handler in a span named after the command. Goes below the commands decorator, which still sees
+    # the handler's own signature through functools.wraps
+    @functools.wraps(func)
+    async def wrapper(self, ctx, *args, **kwargs):
+        try:
+            with monitor.span('!' + ctx.command.qualified_name):
+                return await func(self, ctx, *args, **kwargs)
+        finally:
+            monitor.command_finished()
+    return wrapper
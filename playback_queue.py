@@ -0,0 +1,254 @@
+import asyncio
+import itertools
+import time
+
+# Entry ids are unique for the whole process, so they stay valid when entries move between lists on pause and resume
+_entry_ids = itertools.count(1)
+
+
+class QueueEntry(object):
+    __slots__ = ('id', 'video', 'prev', 'next')
+
+    def __init__(self, video):
+        self.id = next(_entry_ids)
+        self.video = video
+        self.prev = None
+        self.next = None
+
+
+# Doubly linked list of videos, each in an entry with a stable id.
+# Removing or moving an entry by id is O(1) apart from walking to a position in the middle, and a whole list can be
+# handed over to another one in O(1), which is what makes pausing and resuming a long queue cheap.
+class VideoList(object):
+
+    def __init__(self, videos=()):
+        self._head = None
+        self._tail = None
+        self._entries = {}
+        for video in videos:
+            self._link_last(QueueEntry(video))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        entry = self._head
+        while entry is not None:
+            yield entry.video
+            entry = entry.next
+
+    def entries(self):
+        entry = self._head
+        while entry is not None:
+            yield entry
+            entry = entry.next
+
+    def get_entry(self, entry_id):
+        return self._entries.get(entry_id)
+
+    def peek(self):
+        return self._head.video if self._head is not None else None
+
+    def _link_last(self, entry):
+        entry.prev, entry.next = self._tail, None
+        if self._tail is not None:
+            self._tail.next = entry
+        else:
+            self._head = entry
+        self._tail = entry
+        self._entries[entry.id] = entry
+
+    def _link_first(self, entry):
+        entry.prev, entry.next = None, self._head
+        if self._head is not None:
+            self._head.prev = entry
+        else:
+            self._tail = entry
+        self._head = entry
+        self._entries[entry.id] = entry
+
+    def _link_before(self, entry, before):
+        if before.prev is None:
+            self._link_first(entry)
+            return
+        entry.prev, entry.next = before.prev, before
+        before.prev.next = entry
+        before.prev = entry
+        self._entries[entry.id] = entry
+
+    def _unlink(self, entry):
+        if entry.prev is not None:
+            entry.prev.next = entry.next
+        else:
+            self._head = entry.next
+        if entry.next is not None:
+            entry.next.prev = entry.prev
+        else:
+            self._tail = entry.prev
+        entry.prev = entry.next = None
+        del self._entries[entry.id]
+
+    def _entry_at(self, position):
+        # Entry at 1 based position, walking from whichever end is closer
+        if position <= len(self) // 2:
+            entry = self._head
+            for _ in range(position - 1):
+                entry = entry.next
+        else:
+            entry = self._tail
+            for _ in range(len(self) - position):
+                entry = entry.prev
+        return entry
+
+    def append(self, video):
+        entry = QueueEntry(video)
+        self._link_last(entry)
+        return entry
+
+    def appendleft(self, video):
+        entry = QueueEntry(video)
+        self._link_first(entry)
+        return entry
+
+    def extend(self, videos):
+        for video in videos:
+            self.append(video)
+
+    def popleft(self):
+        # Takes the next video without waiting, None when the list is empty
+        if self._head is None:
+            return None
+        entry = self._head
+        self._unlink(entry)
+        return entry.video
+
+    def remove(self, entry_id):
+        # Returns the removed video, or None if there is no entry with that id
+        entry = self._entries.get(entry_id)
+        if entry is None:
+            return None
+        self._unlink(entry)
+        return entry.video
+
+    def move(self, entry_id, position):
+        # Moves an entry to a 1 based position, positions past the end move it to the end. False if there is no such
+        # entry
+        entry = self._entries.get(entry_id)
+        if entry is None:
+            return False
+        self._unlink(entry)
+        if position <= 1:
+            self._link_first(entry)
+        elif position > len(self):
+            self._link_last(entry)
+        else:
+            self._link_before(entry, self._entry_at(position))
+        return True
+
+    def clear(self):
+        self._head = self._tail = None
+        self._entries = {}
+
+    def detach(self):
+        # Moves every entry into a new list and leaves this one empty, without copying
+        videos = VideoList()
+        videos._head, videos._tail, videos._entries = self._head, self._tail, self._entries
+        self._head = self._tail = None
+        self._entries = {}
+        return videos
+
+    def attach(self, videos):
+        # Moves every entry of another list to the end of this one, leaving the other list empty
+        if videos._head is None:
+            return
+        if self._head is None:
+            self._head, self._entries = videos._head, videos._entries
+        else:
+            self._tail.next = videos._head
+            videos._head.prev = self._tail
+            self._entries.update(videos._entries)
+        self._tail = videos._tail
+        videos._head = videos._tail = None
+        videos._entries = {}
+
+
+# Awaitable FIFO of videos waiting to be played.
+# get() parks the consumer on an event instead of polling, so it wakes up the moment anything is enqueued.
+# Every enqueue stamps the video with the time it was queued so the player can log enqueue-to-spawn latency.
+# on_change is called after every mutation, so the contents can be persisted.
+class PlaybackQueue(VideoList):
+
+    def __init__(self, on_change=None):
+        super().__init__()
+        self._not_empty = asyncio.Event()
+        self._on_change = on_change
+
+    def _changed(self):
+        if self._head is not None:
+            self._not_empty.set()
+        else:
+            self._not_empty.clear()
+        if self._on_change:
+            self._on_change()
+
+    def append(self, video):
+        video.queued_at = time.perf_counter()
+        entry = super().append(video)
+        self._changed()
+        return entry
+
+    def appendleft(self, video):
+        video.queued_at = time.perf_counter()
+        entry = super().appendleft(video)
+        self._changed()
+        return entry
+
+    def extend(self, videos):
+        # One change notification for the whole batch
+        queued_at = time.perf_counter()
+        for video in videos:
+            video.queued_at = queued_at
+            super().append(video)
+        self._changed()
+
+    def popleft(self):
+        video = super().popleft()
+        if video is not None:
+            self._changed()
+        return video
+
+    def remove(self, entry_id):
+        video = super().remove(entry_id)
+        if video is not None:
+            self._changed()
+        return video
+
+    def move(self, entry_id, position):
+        moved = super().move(entry_id, position)
+        if moved:
+            self._changed()
+        return moved
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+    def detach(self):
+        videos = super().detach()
+        self._changed()
+        return videos
+
+    def attach(self, videos):
+        if videos.peek() is not None:
+            # Only the video that plays next has its enqueue-to-spawn latency logged
+            videos.peek().queued_at = time.perf_counter()
+        super().attach(videos)
+        self._changed()
+
+    async def get(self):
+        while self._head is None:
+            await self._not_empty.wait()
+        entry = self._head
+        self._unlink(entry)
+        self._changed()
+        return entry.video
@@ -0,0 +1,157 @@
+import collections
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Regions are considered to still be in the page cache for this long after being prefetched
+REGION_TTL = 600
+
+MODE_FADVISE = 'fadvise'
+MODE_READ = 'read'
+
+
+# Pulls regions of upcoming video files into the page cache on a background thread, so FFmpeg doesn't stall on a
+# cold (e.g. network) mount when the next video starts or a seek lands somewhere new.
+# In fadvise mode the kernel is asked to read ahead with posix_fadvise(WILLNEED), which returns immediately but is
+# only a hint. Read mode actually reads the region in chunks and throws the data away, which is slower to issue but
+# guarantees the data is cached, and is the fallback on platforms without posix_fadvise.
+#
+# When playback starts, the region it starts in counts as a hit if it was prefetched in time, late if the prefetch
+# was still running, and a miss otherwise.
+class Prefetcher(object):
+
+    def __init__(self, head_bytes=64 * 1024 ** 2, seek_bytes=32 * 1024 ** 2, tail_bytes=2 * 1024 ** 2,
+                 mode=MODE_READ, max_regions=64, chunk_size=1024 ** 2):
+        self._head_bytes = head_bytes
+        self._seek_bytes = seek_bytes
+        self._tail_bytes = tail_bytes
+        self._mode = mode if hasattr(os, 'posix_fadvise') else MODE_READ
+        self._chunk_size = chunk_size
+
+        # Two workers, so a seek doesn't have to wait behind the head of the next video
+        self._executor = ThreadPoolExecutor(max_workers=2)
+
+        # (path, offset, length) -> completion time, or None while in flight. Oldest first
+        self._regions = collections.OrderedDict()
+        self._max_regions = max_regions
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.late = 0
+        self.misses = 0
+        self.bytes_prefetched = 0
+        self.prefetch_time = 0.0
+
+    def _read_region(self, path, offset, length):
+        start = time.perf_counter()
+        try:
+            with open(path, 'rb', buffering=0) as f:
+                if self._mode == MODE_FADVISE:
+                    os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_WILLNEED)
+                    read = length
+                else:
+                    f.seek(offset)
+                    read = 0
+                    while read < length:
+                        data = f.read(min(self._chunk_size, length - read))
+                        if not data:
+                            break
+                        read += len(data)
+        except OSError as e:
+            print('Prefetch of {} failed: {}'.format(path, e))
+            with self._lock:
+                self._regions.pop((path, offset, length), None)
+            return
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            if (path, offset, length) in self._regions:
+                self._regions[(path, offset, length)] = time.time()
+            self.bytes_prefetched += read
+            self.prefetch_time += elapsed
+
+    def _claim(self, path, offset, length):
+        # Returns False when the region is already cached or being prefetched
+        key = (path, offset, length)
+        with self._lock:
+            if key in self._regions:
+                completed = self._regions[key]
+                if completed is None or time.time() - completed < REGION_TTL:
+                    return False
+            self._regions[key] = None
+            self._regions.move_to_end(key)
+            while len(self._regions) > self._max_regions:
+                self._regions.popitem(last=False)
+        return True
+
+    def _get_region(self, size, position, duration):
+        # Byte range to prefetch for playback starting at position (seconds). Without an index mapping times to
+        # byte offsets, assume a constant bitrate and keep a quarter of the window before the estimate
+        if not position or not duration:
+            return 0, min(self._head_bytes, size)
+
+        estimate = int(size * min(position / duration, 1.0))
+        offset = max(0, estimate - self._seek_bytes // 4)
+        return offset, min(self._seek_bytes, size - offset)
+
+    def _prefetch(self, path, position, duration):
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            return
+
+        offset, length = self._get_region(size, position, duration)
+        regions = [(offset, length)]
+
+        # Seeking also needs the container's index, which MKV and many MP4s keep at the end of the file
+        if offset > 0 and self._tail_bytes:
+            tail = min(self._tail_bytes, size)
+            regions.append((size - tail, tail))
+
+        for offset, length in regions:
+            if self._claim(path, offset, length):
+                self._read_region(path, offset, length)
+
+    def prefetch(self, path, position=0.0, duration=None):
+        # Queue a prefetch for playback of path starting at position (seconds), returns immediately.
+        # Even the stat happens on the worker, a cold network mount can take a while to answer it
+        self._executor.submit(self._prefetch, path, position, duration)
+
+    def _record_playback(self, path, position, duration, regions, now):
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            return
+
+        target = int(size * min(position / duration, 1.0)) if position and duration else 0
+        in_flight = False
+        for offset, length, completed in regions:
+            if not offset <= target < offset + length:
+                continue
+            if completed is None:
+                in_flight = True
+            elif now - completed < REGION_TTL:
+                with self._lock:
+                    self.hits += 1
+                return
+
+        with self._lock:
+            if in_flight:
+                self.late += 1
+            else:
+                self.misses += 1
+
+    def record_playback(self, path, position=0.0, duration=None):
+        # Called as playback starts, to count whether the data it starts on was prefetched in time. The regions are
+        # looked at now, but the stat needed to place the start position in the file happens on the worker
+        with self._lock:
+            regions = [(offset, length, completed)
+                       for (region_path, offset, length), completed in self._regions.items() if region_path == path]
+        self._executor.submit(self._record_playback, path, position, duration, regions, time.time())
+
+    def get_throughput(self):
+        # Bytes per second achieved by prefetch reads (meaningful in read mode only)
+        if not self.prefetch_time:
+            return None
+        return self.bytes_prefetched / self.prefetch_time
@@ -0,0 +1,328 @@
+import asyncio
+import collections
+import subprocess
+import time
+
+# Extra room left between segments so timestamps never run backwards when one encoder hands over to the next
+SEGMENT_GAP = 0.1
+
+# Minimum seconds between restarts of a relay FFmpeg whose endpoint keeps failing
+RESTART_DELAY = 5
+
+# Encoder output is only ever cut between MPEG-TS packets
+TS_PACKET_SIZE = 188
+
+# Output a relay can fall behind by before it is dropped (and restarted after RESTART_DELAY)
+MAX_BUFFERED_BYTES = 16 * 1024 ** 2
+
+
+# Bounded buffer between the encoder's output and one relay FFmpeg's stdin.
+# Its own task drains it into the pipe, so a relay that stops accepting data only holds up itself instead of the
+# encoder and every other relay.
+class RelayPipe(object):
+
+    def __init__(self, index, process, max_bytes):
+        self._index = index
+        self._process = process
+        self._max_bytes = max_bytes
+
+        self._chunks = collections.deque()
+        self._buffered = 0
+        self._has_data = asyncio.Event()
+        self._closing = False
+        self._task = asyncio.ensure_future(self._run())
+
+    def write(self, data):
+        # Returns False without buffering anything when the relay is too far behind to take data
+        if self._buffered + len(data) > self._max_bytes:
+            return False
+        self._chunks.append(data)
+        self._buffered += len(data)
+        self._has_data.set()
+        return True
+
+    def close(self):
+        # Closes the relay's stdin once everything buffered has been written
+        self._closing = True
+        self._has_data.set()
+
+    def abort(self):
+        self._task.cancel()
+        self._chunks.clear()
+        self._buffered = 0
+
+    async def _run(self):
+        stdin = self._process.stdin
+        try:
+            while True:
+                await self._has_data.wait()
+                self._has_data.clear()
+                while self._chunks:
+                    data = self._chunks.popleft()
+                    self._buffered -= len(data)
+                    stdin.write(data)
+                    await stdin.drain()
+                if self._closing:
+                    stdin.close()
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            print('Relay FFmpeg {} pipe closed'.format(self._index))
+
+
+# Long-lived FFmpegs that own the RTMP connections.
+# Per-video encoders write MPEG-TS into our stdin pipes instead of connecting to the RTMP server themselves, so the
+# FLV streams (and every viewer's player) survive transitions between videos and seeks. Each encoder is given an
+# output timestamp offset that continues where the previous one stopped, keeping the relayed timestamps monotonic.
+#
+# outputs is a list of variants, each a list of RTMP URLs. The encoder's MPEG-TS carries one video and one audio
+# stream per variant, so every variant gets its own relay that picks out its pair of streams and sends them to all
+# of that variant's URLs. Relays are independent processes and variants with several URLs use the tee muxer with
+# onfail=ignore, so one endpoint going away never takes the others down with it. Each relay is fed through its own
+# RelayPipe, and a relay that stalls without exiting is dropped once its buffer fills up, then restarted.
+#
+# Each encoder's output is a segment. Normally a segment goes live when it begins, but a standby segment (a
+# replacement encoder started for a seek or skip while the current one keeps streaming) only goes live once its
+# encoder produces data, at which point the previous encoder's output stops being relayed.
+class RtmpRelay(object):
+
+    def __init__(self, outputs, idle_timeout=30, max_buffered_bytes=MAX_BUFFERED_BYTES):
+        if isinstance(outputs, str):
+            outputs = [[outputs]]
+        self._outputs = [list(urls) for urls in outputs]
+        self._idle_timeout = idle_timeout
+        self._max_buffered_bytes = max_buffered_bytes
+
+        self._processes = [None] * len(self._outputs)
+        self._pipes = [None] * len(self._outputs)
+        self._started_at = [None] * len(self._outputs)
+        self._idle_task = None
+
+        # Stream time the live segment started at, and when its first data arrived
+        self._stream_clock = 0.0
+        self._segment_start = None
+
+        self._next_segment_id = 0
+        self._live_segment = None
+        # Segment id -> timestamp offset, for standby segments that haven't gone live yet
+        self._standby_offsets = {}
+        # While a standby is starting, live output past this point would overlap the standby's timestamps
+        self._live_deadline = None
+
+        # Time the previous encoder delivered its last byte, used to measure stalls at transitions
+        self._last_segment_end = None
+        self.transition_stalls = collections.deque(maxlen=100)
+
+    def _is_variant_running(self, index):
+        process = self._processes[index]
+        return process is not None and process.returncode is None
+
+    def is_running(self):
+        return any(self._is_variant_running(i) for i in range(len(self._processes)))
+
+    def _get_output_params(self, index):
+        urls = self._outputs[index]
+        if len(urls) == 1:
+            return ['-flvflags', 'no_duration_filesize', '-f', 'flv', urls[0]]
+
+        # Failed slaves are dropped while the rest keep streaming, they come back when the relay is next restarted
+        return ['-f', 'tee', '|'.join('[f=flv:flvflags=no_duration_filesize:onfail=ignore]{}'.format(url)
+                                      for url in urls)]
+
+    async def _start(self, index):
+        # ffmpy3 can't hand us a stdin pipe without also writing input to it, so spawn the process directly
+        cmd = [
+            'ffmpeg', '-hide_banner', '-loglevel', 'warning',
+            '-f', 'mpegts', '-i', 'pipe:0',
+
+            # This variant's streams out of the encoder's output
+            '-map', '0:v:{}'.format(index),
+            '-map', '0:a:{}'.format(index),
+
+            # Packets are already encoded, just remux them
+            '-c', 'copy',
+
+            # ADTS AAC from MPEG-TS has to be converted for FLV
+            '-bsf:a', 'aac_adtstoasc',
+        ] + self._get_output_params(index)
+
+        print('Starting relay FFmpeg {}'.format(index))
+        print(subprocess.list2cmdline(cmd))
+        self._started_at[index] = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.PIPE)
+        self._processes[index] = process
+        self._pipes[index] = RelayPipe(index, process, self._max_buffered_bytes)
+
+    async def _stop(self, index):
+        process = self._processes[index]
+        pipe = self._pipes[index]
+        self._pipes[index] = None
+        if not self._is_variant_running(index):
+            # Already gone, so nothing buffered can be delivered any more
+            if pipe is not None:
+                pipe.abort()
+            return
+
+        print('Stopping relay FFmpeg {}'.format(index))
+        pipe.close()
+        try:
+            await asyncio.wait_for(process.wait(), 5)
+        except asyncio.TimeoutError:
+            process.terminate()
+            await process.wait()
+        finally:
+            # The writer has finished by now unless the relay had to be terminated
+            pipe.abort()
+
+    def _drop(self, index):
+        # Gives up on a relay that has stopped taking data, the RESTART_DELAY countdown starts now
+        print('Relay FFmpeg {} fell more than {} MB behind, dropping it'.format(
+            index, self._max_buffered_bytes // 1024 ** 2))
+        self._pipes[index].abort()
+        try:
+            self._processes[index].kill()
+        except ProcessLookupError:
+            pass
+        self._processes[index] = None
+        self._pipes[index] = None
+        self._started_at[index] = time.perf_counter()
+
+    async def stop(self):
+        if self._idle_task:
+            self._idle_task.cancel()
+            self._idle_task = None
+
+        for i in range(len(self._processes)):
+            await self._stop(i)
+
+    async def _stop_when_idle(self):
+        await asyncio.sleep(self._idle_timeout)
+        self._idle_task = None
+        await self.stop()
+
+    async def begin_segment(self, standby_lead=None):
+        # Returns (segment id, timestamp offset) for the next encoder.
+        # A regular segment goes live right away and continues the stream clock. A standby segment starts
+        # standby_lead seconds ahead of the live stream's current position, which should cover its encoder's startup
+        if self._idle_task:
+            self._idle_task.cancel()
+            self._idle_task = None
+
+        if not self.is_running():
+            # Fresh RTMP connections start their timestamps from zero
+            self._stream_clock = 0.0
+            self._segment_start = None
+            self._last_segment_end = None
+
+        for i in range(len(self._processes)):
+            if not self._is_variant_running(i):
+                await self._start(i)
+
+        self._next_segment_id += 1
+        segment_id = self._next_segment_id
+
+        if standby_lead is None:
+            self._go_live(segment_id, self._stream_clock)
+            return segment_id, self._stream_clock
+
+        offset = self.get_live_position() + standby_lead
+        self._standby_offsets[segment_id] = offset
+        self._live_deadline = time.perf_counter() + standby_lead
+        return segment_id, offset
+
+    def get_live_position(self):
+        # Stream time the live segment has reached, going by the wall clock (encoders run at realtime with -re)
+        if self._segment_start is None:
+            return self._stream_clock
+        return self._stream_clock + time.perf_counter() - self._segment_start
+
+    def _go_live(self, segment_id, offset, standby=False):
+        if self._idle_task:
+            # The previous encoder may have finished while this one was on standby
+            self._idle_task.cancel()
+            self._idle_task = None
+
+        switching = standby and self._live_segment is not None
+        self._live_segment = segment_id
+        self._stream_clock = offset
+        self._segment_start = None
+        self._live_deadline = None
+        if switching:
+            # Nothing went quiet, the previous encoder streamed right up to the switch
+            self._last_segment_end = None
+
+    def end_segment(self, segment_id, media_duration):
+        # Advance the clock past everything the finished encoder produced, unless its output had already been
+        # replaced by a standby segment
+        self._standby_offsets.pop(segment_id, None)
+        if segment_id != self._live_segment:
+            return
+
+        elapsed = time.perf_counter() - self._segment_start if self._segment_start is not None else 0.0
+        self._stream_clock += max(media_duration, elapsed) + SEGMENT_GAP
+        self._segment_start = None
+        self._last_segment_end = time.perf_counter()
+        self._live_segment = None
+
+        # Keep the connections open for a while in case something else gets queued
+        self._idle_task = asyncio.ensure_future(self._stop_when_idle())
+
+    async def feed(self, reader, segment_id, on_first_data=None, chunk_size=65536):
+        # Copy an encoder's stdout into every relay until the encoder exits.
+        # on_first_data(went_live) is called with the encoder's first data (or with False at EOF if there was none)
+        remainder = b''
+        received = False
+
+        while True:
+            data = await reader.read(chunk_size)
+            if not data:
+                break
+
+            if not received:
+                received = True
+                if segment_id in self._standby_offsets:
+                    self._go_live(segment_id, self._standby_offsets.pop(segment_id), standby=True)
+                if on_first_data:
+                    on_first_data(segment_id == self._live_segment)
+
+            # Superseded by a standby segment, or past the point where the standby's timestamps start
+            if segment_id != self._live_segment:
+                continue
+            if self._live_deadline is not None and time.perf_counter() >= self._live_deadline:
+                continue
+
+            # Only whole packets, so the output can switch to another encoder between any two chunks
+            data = remainder + data
+            cut = len(data) - len(data) % TS_PACKET_SIZE
+            data, remainder = data[:cut], data[cut:]
+            if not data:
+                continue
+
+            if self._segment_start is None:
+                self._segment_start = time.perf_counter()
+                if self._last_segment_end is not None:
+                    stall = self._segment_start - self._last_segment_end
+                    self.transition_stalls.append(stall)
+                    print('Transition stall: {:.0f} ms'.format(stall * 1000))
+
+            # Never waits on the relays themselves, so the encoder's stdout keeps draining whatever they do
+            for i in range(len(self._processes)):
+                if not self._is_variant_running(i):
+                    # The RTMP side went away (e.g. server restart), so reconnect and carry on, but don't hammer an
+                    # endpoint that is refusing connections. The other variants keep going in the meantime
+                    if time.perf_counter() - self._started_at[i] < RESTART_DELAY:
+                        continue
+                    print('Relay FFmpeg {} exited, restarting'.format(i))
+                    await self._start(i)
+                pipe = self._pipes[i]
+                if pipe is None:
+                    # Being stopped
+                    continue
+                if not pipe.write(data):
+                    self._drop(i)
+
+        if not received:
+            # A standby that never produced anything, let the live encoder carry on as if nothing happened
+            if self._standby_offsets.pop(segment_id, None) is not None:
+                self._live_deadline = None
+            if on_first_data:
+                on_first_data(False)
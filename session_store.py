@@ -0,0 +1,98 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Crash-safe record of every session's queue, pause backup and playback position, so a restarted bot can pick up
+# where it left off. Queue snapshots are saved on every change and the playback position is checkpointed every few
+# seconds. Writes happen on a single worker thread, which keeps them in order and off the event loop, and a burst of
+# changes to one session (e.g. a whole directory being queued) collapses into a single write of the latest state.
+class SessionStore(object):
+
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(db_dir, exist_ok=True)
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+        # Only ever used from the worker thread after this point
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS queue_state ('
+                           'session TEXT PRIMARY KEY, '
+                           'queue TEXT NOT NULL, '
+                           'backup TEXT, '
+                           'updated_at REAL NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS playback_state ('
+                           'session TEXT PRIMARY KEY, '
+                           'video TEXT NOT NULL, '
+                           'position REAL NOT NULL, '
+                           'updated_at REAL NOT NULL)')
+        self._conn.commit()
+
+        # Latest unsaved queue snapshot per session, picked up by the write already scheduled for that session
+        self._pending_queues = {}
+        self._pending_lock = threading.Lock()
+
+    def _load(self, session):
+        row = self._conn.execute('SELECT video, position FROM playback_state WHERE session = ?',
+                                 (session,)).fetchone()
+        playback = (json.loads(row[0]), row[1]) if row else None
+
+        row = self._conn.execute('SELECT queue, backup FROM queue_state WHERE session = ?', (session,)).fetchone()
+        queue, backup = [], None
+        if row:
+            queue = json.loads(row[0])
+            backup = json.loads(row[1]) if row[1] is not None else None
+
+        return playback, queue, backup
+
+    async def load(self, session):
+        # Returns ((video, position) or None, queued videos, paused videos or None) as saved for session
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._load, session)
+
+    def _write_queue(self, session):
+        with self._pending_lock:
+            queue, backup, serialize = self._pending_queues.pop(session)
+        queue = [serialize(video) for video in queue]
+        if backup is not None:
+            backup = [serialize(video) for video in backup]
+        self._conn.execute('INSERT OR REPLACE INTO queue_state (session, queue, backup, updated_at) '
+                           'VALUES (?, ?, ?, ?)',
+                           (session, json.dumps(queue), json.dumps(backup) if backup is not None else None,
+                            time.time()))
+        self._conn.commit()
+
+    def save_queue(self, session, queue, backup, serialize):
+        # queue is a list of videos, backup is a list or None when the session isn't paused. serialize turns a video
+        # into something JSON can store, it runs on the writer thread so long queues don't hold up the event loop
+        with self._pending_lock:
+            scheduled = session in self._pending_queues
+            self._pending_queues[session] = (queue, backup, serialize)
+        if not scheduled:
+            self._executor.submit(self._write_queue, session)
+
+    def _write_playback(self, session, video, position):
+        if video is None:
+            self._conn.execute('DELETE FROM playback_state WHERE session = ?', (session,))
+        else:
+            self._conn.execute('INSERT OR REPLACE INTO playback_state (session, video, position, updated_at) '
+                               'VALUES (?, ?, ?, ?)', (session, json.dumps(video), position, time.time()))
+        self._conn.commit()
+
+    def save_playback(self, session, video, position):
+        self._executor.submit(self._write_playback, session, video, position)
+
+    def clear_playback(self, session):
+        self._executor.submit(self._write_playback, session, None, None)
+
+    def close(self):
+        # Waits for outstanding writes
+        self._executor.shutdown(wait=True)
+        self._conn.close()
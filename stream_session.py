@@ -0,0 +1,252 @@
+import asyncio
+import os
+
+import file_explorer
+import media_player
+import playback_queue
+
+# Seconds queue changes are collected for before the queue is saved, so a burst of edits costs one save
+QUEUE_SAVE_DELAY = 0.5
+
+
+def _serialize_video(video):
+    # Everything needed to queue the video again, probe data comes back from the metadata cache
+    return {
+        'path': video.absolute_path,
+        'name': video.name,
+        'seek_time': video.seek_time,
+        'audio_track': video.audio_track,
+        'subtitle_track': video.subtitle_track,
+    }
+
+
+# Everything one stream needs: its own queue, working directory and player.
+# Sessions only share the process-wide caches and the encoder pool, so several channels can each run an independent
+# stream from one bot. The queue is worked through by a background task that holds the session's encoder slots for
+# as long as there is something to play.
+# With a session store, the queue, pause backup and playback position are persisted as they change and restored when
+# the session starts, resuming the interrupted video from its last checkpoint.
+class StreamSession(object):
+
+    def __init__(self, name, stream_url, media_directory, player, encoder_pool, on_playing=None, store=None,
+                 checkpoint_interval=5):
+        self.name = name
+        self.stream_url = stream_url
+
+        self.file_explorer = file_explorer.FileExplorer(media_directory)
+        self.media_player = player
+        self.media_queue = playback_queue.PlaybackQueue(on_change=self._queue_changed)
+
+        # Videos taken off the queue by !stream pause (a playback_queue.VideoList), put back by !stream resume
+        self._backup_queue = None
+
+        # Directories and files from the last !ls or !find, for selecting entries by number
+        self.last_ls_cache = (None, None)
+        # Directory and page last shown by !ls, for !ls next and !ls prev
+        self.ls_page = (None, 1)
+
+        # Video currently being played, None while idle or waiting for an encoder
+        self.now_playing = None
+
+        self._encoder_pool = encoder_pool
+        self._on_playing = on_playing
+        self._store = store
+        self._checkpoint_interval = checkpoint_interval
+        self._task = None
+        self._save_handle = None
+
+    @property
+    def backup_queue(self):
+        return self._backup_queue
+
+    @backup_queue.setter
+    def backup_queue(self, videos):
+        self._backup_queue = videos
+        self._save_queue()
+
+    def _save_queue(self):
+        # Queue operations are O(1), so saving only schedules a save once the changes settle
+        if self._store and self._save_handle is None:
+            self._save_handle = asyncio.get_event_loop().call_later(QUEUE_SAVE_DELAY, self._flush_queue)
+
+    def _flush_queue(self):
+        # Only the list of videos is copied here, the store serializes them on its writer thread
+        self._save_handle = None
+        backup = list(self._backup_queue) if self._backup_queue is not None else None
+        self._store.save_queue(self.name, list(self.media_queue), backup, _serialize_video)
+
+    def _queue_changed(self):
+        self._save_queue()
+
+        # Get the start of whatever plays next off the disk while the current video is still playing
+        next_video = self.media_queue.peek()
+        if next_video is not None:
+            self.media_player.prefetch_video(next_video)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        if self._store:
+            await self._restore()
+            asyncio.ensure_future(self._checkpoint_playback())
+        await self._process_media_queue()
+
+    async def _load_video(self, data):
+        # None for entries that can't be restored, which are dropped rather than taking the whole restore down
+        try:
+            if not os.path.isfile(data['path']):
+                print('[{}] Not restoring missing file {}'.format(self.name, data['path']))
+                return None
+
+            media_info = await self.media_player.get_media_info(data['path'])
+            return media_player.Video(data['path'], name=data['name'], seek_time=data['seek_time'],
+                                      audio_track=data['audio_track'], subtitle_track=data['subtitle_track'],
+                                      media_info=media_info)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print('[{}] Not restoring {}: {}'.format(self.name, data.get('path') if isinstance(data, dict) else data,
+                                                     e))
+            return None
+
+    async def _restore(self):
+        try:
+            playback, queue, backup = await self._store.load(self.name)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print('[{}] Failed to load saved state, starting with an empty queue: {}'.format(self.name, e))
+            return
+
+        resumed = None
+        if playback:
+            video, position = playback
+            video['seek_time'] = position
+            resumed = await self._load_video(video)
+
+        # Probe data comes from the metadata cache, so this is quick even for a long queue
+        videos = await asyncio.gather(*[self._load_video(data) for data in queue])
+        videos = ([resumed] if resumed is not None else []) + [video for video in videos if video is not None]
+        backup_videos = None
+        if backup is not None:
+            backup_videos = await asyncio.gather(*[self._load_video(data) for data in backup])
+            backup_videos = [video for video in backup_videos if video is not None]
+
+        for video in videos:
+            self.media_player.prepare_video(video)
+        self.media_queue.extend(videos)
+        if backup_videos is not None:
+            self.backup_queue = playback_queue.VideoList(backup_videos)
+
+        if videos or backup_videos:
+            print('[{}] Restored {} queued and {} paused videos{}'.format(
+                self.name, len(videos), len(backup_videos or []),
+                ', resuming {} at {}'.format(resumed.name, self.media_player.convert_secs_to_str(
+                    resumed.seek_time)) if resumed is not None else ''))
+
+    async def _checkpoint_playback(self):
+        while True:
+            await asyncio.sleep(self._checkpoint_interval)
+            video = self.now_playing
+            if video is not None and self.media_player.get_current_video() is video:
+                position, _ = self.media_player.get_video_time()
+                self._store.save_playback(self.name, _serialize_video(video), position)
+
+    def can_start_stream(self):
+        # False when the encoder pool is full and enough other sessions are already waiting for it
+        return self._encoder_pool.can_admit(self, self.media_player.get_encoder_count())
+
+    def must_wait_for_encoder(self):
+        # True when this session's queue can't start playing until another session frees up encoders
+        return not self._encoder_pool.is_holding(self) and \
+            not self._encoder_pool.can_acquire_now(self.media_player.get_encoder_count())
+
+    async def _set_now_playing(self, video):
+        self.now_playing = video
+        if self._store and video is None:
+            self._store.clear_playback(self.name)
+        if self._on_playing:
+            await self._on_playing(self)
+
+    async def _switch_to(self, video):
+        # Hands the stream over to video without stopping it, returns the switch time or None if that didn't work.
+        # The standby encoder runs next to the current one until the switch, so it needs encoder slots of its own for
+        # that long. When none are free the caller falls back to stopping and restarting within the session's slots
+        standby_owner = (self, 'standby')
+        if not self._encoder_pool.try_acquire(standby_owner, self.media_player.get_encoder_count()):
+            print('[{}] No free encoder for a standby, restarting instead'.format(self.name))
+            return None
+        try:
+            latency = await self.media_player.switch_to(video)
+        finally:
+            self._encoder_pool.release(standby_owner)
+
+        if latency is not None:
+            await self._set_now_playing(video)
+            if self._store:
+                self._store.save_playback(self.name, _serialize_video(video), video.seek_time)
+        return latency
+
+    async def seek(self, video, seek_time):
+        # Restarts the current video at seek_time. A standby encoder takes over once it is ready, so the stream keeps
+        # going in the meantime. Returns the switch time, or None when the player had to be stopped and restarted
+        video = video.with_seek_time(seek_time)
+        latency = await self._switch_to(video)
+        if latency is None and self.media_player.is_video_playing():
+            self.media_queue.appendleft(video)
+            await self.media_player.stop_video()
+        return latency
+
+    async def skip(self):
+        # Moves on to the next queued video, the same way seek() does
+        video = self.media_queue.peek()
+        if video is not None:
+            latency = await self._switch_to(video)
+            if latency is not None:
+                # Still at the head, nothing else takes videos off the queue while the player is busy
+                if self.media_queue.peek() is video:
+                    self.media_queue.popleft()
+                return latency
+
+        if self.media_player.is_video_playing():
+            await self.media_player.stop_video()
+        return None
+
+    async def _process_media_queue(self):
+        while True:
+            video = await self.media_queue.get()
+
+            # Off the queue from here on, so it has to be recorded as playing even while it waits for an encoder
+            if self._store:
+                self._store.save_playback(self.name, _serialize_video(video), video.seek_time)
+
+            try:
+                await self._encoder_pool.acquire(self, self.media_player.get_encoder_count())
+
+                await self._set_now_playing(video)
+                await self.media_player.play_video(video)
+            except FileNotFoundError as e:
+                print('[{}] {}'.format(self.name, e))
+            except asyncio.CancelledError:
+                # Shutting down, so leave the playback checkpoint in place for the next start
+                self._encoder_pool.release(self)
+                raise
+            except Exception as e:
+                # Skip the video rather than letting the session task die while holding its encoder slots. The slots
+                # go back to the pool, the next video waits its turn for them again
+                print('[{}] Failed to play {}: {!r}'.format(self.name, video.name, e))
+                self._encoder_pool.release(self)
+
+            try:
+                await self._set_now_playing(None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print('[{}] Failed to update now playing: {!r}'.format(self.name, e))
+
+            # Hand the slots over to other sessions once there is nothing left to play (seeks and skips
+            # requeue before stopping the player, so they keep their slots)
+            if not len(self.media_queue):
+                self._encoder_pool.release(self)
@@ -0,0 +1,147 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Embedded subtitle tracks (and the fonts attached to the container) extracted to small standalone files.
+# Pointing the subtitles filter at the source container makes libass demux the whole file on every start and seek,
+# whereas an extracted .ass file loads instantly. Entries are keyed by the source path, size and mtime plus the track,
+# and the least recently used entries are evicted to stay within the disk budget.
+class SubtitleCache(object):
+
+    def __init__(self, cache_dir, max_bytes=1024 ** 3, max_workers=1):
+        # FFmpeg runs from a scratch directory, so every path handed to it has to be absolute
+        self._cache_dir = os.path.abspath(cache_dir)
+        self._max_bytes = max_bytes
+        os.makedirs(self._cache_dir, exist_ok=True)
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._pending = {}
+
+    def _get_entry_dir(self, absolute_path):
+        st = os.stat(absolute_path)
+        key_data = '{}\0{}\0{}'.format(absolute_path, st.st_size, st.st_mtime_ns)
+        return os.path.join(self._cache_dir, hashlib.sha1(key_data.encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def _get_subtitle_file(entry_dir, subtitle_track):
+        return os.path.join(entry_dir, 'track_{}.ass'.format(subtitle_track))
+
+    def _lookup(self, absolute_path, subtitle_track):
+        absolute_path = os.path.abspath(absolute_path)
+        try:
+            entry_dir = self._get_entry_dir(absolute_path)
+        except OSError:
+            return None
+
+        subtitle_file = self._get_subtitle_file(entry_dir, subtitle_track)
+        fonts_dir = os.path.join(entry_dir, 'fonts')
+        if os.path.exists(subtitle_file) and os.path.isdir(fonts_dir):
+            # Touch the entry so LRU eviction sees it as recently used
+            try:
+                os.utime(entry_dir)
+            except OSError:
+                pass
+            return subtitle_file, fonts_dir
+        return None
+
+    def _extract(self, absolute_path, subtitle_track):
+        absolute_path = os.path.abspath(absolute_path)
+        cached = self._lookup(absolute_path, subtitle_track)
+        if cached:
+            return cached
+
+        entry_dir = self._get_entry_dir(absolute_path)
+        subtitle_file = self._get_subtitle_file(entry_dir, subtitle_track)
+        fonts_dir = os.path.join(entry_dir, 'fonts')
+        os.makedirs(entry_dir, exist_ok=True)
+
+        # Attachments are dumped into the working directory, so run FFmpeg from a scratch fonts directory
+        extract_fonts = not os.path.isdir(fonts_dir)
+        partial_fonts_dir = fonts_dir + '.partial'
+        shutil.rmtree(partial_fonts_dir, True)
+        os.makedirs(partial_fonts_dir)
+
+        cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-y']
+        if extract_fonts:
+            cmd += ['-dump_attachment:t', '']
+        cmd += [
+            '-i', absolute_path,
+            # Tracks are 1 indexed in the bot, but 0 indexed in FFmpeg
+            '-map', '0:s:{}'.format(subtitle_track - 1),
+            '-c:s', 'ass',
+            '-f', 'ass', subtitle_file + '.tmp'
+        ]
+
+        start = time.perf_counter()
+        try:
+            subprocess.run(cmd, cwd=partial_fonts_dir, stdin=subprocess.DEVNULL, check=True)
+            os.replace(subtitle_file + '.tmp', subtitle_file)
+            if extract_fonts:
+                os.rename(partial_fonts_dir, fonts_dir)
+        finally:
+            shutil.rmtree(partial_fonts_dir, True)
+
+        print('Extracted subtitle track {} of {} in {:.1f} s'.format(
+            subtitle_track, os.path.basename(absolute_path), time.perf_counter() - start))
+
+        os.utime(entry_dir)
+        self._evict(entry_dir)
+        return subtitle_file, fonts_dir
+
+    @staticmethod
+    def _get_dir_size(path):
+        size = 0
+        for dir_path, _, file_names in os.walk(path):
+            size += sum(os.path.getsize(os.path.join(dir_path, name)) for name in file_names)
+        return size
+
+    def _evict(self, keep_dir):
+        # Runs on the extraction worker, so it never races an extraction. keep_dir was just extracted and stays
+        entries = []
+        for entry in os.scandir(self._cache_dir):
+            if entry.is_dir():
+                entries.append((entry.stat().st_mtime, entry.path, self._get_dir_size(entry.path)))
+
+        total_bytes = sum(size for _, _, size in entries)
+        for _, entry_dir, size in sorted(entries):
+            if total_bytes <= self._max_bytes:
+                break
+            if entry_dir == keep_dir:
+                continue
+            shutil.rmtree(entry_dir, True)
+            total_bytes -= size
+            print('Evicted extracted subtitles {} ({} bytes)'.format(os.path.basename(entry_dir), size))
+
+    def _extract_logged(self, absolute_path, subtitle_track):
+        try:
+            return self._extract(absolute_path, subtitle_track)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('Failed to extract subtitle track {} of {}: {}'.format(
+                subtitle_track, os.path.basename(absolute_path), e))
+            return None
+
+    def extract(self, absolute_path, subtitle_track):
+        # Start extracting in the background, returns a future that resolves to (subtitle file, fonts dir) or None
+        key = (os.path.abspath(absolute_path), subtitle_track)
+
+        future = self._pending.get(key)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(self._executor, self._extract_logged, absolute_path, subtitle_track)
+            self._pending[key] = future
+            future.add_done_callback(lambda _: self._pending.pop(key, None))
+
+        return future
+
+    async def get(self, absolute_path, subtitle_track):
+        # Only returns subtitles that have already been extracted; never waits on an extraction
+        if (os.path.abspath(absolute_path), subtitle_track) in self._pending:
+            return None
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._lookup, absolute_path, subtitle_track)
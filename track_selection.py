@@ -0,0 +1,54 @@
+# Picks matching audio/subtitle tracks across a batch of videos, so a track choice made once (e.g. Japanese audio
+# with the "Full" English subtitles) applies to every episode even when the track order differs between files.
+
+AUDIO = 'Audio'
+SUBTITLES = 'Text'
+
+
+def get_tracks(media_info, track_type):
+    return [track for track in media_info['tracks'] if track.get('track_type') == track_type]
+
+
+def get_language(track):
+    # MediaInfo gives a language code, with the full names in other_language
+    language = track.get('language') or (track.get('other_language') or [None])[0]
+    return language.lower() if language else None
+
+
+def get_title(track):
+    title = track.get('title')
+    return title.strip().lower() if title else None
+
+
+class TrackRule(object):
+
+    def __init__(self, language=None, title=None):
+        self.language = language
+        self.title = title
+
+    @classmethod
+    def from_track(cls, track):
+        return cls(language=get_language(track), title=get_title(track))
+
+    def describe(self):
+        if self.language and self.title:
+            return '{} ({})'.format(self.language, self.title)
+        return self.language or self.title or 'first track'
+
+    def choose(self, tracks):
+        # Returns the 1 based number of the best matching track, or None when nothing matches.
+        # Language and title together beat language alone, which beats title alone
+        if not tracks:
+            return None
+
+        best, best_score = None, 0
+        for i, track in enumerate(tracks):
+            score = 0
+            if self.language and get_language(track) == self.language:
+                score += 2
+            if self.title and get_title(track) == self.title:
+                score += 1
+            if score > best_score:
+                best, best_score = i + 1, score
+
+        return best
@@ -0,0 +1,230 @@
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+INDEX_FILE = 'index.csv'
+
+
+class CachedTranscode(object):
+    def __init__(self, key, path, segments):
+        self.key = key
+        self.path = path
+        # List of (filename, start, end) in presentation order
+        self.segments = segments
+
+    def get_duration(self):
+        return self.segments[-1][2] if self.segments else 0.0
+
+    def write_playlist(self, seek_time):
+        # Write an ffconcat playlist starting from the segment containing seek_time.
+        # Returns (playlist path, time the playlist actually starts at), or None if seek_time is past the end
+        first = None
+        for i, (_, start, end) in enumerate(self.segments):
+            if end > seek_time:
+                first = i
+                break
+        if first is None:
+            return None
+
+        fd, playlist_path = tempfile.mkstemp(suffix='.ffconcat', dir=self.path)
+        with open(fd, 'w') as f:
+            f.write('ffconcat version 1.0\n')
+            for filename, start, end in self.segments[first:]:
+                f.write('file \'{}\'\n'.format(filename))
+                f.write('duration {:.6f}\n'.format(end - start))
+
+        return playlist_path, self.segments[first][1]
+
+
+# On-disk cache of fully encoded videos, split into MPEG-TS segments so playback can stream-copy from any segment.
+# Entries are content-addressed by the source file (path, size, mtime), the chosen tracks and the exact encode
+# parameters, so changing any of them yields a new entry. A single background worker encodes queued videos ahead of
+# time, and the least recently used entries are evicted to stay within the disk budget.
+# With an encoder pool, the worker takes a background slot from it for each encode, and stops and requeues the job
+# when a stream needs the slot.
+class TranscodeCache(object):
+
+    def __init__(self, cache_dir, max_bytes, segment_time=4, threads=2, encoder_pool=None):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._segment_time = segment_time
+        self._threads = threads
+        self._encoder_pool = encoder_pool
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._jobs = asyncio.Queue()
+        self._scheduled = set()
+        self._in_use = {}
+        self._encoding_process = None
+        self._preempted = False
+        asyncio.ensure_future(self._process_jobs())
+
+    @staticmethod
+    def get_key(absolute_path, encode_params):
+        st = os.stat(absolute_path)
+        key_data = json.dumps([os.path.abspath(absolute_path), st.st_size, st.st_mtime_ns, encode_params])
+        return hashlib.sha1(key_data.encode('utf-8')).hexdigest()
+
+    def _load_entry(self, key):
+        entry_path = os.path.join(self._cache_dir, key)
+        try:
+            with open(os.path.join(entry_path, INDEX_FILE), 'r', newline='') as f:
+                segments = [(row[0], float(row[1]), float(row[2])) for row in csv.reader(f) if row]
+        except OSError:
+            return None
+
+        # Touch the entry so LRU eviction sees it as recently used
+        os.utime(entry_path)
+        return CachedTranscode(key, entry_path, segments)
+
+    def _lookup(self, absolute_path, encode_params):
+        try:
+            key = self.get_key(absolute_path, encode_params)
+        except OSError:
+            return None
+        return self._load_entry(key)
+
+    async def lookup(self, absolute_path, encode_params):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._lookup, absolute_path, encode_params)
+
+    def acquire(self, entry):
+        # Entries being streamed from are never evicted
+        self._in_use[entry.key] = self._in_use.get(entry.key, 0) + 1
+
+    def release(self, entry):
+        self._in_use[entry.key] -= 1
+        if self._in_use[entry.key] <= 0:
+            del self._in_use[entry.key]
+
+    def schedule(self, absolute_path, encode_params):
+        # Called on every enqueue, so it never touches the disk. The worker works out the cache key, which needs a
+        # stat of the source, once it gets to the job
+        job_id = (os.path.abspath(absolute_path), json.dumps(encode_params))
+        if job_id in self._scheduled:
+            return
+
+        self._scheduled.add(job_id)
+        self._jobs.put_nowait((job_id, absolute_path, encode_params))
+
+    def _get_missing_key(self, absolute_path, encode_params):
+        # Blocking: the cache key for a job, or None if the source is gone or is already cached
+        try:
+            key = self.get_key(absolute_path, encode_params)
+        except OSError:
+            return None
+        if os.path.exists(os.path.join(self._cache_dir, key, INDEX_FILE)):
+            return None
+        return key
+
+    def _preempt(self):
+        # A stream is waiting for the encoder slot this worker holds
+        self._preempted = True
+        if self._encoding_process is not None and self._encoding_process.returncode is None:
+            self._encoding_process.terminate()
+
+    async def _process_jobs(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            job = await self._jobs.get()
+            job_id, absolute_path, encode_params = job
+            requeue = False
+            try:
+                key = await loop.run_in_executor(None, self._get_missing_key, absolute_path, encode_params)
+                if key is not None:
+                    if self._encoder_pool:
+                        await self._encoder_pool.acquire_background(self, self._preempt)
+                    self._preempted = False
+                    try:
+                        requeue = not await self._encode(key, absolute_path, encode_params)
+                    finally:
+                        if self._encoder_pool:
+                            self._encoder_pool.release(self)
+            except Exception as e:
+                print('Pre-transcode of {} failed: {}'.format(os.path.basename(absolute_path), e))
+            finally:
+                if requeue:
+                    # Starts over once the pool has a slot to spare again
+                    print('Pre-transcode of {} interrupted for a stream, will retry'.format(
+                        os.path.basename(absolute_path)))
+                    self._jobs.put_nowait(job)
+                else:
+                    self._scheduled.discard(job_id)
+
+    async def _encode(self, key, absolute_path, encode_params):
+        # Returns False when the encode was preempted before it finished
+        import ffmpy3
+
+        loop = asyncio.get_event_loop()
+        entry_path = os.path.join(self._cache_dir, key)
+        partial_path = entry_path + '.partial'
+        await loop.run_in_executor(None, shutil.rmtree, partial_path, True)
+        os.makedirs(partial_path)
+
+        ffmpeg = ffmpy3.FFmpeg(
+            global_options=['-hide_banner', '-loglevel', 'error', '-nostats'],
+            inputs={absolute_path: None},
+            outputs={os.path.join(partial_path, 'seg_%05d.ts'): encode_params + [
+                # Leave CPU for the realtime encoders
+                '-threads', str(self._threads),
+
+                # Put a keyframe on every segment boundary so any segment can be streamed on its own
+                '-force_key_frames', 'expr:gte(t,n_forced*{})'.format(self._segment_time),
+
+                '-f', 'segment',
+                '-segment_time', str(self._segment_time),
+                '-segment_format', 'mpegts',
+                '-segment_list', os.path.join(partial_path, INDEX_FILE + '.tmp'),
+                '-segment_list_type', 'csv',
+                '-reset_timestamps', '0',
+            ]},
+        )
+
+        print('Pre-transcoding {}'.format(os.path.basename(absolute_path)))
+        start = time.perf_counter()
+        self._encoding_process = await ffmpeg.run_async()
+        if self._preempted:
+            self._encoding_process.terminate()
+        returncode = await self._encoding_process.wait()
+        self._encoding_process = None
+
+        if self._preempted:
+            await loop.run_in_executor(None, shutil.rmtree, partial_path, True)
+            return False
+        if returncode != 0:
+            await loop.run_in_executor(None, shutil.rmtree, partial_path, True)
+            raise RuntimeError('FFmpeg exited with code {}'.format(returncode))
+
+        # The index only appears under its final name once every segment is complete
+        os.rename(os.path.join(partial_path, INDEX_FILE + '.tmp'), os.path.join(partial_path, INDEX_FILE))
+        await loop.run_in_executor(None, shutil.rmtree, entry_path, True)
+        os.rename(partial_path, entry_path)
+        print('Pre-transcoded {} in {:.0f} s'.format(os.path.basename(absolute_path), time.perf_counter() - start))
+
+        await loop.run_in_executor(None, self._evict)
+        return True
+
+    @staticmethod
+    def _get_dir_size(path):
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self._cache_dir):
+            if entry.is_dir() and not entry.name.endswith('.partial'):
+                entries.append((entry.stat().st_mtime, entry.name, self._get_dir_size(entry.path)))
+
+        total_bytes = sum(size for _, _, size in entries)
+        for _, key, size in sorted(entries):
+            if total_bytes <= self._max_bytes:
+                break
+            if key in self._in_use:
+                continue
+            shutil.rmtree(os.path.join(self._cache_dir, key), True)
+            total_bytes -= size
+            print('Evicted pre-transcoded entry {} ({} bytes)'.format(key, size))
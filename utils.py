@@ -3,7 +3,9 @@ import humanize
 from io import StringIO
 
 
-async def ask_for_int(bot, message, lower_bound=None, upper_bound=None, timeout=30, timeout_msg=None, default=None):
+async def ask_for_int(bot, message, lower_bound=None, upper_bound=None, timeout=30, timeout_msg=None, default=None,
+                      channel=None, messages=None):
+    # messages is an optional MessageScheduler to send through, which needs the channel to send to
     def check(msg):
         s = msg.content
         if not s.isdigit():
@@ -15,13 +17,21 @@ async def ask_for_int(bot, message, lower_bound=None, upper_bound=None, timeout=
             return False
         return True
 
-    await bot.say(message)
-    message = await bot.wait_for_message(timeout=timeout, check=check)
+    if messages:
+        # Wait for the question to actually go out before starting the timeout
+        await messages.say(channel, message)
+    else:
+        await bot.say(message)
+    # With several stream sessions running, only accept an answer from the channel the question was asked in
+    message = await bot.wait_for_message(timeout=timeout, channel=channel, check=check)
 
     if message is None:
         if not timeout_msg:
             timeout_msg = 'No response received within 30 seconds. Using default value.'
-        await bot.say(timeout_msg)
+        if messages:
+            messages.say(channel, timeout_msg)
+        else:
+            await bot.say(timeout_msg)
         return default
 
     return int(message.content)
@@ -79,3 +89,19 @@ def format_file_entry(num, max_num, entry):
     output.write(' ' * (MAX_WIDTH - current_width - len(size_str)))
     output.write(size_str)
     return output.getvalue()
+
+
+def split_pages(lines, budget):
+    # Splits rendered lines into pages of consecutive lines that fit in budget characters once joined by newlines.
+    # Returns (start, end) index pairs, always at least one. A line too long for any page gets a page of its own
+    pages = []
+    start, length = 0, 0
+    for i, line in enumerate(lines):
+        line_length = len(line) + 1
+        if i > start and length + line_length > budget:
+            pages.append((start, i))
+            start, length = i, 0
+        length += line_length
+    if start < len(lines) or not pages:
+        pages.append((start, len(lines)))
+    return pages
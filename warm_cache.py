@@ -0,0 +1,60 @@
+import os
+import pickle
+
+SNAPSHOT_VERSION = 1
+
+
+# Snapshot of state that is cheap to keep but slow to rebuild after a restart: each session's current directory and
+# cached directory listings, and the most recent probe results. Restoring it lets the first !ls, !cd and !play after a
+# restart skip the cold directory scans and probes. Everything in it is checked against the filesystem again when it
+# is used (listings by directory mtime, probes by size and mtime), so a stale snapshot only costs the rescans it was
+# meant to save.
+
+def load_snapshot(snapshot_file):
+    # Blocking: the snapshot dict, or None when there is no usable snapshot
+    try:
+        with open(snapshot_file, 'rb') as f:
+            snapshot = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
+
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+    return snapshot
+
+
+def build_snapshot(sessions, metadata_cache):
+    session_states = {}
+    for session in sessions:
+        current_path, listings = session.file_explorer.get_warm_state()
+        session_states[session.name] = {
+            'root_path': session.file_explorer.get_root_path(),
+            'current_path': current_path,
+            'listings': listings,
+        }
+
+    return {
+        'version': SNAPSHOT_VERSION,
+        'sessions': session_states,
+        'probes': metadata_cache.get_warm_entries(),
+    }
+
+
+def restore_snapshot(snapshot, sessions, metadata_cache):
+    for session in sessions:
+        state = snapshot['sessions'].get(session.name)
+        # A session whose media directory changed starts cold
+        if state is None or state['root_path'] != session.file_explorer.get_root_path():
+            continue
+        session.file_explorer.restore_warm_state(state['current_path'], state['listings'])
+
+    metadata_cache.restore_warm_entries(snapshot['probes'])
+
+
+def save_snapshot(snapshot_file, snapshot):
+    # Blocking: written to a temporary file first so a crash mid-write never leaves a truncated snapshot behind
+    os.makedirs(os.path.dirname(os.path.abspath(snapshot_file)), exist_ok=True)
+    tmp_file = snapshot_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, snapshot_file)